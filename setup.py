@@ -63,11 +63,14 @@ setup(
             'check-mounts = swiftlm.systems.check_mounts:main',
             'connectivity = swiftlm.systems.connectivity:main',
             'system = swiftlm.systems.system:main',
+            'diskstats = swiftlm.systems.diskstats:main',
+            'memcache = swiftlm.systems.memcache:main',
             'drive-audit = swiftlm.swift.drive_audit:main',
             'file-ownership = swiftlm.swift.file_ownership:main',
             'swift-services = swiftlm.swift.swift_services:main',
             'replication = swiftlm.swift.replication:main',
             'hpssacli = swiftlm.hp_hardware.hpssacli:main',
+            'smart = swiftlm.generic_hardware.smart:main',
         ],
     },
     include_package_data=True,
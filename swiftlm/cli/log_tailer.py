@@ -27,13 +27,14 @@ from swiftlm.utils.log_tailer import LogTailer, parse_proxy_log_message, \
     AccessStatsRecorder
 from swiftlm.utils.utility import dump_swiftlm_uptime_data, get_logger, \
     sleep_interval
+from swiftlm.utils.histogram import PERCENTILES
 
 
 usage = """
 Program to tail a swift log file, extract messages coming from the
 proxy-logging middleware and derive stats such as number of operations, bytes
 put and bytes get. The stats are worked out as a total and for each
-project.
+project. Percentiles of the request time are worked out for the total.
 
 At the end of each cycle, it writes the stats as metrics to a metrics
 json file. The swiftlm plugin will send these to Monasca.
@@ -105,6 +106,28 @@ def make_measurements(metric_name_prefix, stats, timestamp,
     return metrics
 
 
+def make_latency_measurements(metric_name_prefix, histogram, timestamp):
+    """
+    Convert a histogram of request times into percentile metrics, e.g.
+    <metric_name_prefix>p99.latency_sec
+
+    :param metric_name_prefix: first part of metric name
+    :param histogram: LatencyHistogram of request times in seconds
+    :param timestamp: timestamp
+    :return: list of metrics; empty if there were no requests
+    """
+    metrics = []
+    if not histogram.count:
+        return metrics
+    for percent in PERCENTILES:
+        metrics.append({'metric': metric_name_prefix +
+                        'p%g.latency_sec' % percent,
+                        'value': round(histogram.percentile(percent), 4),
+                        'timestamp': timestamp,
+                        'dimensions': {'service': 'object-storage'}})
+    return metrics
+
+
 def purge_old_measurements(metrics, interval, monasca_agent_interval):
     """
     Purge old measurements
@@ -182,11 +205,14 @@ def run_forever(log_file_name, interval, metric_file, reseller_prefixes,
                                     result.get('bytes_transferred'),
                                     project=result.get('project'),
                                     container=result.get('container'),
-                                    obj=result.get('obj'))
+                                    obj=result.get('obj'),
+                                    request_time=result.get('request_time'))
 
             # Convert stats into metric measurements
             total_metrics = make_measurements('swiftlm.access.host.operation.',
                                               stats.get_stats(), timestamp)
+            total_metrics.extend(make_latency_measurements(
+                'swiftlm.access.host.operation.', stats.latency, timestamp))
             for measurement in total_metrics:
                 metric_data.append(measurement)
 
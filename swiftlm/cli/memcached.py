@@ -17,13 +17,19 @@
 
 import ConfigParser
 from ConfigParser import NoSectionError, NoOptionError
+from bisect import bisect
 from optparse import OptionParser
 import random
 import sys
 import time
+import eventlet
+from eventlet import Timeout
 from swift.common.memcached import (MemcacheRing, CONN_TIMEOUT, POOL_TIMEOUT,
-                                    IO_TIMEOUT, TRY_COUNT)
+                                    IO_TIMEOUT, TRY_COUNT, md5hash,
+                                    MemcacheConnectionError)
 from swiftlm.utils.utility import KeyNames
+from swiftlm.utils.histogram import LatencyHistogram, PERCENTILES
+from swiftlm.utils.memcache import ring_server
 
 
 usage = """
@@ -45,6 +51,22 @@ Usage:
     swiftlm-memcached test_gets  [--keys <number>]
                                  [--run_time <seconds>]
 
+    swiftlm-memcached load       [--keys <number>]
+                                 [--run_time <seconds>]
+                                 [--clients <number>]
+                                 [--get_ratio <fraction>]
+                                 [--value_sizes <bytes>,<bytes>,...]
+                                 [--distribution uniform|zipfian]
+                                 [--zipf_alpha <exponent>]
+                                 [--rate <ops per second>]
+
+    load runs a number of concurrent clients (greenthreads sharing one
+    MemcacheRing, as the greenthreads of a proxy server do) that do a mix
+    of get and set operations, and reports the throughput and the latency
+    and errors of the operations sent to each server of the ring. Unlike
+    the Swift client, an operation is not retried on another server, so
+    the latency and errors of each server are its own.
+
 
     Options:
       --config <filename>
@@ -60,63 +82,78 @@ Usage:
         Default is 100 keys.
 
       --run_time <seconds>
-        In test_conns and test_gets, run for this number of seconds.
+        In test_conns, test_gets and load, run for this number of seconds.
         Defaults to 30 seconds.
+
+      --clients <number>
+        In load, the number of concurrent clients. Defaults to 10.
+
+      --get_ratio <fraction>
+        In load, the fraction of operations that are gets; the rest are
+        sets. Defaults to 0.9.
+
+      --value_sizes <bytes>,<bytes>,...
+        In load, each set uses one of these value sizes, chosen at random.
+        Defaults to 100.
+
+      --distribution uniform|zipfian
+        In load, how keys are chosen. With zipfian a few keys are used far
+        more than the rest, as with tokens of busy users. Defaults to
+        uniform.
+
+      --zipf_alpha <exponent>
+        The exponent of the zipfian distribution. Defaults to 1.0.
+
+      --rate <ops per second>
+        In load, the target rate of operations over all clients. Defaults
+        to 0, as fast as possible.
 """
 
 
-class Buckets(object):
+def new_histogram():
     """
-    Track latency average and pattern
+    :returns: a LatencyHistogram for latencies in milliseconds
+    """
+    return LatencyHistogram(min_value=0.01, max_value=10000.0)
+
+
+def format_latency(histogram):
+    lines = []
+    if histogram.count > 0:
+        lines.append('Count: %d  Average: %.3f ms'
+                     % (histogram.count, histogram.mean()))
+        lines.append('  '.join('p%g: %.3f ms'
+                               % (percent, histogram.percentile(percent))
+                               for percent in PERCENTILES))
+    lines.append('Range %s ms - %s ms' % (histogram.min, histogram.max))
+    return '\n'.join(lines)
+
+
+class KeyChooser(object):
+    """
+    Chooses key numbers from 1 to number_of_keys, uniformly or with a
+    zipfian distribution (key k chosen in proportion to 1 / k ** alpha).
     """
-    def __init__(self):
-        self.slots = [0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 2.0, 5.0, 10.0, 15.0,
-                      20.0, 25.0, 30.0, 40.0]
-        self.bucket = {}
-        for slot in self.slots:
-            self.bucket[str(slot)] = 0
-        self.bucket['>'] = 0
-        self.total = 0.0
-        self.count = 0
-        self.min = None
-        self.max = 0.0
-
-    def record(self, latency):
-        if self.min is None:
-            self.min = latency
-            self.max = latency
-        if self.min > latency:
-            self.min = latency
-        if self.max < latency:
-            self.max = latency
-        off_end = True
-        for slot in self.slots:
-            if latency <= slot:
-                self.bucket[str(slot)] += 1
-                off_end = False
-                break
-        if off_end:
-            self.bucket['>'] += 1
-        self.total += latency
-        self.count += 1
-
-    def __repr__(self):
-        lines = []
-        if self.count > 0:
-            lines.append('Average: %s ms' % float(self.total/self.count))
-        headings = ''
-        for slot in self.slots:
-            headings += '   %s ' % slot
-        headings += ' > '
-        lines.append(headings)
-        values = ''
-        for slot in self.slots:
-            # Does not align once slot is double-digit; not worth effort to fix
-            values += ' %5d ' % self.bucket[str(slot)]
-        values += ' %5d ' % self.bucket['>']
-        lines.append(values)
-        lines.append('Range %s ms - %s ms' % (self.min, self.max))
-        return '\n'.join(lines)
+
+    def __init__(self, number_of_keys, distribution='uniform', alpha=1.0,
+                 rand=random):
+        self.number_of_keys = number_of_keys
+        self.rand = rand
+        self.cumulative = None
+        if distribution == 'zipfian':
+            total = 0.0
+            self.cumulative = []
+            for k in range(1, number_of_keys + 1):
+                total += 1.0 / k ** alpha
+                self.cumulative.append(total)
+        elif distribution != 'uniform':
+            raise ValueError('Unknown distribution: %s' % distribution)
+
+    def choose(self):
+        if self.cumulative is None:
+            return self.rand.randint(1, self.number_of_keys)
+        return bisect(self.cumulative,
+                      self.rand.random() * self.cumulative[-1]) + 1
 
 
 def memcached_main(action, options, key=None, value=None):
@@ -145,6 +182,8 @@ def memcached_main(action, options, key=None, value=None):
         test_conns(options)
     elif action == 'test_gets':
         test_gets(memcache_ring, options)
+    elif action == 'load':
+        print(format_load_report(load(memcache_ring, options)))
 
 
 def get_memcache_ring(options):
@@ -170,21 +209,21 @@ def test_conns(options):
     # Read them back until time to stop
     start_time = time.time()
     count = 0
-    buckets = Buckets()
+    latencies = new_histogram()
     for key in keys.get_keys_forever():
         count += 1
         # This does not connect
         del memcache_ring
         memcache_ring = get_memcache_ring(options)
         value, latency = memcache_get(memcache_ring, key)
-        buckets.record(latency)
+        latencies.record(latency)
         if time.time() - start_time > options['run_time']:
             break
     print('Duration: %s sec' % str(time.time() - start_time))
     print('Average for %s cycles: %s ms' % (
         count, str((time.time() - start_time) * 1000 / count)))
     print('Latency for: connect + get')
-    print('%s' % buckets)
+    print(format_latency(latencies))
 
 
 def test_gets(memcache_ring, options):
@@ -196,18 +235,178 @@ def test_gets(memcache_ring, options):
     # Read them back until time to stop
     start_time = time.time()
     count = 0
-    buckets = Buckets()
+    latencies = new_histogram()
     for key in keys.get_keys_forever():
         count += 1
         value, latency = memcache_get(memcache_ring, key)
-        buckets.record(latency)
+        latencies.record(latency)
         if time.time() - start_time > options['run_time']:
             break
     print('Duration: %s sec' % str(time.time() - start_time))
     print('Average for %s cycles: %s ms' % (
         count, str((time.time() - start_time) * 1000 / count)))
     print('Latency per get:')
-    print('%s' % buckets)
+    print(format_latency(latencies))
+
+
+def load_key(number):
+    return 'swiftlm-load-%d' % number
+
+
+class ServerUnavailable(Exception):
+    pass
+
+
+def server_op(memcache_ring, server, key, value=None, expiry=0):
+    """
+    Get key from (value None), or set key to value on, the server that
+    MemcacheRing sends key to, on a connection from the ring's pool.
+    Unlike MemcacheRing.get and set, a failure is not retried on the next
+    server of the ring but is raised, after it has been counted against
+    the server as MemcacheRing would.
+
+    :param server: the server key belongs to, from ring_server()
+    :returns: True if a get found the key
+    :raises ServerUnavailable: if the server is error limited or cannot be
+                               connected to
+    :raises Exception, Timeout: if the operation fails
+    """
+    key = md5hash(key)
+    # The first server _get_conns() yields is server, unless server is
+    # error limited or the connection failed
+    conns = memcache_ring._get_conns(key)
+    try:
+        conn = next(conns, None)
+    finally:
+        conns.close()
+    if conn is None or conn[0] != server:
+        if conn is not None:
+            memcache_ring._return_conn(*conn)
+        raise ServerUnavailable('%s is error limited or did not connect'
+                                % server)
+
+    _, fp, sock = conn
+    found = False
+    try:
+        with Timeout(memcache_ring._io_timeout):
+            if value is None:
+                sock.sendall('get %s\r\n' % key)
+                line = fp.readline().strip().split()
+                while True:
+                    if not line:
+                        raise MemcacheConnectionError('incomplete read')
+                    if line[0].upper() == 'END':
+                        break
+                    if line[0].upper() == 'VALUE' and line[1] == key:
+                        fp.read(int(line[3]))
+                        fp.readline()
+                        found = True
+                    line = fp.readline().strip().split()
+            else:
+                sock.sendall('set %s 0 %d %d\r\n%s\r\n'
+                             % (key, expiry, len(value), value))
+                reply = fp.readline().strip()
+                if reply != 'STORED':
+                    raise MemcacheConnectionError(
+                        'set failed: %s' % (reply or 'incomplete read'))
+        memcache_ring._return_conn(server, fp, sock)
+    except (Exception, Timeout) as err:
+        memcache_ring._exception_occurred(server, err, sock=sock, fp=fp)
+        raise
+    return found
+
+
+def load(memcache_ring, options):
+    """
+    Run options['clients'] concurrent clients, each doing gets and sets
+    until options['run_time'] has passed.
+
+    :returns: dictionary with the duration, the number of gets, sets, misses
+              and errors, a latency histogram of the successful operations
+              of each server and the number of errors of each server
+    """
+    chooser = KeyChooser(options['number_of_keys'],
+                         options['distribution'], options['zipf_alpha'])
+    values = dict((size, 'x' * size) for size in options['value_sizes'])
+    expiry = int(options['run_time']) + 100
+    servers = dict((key, ring_server(memcache_ring, load_key(key)))
+                   for key in range(1, options['number_of_keys'] + 1))
+    stats = {'gets': 0, 'sets': 0, 'misses': 0, 'errors': 0,
+             'servers': dict((server, new_histogram())
+                             for server in options['servers']),
+             'server_errors': dict((server, 0)
+                                   for server in options['servers'])}
+
+    # Set a value for every key so that gets hit
+    for key in range(1, options['number_of_keys'] + 1):
+        memcache_ring.set(load_key(key),
+                          values[random.choice(options['value_sizes'])],
+                          time=expiry)
+
+    clients = options['clients']
+    # Each client paces itself to its share of the target rate
+    interval = clients / float(options['rate']) if options['rate'] else 0
+    start_time = time.time()
+    end_time = start_time + options['run_time']
+
+    def client(n):
+        next_time = start_time + interval * n / clients
+        while True:
+            now = time.time()
+            if now >= end_time:
+                break
+            if next_time > now:
+                eventlet.sleep(next_time - now)
+            next_time += interval
+            key = chooser.choose()
+            server = servers[key]
+            op_start = time.time()
+            try:
+                if random.random() < options['get_ratio']:
+                    stats['gets'] += 1
+                    if not server_op(memcache_ring, server, load_key(key)):
+                        stats['misses'] += 1
+                else:
+                    stats['sets'] += 1
+                    server_op(memcache_ring, server, load_key(key),
+                              values[random.choice(options['value_sizes'])],
+                              expiry)
+            except (Exception, Timeout):
+                stats['errors'] += 1
+                stats['server_errors'][server] += 1
+                continue
+            stats['servers'][server].record((time.time() - op_start) * 1000)
+
+    pool = eventlet.GreenPool(clients)
+    for n in range(clients):
+        pool.spawn_n(client, n)
+    pool.waitall()
+    stats['duration'] = time.time() - start_time
+    return stats
+
+
+def format_load_report(stats):
+    ops = stats['gets'] + stats['sets']
+    lines = ['Duration: %.1f sec' % stats['duration'],
+             'Throughput: %.1f ops/sec (%d gets, %d sets)'
+             % (ops / stats['duration'], stats['gets'], stats['sets']),
+             'Misses: %d  Errors: %d' % (stats['misses'], stats['errors']),
+             'Latency per server (ms):',
+             '%-24s %8s %8s %8s' % ('server', 'errors', 'ops', 'ops/sec') +
+             ''.join(' %8s' % ('p%g' % percent) for percent in PERCENTILES) +
+             ' %8s' % 'max']
+    for server, latencies in sorted(stats['servers'].items()):
+        errors = stats['server_errors'].get(server, 0)
+        if not latencies.count:
+            lines.append('%-24s %8d %8d' % (server, errors, 0))
+            continue
+        lines.append('%-24s %8d %8d %8.1f' % (server, errors, latencies.count,
+                                              latencies.count /
+                                              stats['duration']) +
+                     ''.join(' %8.3f' % latencies.percentile(percent)
+                             for percent in PERCENTILES) +
+                     ' %8.3f' % latencies.max)
+    return '\n'.join(lines)
 
 
 def memcache_get(memcache_ring, key):
@@ -223,6 +422,13 @@ def main():
     parser.add_option('--servers', dest='servers', default=None)
     parser.add_option('--run_time', dest='run_time', default=30)
     parser.add_option('--keys', dest='keys', default=100)
+    parser.add_option('--clients', dest='clients', default=10)
+    parser.add_option('--get_ratio', dest='get_ratio', default=0.9)
+    parser.add_option('--value_sizes', dest='value_sizes', default='100')
+    parser.add_option('--distribution', dest='distribution',
+                      default='uniform', choices=['uniform', 'zipfian'])
+    parser.add_option('--zipf_alpha', dest='zipf_alpha', default=1.0)
+    parser.add_option('--rate', dest='rate', default=0)
     (options, args) = parser.parse_args()
 
     if not options.config_file:
@@ -275,6 +481,14 @@ def main():
                                                             IO_TIMEOUT))
     main_options['run_time'] = float(options.run_time)
     main_options['number_of_keys'] = int(options.keys)
+    main_options['clients'] = max(1, int(options.clients))
+    main_options['get_ratio'] = float(options.get_ratio)
+    main_options['value_sizes'] = [int(size) for size in
+                                   options.value_sizes.split(',')
+                                   if size.strip()]
+    main_options['distribution'] = options.distribution
+    main_options['zipf_alpha'] = float(options.zipf_alpha)
+    main_options['rate'] = float(options.rate)
     if len(args) == 0:
         print('Missing command')
         sys.exit(1)
@@ -15,15 +15,21 @@
 # under the License.
 #
 
+import json
+import re
 import socket
 from os import getenv
 from os import path
 from sys import exit
-from collections import OrderedDict
+from collections import namedtuple
 import sys
 import urlparse
 import uuid
 import random
+import itertools
+import threading
+import calendar
+import requests
 from swiftclient import Connection
 from swiftclient import ClientException
 from swiftclient import http_connection
@@ -35,6 +41,9 @@ import ConfigParser
 from swiftlm.utils.utility import get_logger
 from swiftlm.utils.utility import dump_swiftlm_uptime_data, timestamp, Enum, \
     sleep_interval
+from swiftlm.utils.utility import run_in_threads
+from swiftlm.utils.utility import load_state, save_state
+from swiftlm.utils.histogram import LatencyHistogram
 
 from httplib import HTTPException
 
@@ -43,13 +52,40 @@ MIN_LATENCY = 'swiftlm.umon.target.min.latency_sec'
 MAX_LATENCY = 'swiftlm.umon.target.max.latency_sec'
 AVG_LATENCY = 'swiftlm.umon.target.avg.latency_sec'
 SWIFT_STATE = 'swiftlm.umon.target.check.state'
+BACKEND_LATENCY = 'swiftlm.umon.target.backend.p50.latency_sec'
+SLOWEST_BACKEND = 'swiftlm.umon.target.slowest_backend.latency_sec'
+PERCENTILE_LATENCY = 'swiftlm.umon.target.p%d.latency_sec'
+PERCENTILES = (95, 99)
+OBJECT_TTFB = 'swiftlm.umon.target.object.ttfb_sec'
+OBJECT_PUT_RATE = 'swiftlm.umon.target.object.put_bytes_per_sec'
+OBJECT_GET_RATE = 'swiftlm.umon.target.object.get_bytes_per_sec'
 AVAIL_MINUTE = 'swiftlm.umon.target.val.avail_minute'
 AVAIL_DAY = 'swiftlm.umon.target.val.avail_day'
 COMPONENT_KEYSTONE_GET_TOKEN = 'keystone-get-token'
 COMPONENT_REST_API = 'rest-api'
 COMPONENT_HEALTHCHECK_API = 'healthcheck-api'
+# The requests that make up a rest-api probe
+OPERATIONS = ('head-account', 'put-container', 'put-object', 'get-object',
+              'delete-object')
 LATENCY_LOG_INTERVAL = 600  # Log latencies after a number of cycles
 WAKE_UP_SECOND = 30  # Synchronise sleeps so we wake up in middle of minute
+PROBE_TIMEOUT = 30.0  # Socket timeout of each probe
+PROBE_CONCURRENCY = 10  # Number of probes run at once
+TOKEN_LIFETIME = 3600  # Keystone's default token expiration
+# A cached token is refreshed once this fraction of its lifetime is left
+TOKEN_REFRESH_FRACTION = 0.25
+# Length of a swift transaction id without the proxy's trans_id_suffix,
+# i.e. 'tx' + 21 hex digits + '-' + 10 hex digits of timestamp
+TRANS_ID_LENGTH = 34
+# Percentiles cover between one and two of these windows of samples
+HISTOGRAM_WINDOW = 3600
+LATENCY_STATE = 'uptime_latency.json'
+UPTIME_STATE = 'uptime_window.json'
+TEST_CONTAINER = 'swift_monitor_latency_test'
+SEGMENT_CONTAINER = 'swift_monitor_latency_test_segments'
+OBJECT_PROFILE_SECTION = 'object_profile:'
+PATTERN_SIZE = 65536  # Object data is streamed from a buffer of this size
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
 
 common_dimensions = dict()
 # 0 = ok, 1 = warn, 2 = fail, 3 = unknown
@@ -69,11 +105,61 @@ class UPtimeMonException(Exception):
     pass
 
 
-def health_check(url, logger):
+# Outcome of one probe. duration is None if no request was made, backend
+# is the proxy that served the probe if that is known and operations is a
+# dictionary of operation name to duration
+ProbeResult = namedtuple('ProbeResult', ['state', 'reason', 'duration',
+                                         'backend', 'operations'])
+
+# An object workload: objects of size bytes, uploaded as segments of
+# segment_size under a manifest ('slo' or 'dlo') if segment_size is set,
+# every few cycles
+ObjectProfile = namedtuple('ObjectProfile', ['name', 'size', 'segment_size',
+                                             'manifest', 'every'])
+
+
+def parse_size(value):
+    """
+    :param value: a size in bytes, with an optional binary unit, e.g. 4096,
+                  4K, 4KiB or 64MiB
+    :returns: the size in bytes
+    :raises ValueError: if value is not a size
+    """
+    match = re.match(r'^\s*(\d+)\s*(?:([kmg])(?:i?b)?|b)?\s*$', value,
+                     re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: %s' % value)
+    return int(match.group(1)) * SIZE_UNITS[(match.group(2) or '').lower()]
+
+
+class PatternReader(object):
+    """
+    A file-like object returning size bytes by repeating one buffer, so
+    that large objects can be uploaded without building them in memory.
+    """
+    pattern = None
+
+    def __init__(self, size):
+        if PatternReader.pattern is None:
+            PatternReader.pattern = ''.join(
+                chr(random.randint(0, 255)) for _ in range(PATTERN_SIZE))
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > PATTERN_SIZE:
+            size = PATTERN_SIZE
+        size = min(size, self.remaining)
+        self.remaining -= size
+        if size == PATTERN_SIZE:
+            return self.pattern
+        return self.pattern[:size]
+
+
+def health_check(url, logger, timeout=None):
     scheme = urlparse.urlparse(url).scheme
     netloc = urlparse.urlparse(url).netloc
     url = scheme + '://' + netloc + '/healthcheck'
-    parsed, conn = http_connection(url)
+    parsed, conn = http_connection(url, timeout=timeout)
     logger.debug('GET %s' % url)
     conn.request('GET', parsed.path, '', {'X-Auth-Token': 'none-needed'})
     resp = conn.getresponse()
@@ -90,6 +176,101 @@ def health_check(url, logger):
     return resp_headers
 
 
+def backend_name(headers, proxy_header=None):
+    """
+    Work out which proxy served a request.
+
+    :param headers: response headers, with lower case names
+    :param proxy_header: name of a header that identifies the proxy, e.g.
+                         one added by the load balancer
+    :returns: the value of proxy_header if present, else the suffix of
+              X-Trans-Id (the proxy's trans_id_suffix), else None
+    """
+    if not headers:
+        return None
+    if proxy_header and headers.get(proxy_header.lower()):
+        return headers[proxy_header.lower()]
+    trans_id = headers.get('x-trans-id')
+    if trans_id and len(trans_id) > TRANS_ID_LENGTH:
+        return trans_id[TRANS_ID_LENGTH:].lstrip('-')
+    return None
+
+
+class UptimeWindow(object):
+    """
+    Availability of each of the last 24 hours of minutes, in a circular
+    array of one slot per minute with a running total, so recording a
+    minute and reading the day's average take constant time.
+    """
+    period = 60
+    slots = 1440
+
+    def __init__(self):
+        self.values = [None] * self.slots
+        self.total = 0
+        self.count = 0
+        self.last_minute = None
+        self.last_time = None
+        self.last_value = None
+
+    def _set(self, minute, value):
+        index = minute % self.slots
+        old = self.values[index]
+        if old is not None:
+            self.total -= old
+            self.count -= 1
+        self.values[index] = value
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def record(self, now, value):
+        """
+        Record the availability of the minute holding now. Minutes since
+        the last record are backfilled with the same value, and minutes
+        more than 24 hours old are dropped as their slots are reused.
+        """
+        minute = int(now // self.period)
+        if self.last_minute is not None and minute > self.last_minute:
+            gap = min(minute - self.last_minute - 1, self.slots)
+            for m in range(minute - gap, minute):
+                self._set(m, value)
+        if self.last_minute is None or minute >= self.last_minute:
+            self._set(minute, value)
+            self.last_minute = minute
+            self.last_time = now
+            self.last_value = value
+
+    def average(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    def to_dict(self):
+        return {'last_minute': self.last_minute, 'last_time': self.last_time,
+                'last_value': self.last_value, 'values': self.values}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: a dictionary from to_dict, or an empty dictionary
+        :returns: UptimeWindow
+        """
+        window = cls()
+        try:
+            values = state['values']
+            if len(values) != cls.slots:
+                return window
+            for minute, value in enumerate(values):
+                window._set(minute, value)
+            window.last_minute = int(state['last_minute'])
+            window.last_time = float(state['last_time'])
+            window.last_value = state['last_value']
+        except (KeyError, TypeError, ValueError):
+            return cls()
+        return window
+
+
 def endpoint_trim(url, extension=None):
     s = urlparse.urlparse(url).netloc.split(':')[0]
     if extension is None:
@@ -101,7 +282,9 @@ def endpoint_trim(url, extension=None):
 class TrackConnection(Connection):
     def __init__(self, auth_url, user_name, key, logger, cache_file_path,
                  object_store_url=None, auth_version="2",
-                 os_options=None, latency_log_interval=LATENCY_LOG_INTERVAL):
+                 os_options=None, latency_log_interval=LATENCY_LOG_INTERVAL,
+                 proxy_header=None, proxy_hosts=None,
+                 token_lifetime=TOKEN_LIFETIME):
         socket.setdefaulttimeout(30.0)  # timeout set at socket level
         Connection.__init__(self, auth_url, user_name, key, retries=0,
                             os_options=os_options,
@@ -115,15 +298,38 @@ class TrackConnection(Connection):
                      reason='',
                      metrics={})
 
-        self.uptime = OrderedDict()
+        self.uptime = UptimeWindow.from_dict(
+            load_state(UPTIME_STATE, path.dirname(cache_file_path)))
         self.latency = dict()
+        self.backend_latency = dict()
+        # (previous, current) histograms of each component and operation
+        self.histograms = dict()
+        self.histogram_window_start = time.time()
         self.metric_data = []
         self.latency_reset()
         self.logger = logger
         self.cache_file_path = cache_file_path
+        self.load_histograms()
         self.loop_end_time = time.time()
         self.latency_log_interval = latency_log_interval
         self.last_latency_logged = 0  # Will trigger immediate log
+        self.cycle = 0  # Incremented as each set of probes starts and ends
+        self.probe_lock = threading.Lock()
+        # The token is cached until shortly before it expires
+        self.token_lifetime = token_lifetime
+        self.token_issued = 0
+        self.token_expires = 0
+        self.keystone_thread = None
+        self.keystone_lock = threading.Lock()
+        # Proxies are identified by this header (or by X-Trans-Id)
+        self.proxy_header = proxy_header
+        # If set, healthcheck probes go to each proxy in turn rather than
+        # through the load balancer
+        self.health_check_urls = None
+        if proxy_hosts:
+            scheme = urlparse.urlparse(object_store_url).scheme
+            self.health_check_urls = itertools.cycle(
+                [(host, '%s://%s/' % (scheme, host)) for host in proxy_hosts])
 
     @staticmethod
     def component_names():
@@ -151,74 +357,29 @@ class TrackConnection(Connection):
 
     def uptime_record(self, avail_percentage):
         _now = time.time()
-        _avail_period = 60
-        _avail_epoch = 60*60*24
-
-        # Keeping at least two records so the first is not the last, and at
-        # most the last _avail_epoch (24 hours) of uptime records
-        if len(self.uptime) > 1:
-
-            # First record in uptime data
-            _first_record = self.uptime.keys()[0]
-            # Last record in uptime data
-            _last_record = self.uptime.keys()[-1]
-
-            # Record a value every minute
-            if (_now - _last_record) >= _avail_period:
-
-                # If the time from the last loop is more than twice the
-                # availability period of one minute, backfill the
-                # uptime data with last known avail_percentage.
-                if (_now - _last_record) >= (2 * _avail_period):
-                    for _ in range(int((_now - _last_record) //
-                                       _avail_period)):
-                        self.uptime[(self.uptime.keys()[-1] +
-                                     _avail_period)] = avail_percentage
-                self.uptime[_now] = avail_percentage
-        else:
+        if not self.uptime.count and \
+                self.loop_end_time <= (_now - UptimeWindow.period):
             # This is the first entry in the uptime data and the endpoints
-            # are taking longer than _avail_period to respond, so backfill
-            # with last known avail_percentage.
-            if self.loop_end_time <= (_now - _avail_period):
-                self.uptime[self.loop_end_time] = avail_percentage
-                # Backfill uptime data from last loop end time in
-                # increments of one minute.
-                for _ in range(int((_now - self.loop_end_time) //
-                                   _avail_period)):
-                    self.uptime[(self.uptime.keys()[-1] +
-                                 _avail_period)] = avail_percentage
-            self.uptime[_now] = avail_percentage
-
-        # Purge the oldest record(s) in the uptime data if older
-        # than _avail_epoch.
-        while True:
-            if self.uptime.keys()[0] <= (_now - _avail_epoch):
-                self.uptime.popitem(last=False)
-            else:
-                break
-        # The logging data is reversed because the string size truncates
-        # and we won't see updates to the end of the data
-        self.logger.debug("+++++++++++++++ Uptime Data %s" %
-                          OrderedDict(sorted(self.uptime.items(),
-                                      key=lambda t: t[0], reverse=True)))
+            # are taking longer than a minute to respond, so backfill
+            # from the last loop end time with this avail_percentage.
+            self.uptime.record(self.loop_end_time, avail_percentage)
+        self.uptime.record(_now, avail_percentage)
+        save_state(UPTIME_STATE, self.uptime.to_dict(),
+                   path.dirname(self.cache_file_path))
+        self.logger.debug("+++++++++++++++ Uptime Data %s of %s minutes up"
+                          % (self.uptime.total / float(SWIFT_UP),
+                             self.uptime.count))
 
     def emit_avail_metrics(self):
-        # Total of all values in uptime dictionary
-        _total = 0
-
         # Report the most recent minute in the log
-        _avail_minute = self.uptime.values()[-1]
+        _avail_minute = self.uptime.last_value
         # Report the most recent timestamp in the log
-        _avail_timestamp = int(round(self.uptime.keys()[-1]))
-
+        _avail_timestamp = int(round(self.uptime.last_time))
         # Report the average of all minutes for the last 24 hours
-        for k, v in self.uptime.items():
-            _total += v
-            _avail_day = float(_total/len(self.uptime))
+        _avail_day = self.uptime.average()
 
         dimensions = common_dimensions.copy()
         dimensions['component'] = COMPONENT_REST_API
-        target_name = urlparse.urlparse(self.object_store_url).hostname
         dimensions['url'] = self.object_store_url
         dimensions['hostname'] = '_'
         self.metric_data.append(
@@ -229,6 +390,7 @@ class TrackConnection(Connection):
                  dimensions=dimensions, timestamp=_avail_timestamp))
 
     def latency_reset(self):
+        self.backend_latency = dict()
         for component_name in self.component_names():
             self.latency[(component_name, 'num-samples')] = 0
             self.latency[(component_name, 'total-time')] = 0
@@ -236,7 +398,79 @@ class TrackConnection(Connection):
             self.latency[(component_name, 'min-latency')] = None
             self.latency[(component_name, 'max-latency')] = 0
 
-    def latency_record(self, component_name, duration):
+    def histogram_record(self, name, duration):
+        if name not in self.histograms:
+            self.histograms[name] = (LatencyHistogram(), LatencyHistogram())
+        self.histograms[name][1].record(duration)
+
+    def histogram_roll(self, now):
+        """Start a new window of samples once the current one is full"""
+        elapsed = now - self.histogram_window_start
+        if elapsed < HISTOGRAM_WINDOW:
+            return
+        for name, (previous, current) in self.histograms.items():
+            if elapsed >= 2 * HISTOGRAM_WINDOW:
+                current = LatencyHistogram()
+            self.histograms[name] = (current, LatencyHistogram())
+        self.histogram_window_start = now
+
+    def load_histograms(self):
+        state = load_state(LATENCY_STATE,
+                           path.dirname(self.cache_file_path))
+        try:
+            self.histogram_window_start = float(state['window_start'])
+            for name, (previous, current) in state['histograms'].items():
+                self.histograms[name] = (
+                    LatencyHistogram.from_dict(previous),
+                    LatencyHistogram.from_dict(current))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.histograms = dict()
+            self.histogram_window_start = time.time()
+
+    def save_histograms(self):
+        state = {'window_start': self.histogram_window_start,
+                 'histograms': dict(
+                     (name, (previous.to_dict(), current.to_dict()))
+                     for name, (previous, current) in self.histograms.items())}
+        save_state(LATENCY_STATE, state, path.dirname(self.cache_file_path))
+
+    def percentile_write_log(self):
+        """
+        Report latency percentiles of each component and of each operation
+        of the rest-api probe, over the current and previous windows.
+        """
+        self.histogram_roll(time.time())
+        for name, (previous, current) in sorted(self.histograms.items()):
+            histogram = LatencyHistogram()
+            histogram.merge(previous)
+            histogram.merge(current)
+            if not histogram.count:
+                continue
+            dimensions = common_dimensions.copy()
+            if name in OPERATIONS:
+                dimensions['component'] = COMPONENT_REST_API
+                dimensions['operation'] = name
+            else:
+                dimensions['component'] = name
+            if name == COMPONENT_KEYSTONE_GET_TOKEN:
+                dimensions['url'] = self.authurl
+            else:
+                dimensions['url'] = self.object_store_url
+            dimensions['hostname'] = '_'
+            for percent in PERCENTILES:
+                self.metric_data.append(
+                    dict(metric=PERCENTILE_LATENCY % percent,
+                         value=histogram.percentile(percent),
+                         dimensions=dimensions, timestamp=timestamp()))
+        self.save_histograms()
+
+    def latency_record(self, component_name, duration, backend=None):
+        self.histogram_record(component_name, duration)
+        if backend:
+            key = (component_name, backend)
+            if key not in self.backend_latency:
+                self.backend_latency[key] = LatencyHistogram()
+            self.backend_latency[key].record(duration)
         if not self.latency[(component_name, 'min-latency')]:
             self.latency[(component_name, 'min-latency')] = duration
         if duration < self.latency[(component_name, 'min-latency')]:
@@ -286,6 +520,37 @@ class TrackConnection(Connection):
             self.metric_data.append(
                 dict(metric=AVG_LATENCY, value=avg_latency,
                      dimensions=dimensions, timestamp=timestamp()))
+        self.backend_latency_write_log()
+        self.percentile_write_log()
+
+    def backend_latency_write_log(self):
+        """
+        Report the median latency of each proxy and, for each component,
+        the proxy with the highest median latency.
+        """
+        slowest = dict()
+        for (component_name, backend), histogram in sorted(
+                self.backend_latency.items()):
+            median = histogram.percentile(50)
+            dimensions = common_dimensions.copy()
+            dimensions['component'] = component_name
+            dimensions['backend'] = backend
+            dimensions['url'] = self.object_store_url
+            dimensions['hostname'] = '_'
+            self.metric_data.append(
+                dict(metric=BACKEND_LATENCY, value=median,
+                     dimensions=dimensions, timestamp=timestamp()))
+            if median > slowest.get(component_name, (None, -1))[1]:
+                slowest[component_name] = (backend, median)
+        for component_name, (backend, median) in sorted(slowest.items()):
+            dimensions = common_dimensions.copy()
+            dimensions['component'] = component_name
+            dimensions['backend'] = backend
+            dimensions['url'] = self.object_store_url
+            dimensions['hostname'] = '_'
+            self.metric_data.append(
+                dict(metric=SLOWEST_BACKEND, value=median,
+                     dimensions=dimensions, timestamp=timestamp()))
 
     def record_state(self, component_name, new_state, reason):
         self.logger.debug(" ++++++++++++++ record_state called %s %s %s" %
@@ -365,18 +630,24 @@ class TrackConnection(Connection):
             try:
                 self.logger.debug('Doing GET AUTH')
                 start_time = time.time()
-                self.url, token = self.get_auth()
+                url, token = self.get_auth()
                 duration = time.time() - start_time
-                self.latency_record(component, duration)
+                expires = self.get_token_expiry(token)
+                with self.probe_lock:
+                    self.latency_record(component, duration)
+                    self.url, self.token = url, token
+                    self.token_issued = start_time
+                    self.token_expires = expires or \
+                        start_time + self.token_lifetime
                 self.logger.debug('SUCCESS; token: %s    in %s'
-                                  % (self.token, duration))
-                self.token = token
+                                  % (token, duration))
                 component_state = component_states.ok
                 reason = 'success'
             except (socket.error, HTTPException, ClientException,
                     ConnectionError) as err:
                 duration = time.time() - start_time
-                self.latency_record(component, duration)
+                with self.probe_lock:
+                    self.latency_record(component, duration)
                 self.record_state(component, component_states.fail, err)
                 component_state = component_states.fail
                 reason = err
@@ -389,111 +660,410 @@ class TrackConnection(Connection):
         self.record_state(component, component_state, reason)
         return component_state
 
-    def check_object_store(self):
+    def get_token_expiry(self, token):
+        """
+        Ask keystone when a token expires. Only the v3 API lets a user
+        validate their own token; for v2, or if keystone does not answer,
+        the token is assumed to last token_lifetime.
+
+        :returns: the time the token expires, or None if not known
+        """
+        if str(self.auth_version) not in ('3', '3.0'):
+            return None
+        url = self.authurl.rstrip('/')
+        if not url.endswith('/v3'):
+            url += '/v3'
+        try:
+            resp = requests.get(url + '/auth/tokens',
+                                headers={'X-Auth-Token': token,
+                                         'X-Subject-Token': token},
+                                timeout=PROBE_TIMEOUT,
+                                verify=self.cacert or not self.insecure)
+            if resp.status_code != 200:
+                return None
+            # e.g. 2017-06-01T12:00:00.000000Z
+            expires_at = resp.json()['token']['expires_at']
+            return calendar.timegm(time.strptime(expires_at[:19],
+                                                 '%Y-%m-%dT%H:%M:%S'))
+        except (requests.RequestException, ValueError, KeyError,
+                TypeError) as err:
+            self.logger.debug('Cannot get token expiry: %s' % err)
+            return None
+
+    def token_refresh_due(self, now):
+        """
+        :returns: True if there is no token or it is close to expiring
+        """
+        lifetime = self.token_lifetime
+        if self.token_issued < self.token_expires:
+            lifetime = min(lifetime, self.token_expires - self.token_issued)
+        return (not self.token or now >= self.token_expires -
+                lifetime * TOKEN_REFRESH_FRACTION)
+
+    def token_expired(self, now):
+        """
+        :returns: True if there is no token, or it has expired or been
+                  rejected, so probes must wait for a new one
+        """
+        return not self.token or now >= self.token_expires
+
+    def start_keystone_check(self):
+        """
+        Run check_keystone_get_token in the background, unless a check is
+        still running, so that a slow keystone does not hold up the
+        probes; they use the cached token meanwhile.
+        """
+        with self.keystone_lock:
+            if self.keystone_thread and self.keystone_thread.is_alive():
+                self.logger.debug('Previous keystone check still running')
+                return
+            self.keystone_thread = threading.Thread(
+                target=self.check_keystone_get_token)
+            self.keystone_thread.daemon = True
+            self.keystone_thread.start()
+
+    def token_rejected(self, token, deadline):
+        """
+        A probe got a 401 using token. Unless another probe has already
+        replaced it, get a new token, waiting at most until deadline.
+        """
+        with self.probe_lock:
+            if self.token == token:
+                self.token_expires = 0
+                refresh = True
+            else:
+                refresh = False
+        if refresh:
+            self.start_keystone_check()
+        self.wait_keystone_check(deadline)
+
+    def wait_keystone_check(self, deadline):
+        """Wait, at most until deadline, for a keystone check to finish"""
+        if self.keystone_thread:
+            self.keystone_thread.join(max(0.0, deadline - time.time()))
+
+    def probe_timeout(self, deadline):
+        """Socket timeout for a probe: at most 30s and not past deadline"""
+        return max(0.1, min(PROBE_TIMEOUT, deadline - time.time()))
+
+    def probe_object_store(self, deadline):
+        """
+        PUT, GET and DELETE a small object, on a connection of its own so
+        that the load balancer can send each probe to a different proxy.
+
+        :param deadline: time by which the probe must have finished
+        :returns: ProbeResult; operations holds the time taken by each of
+                  OPERATIONS that succeeded
+        """
         # If no token then cannot perform request
         if not self.token:
-            self.record_state(COMPONENT_REST_API, component_states.fail,
-                              'Authentication failed')
-            return
+            return ProbeResult(component_states.fail, 'Authentication failed',
+                               None, None, {})
 
         retries = 3
         attempts = 0
         tinyobj_contents = str(uuid.uuid4())  # Create random contents
-        randint = random.randint(0, 500)
-        tinyobj_name = 'tinyobj-' + str(randint) + '-' + socket.gethostname()
-        component_state = component_states.ok
-        reason = 'success'
+        # Unique to this probe, as others run at the same time
+        tinyobj_name = 'tinyobj-%s-%s' % (uuid.uuid4().hex,
+                                          socket.gethostname())
 
-        while attempts <= retries:
+        while True:
             obj_start_time = time.time()
             start_time = obj_start_time
+            operations = dict()
+            token = self.token
+
+            def timed(operation):
+                duration = time.time() - start_time
+                operations[operation] = duration
+                self.logger.debug('%s ok in %s' % (operation, duration))
+                return time.time()
+
             try:
-                self.http_conn = None  # Force new connection
+                conn = Connection(preauthurl=self.url,
+                                  preauthtoken=token, retries=0,
+                                  timeout=self.probe_timeout(deadline))
                 self.logger.debug('Doing OBJECT PUT/GET/DELETE')
-                obj_start_time = time.time()
-                start_time = obj_start_time
-                self.head_account()
-                duration = time.time() - start_time
-                self.logger.debug('head-account ok in %s' % duration)
-                start_time = time.time()
-                self.put_container('swift_monitor_latency_test')
-                duration = time.time() - start_time
-                self.logger.debug('put-container ok in %s' % duration)
-                start_time = time.time()
-                self.put_object('swift_monitor_latency_test', tinyobj_name,
+                conn.head_account()
+                start_time = timed('head-account')
+                conn.put_container(TEST_CONTAINER)
+                start_time = timed('put-container')
+                conn.put_object(TEST_CONTAINER, tinyobj_name,
                                 tinyobj_contents)
-                duration = time.time() - start_time
-                self.logger.debug('put-object ok in %s' % duration)
-                start_time = time.time()
-                headers, body = self.get_object('swift_monitor_latency_test',
-                                                tinyobj_name,
+                start_time = timed('put-object')
+                headers, body = conn.get_object(TEST_CONTAINER, tinyobj_name,
                                                 resp_chunk_size=65536)
                 chunks = []
                 for chunk in body:
                     self.logger.debug('get-object chunk: %s' % chunk)
                     chunks.append(chunk)
-                duration = time.time() - start_time
-                self.logger.debug('get-object ok in %s' % duration)
-                start_time = time.time()
-                self.delete_object('swift_monitor_latency_test', tinyobj_name)
-                duration = time.time() - start_time
-                self.logger.debug('delete-object ok in %s' % duration)
-                duration = time.time() - obj_start_time
-                self.latency_record(COMPONENT_REST_API, duration)
-                component_state = component_states.ok
-                reason = 'success'
+                start_time = timed('get-object')
+                conn.delete_object(TEST_CONTAINER, tinyobj_name)
+                start_time = timed('delete-object')
+                return ProbeResult(component_states.ok, 'success',
+                                   time.time() - obj_start_time,
+                                   backend_name(headers, self.proxy_header),
+                                   operations)
             except (socket.error, HTTPException, ClientException,
                     ConnectionError) as err:
                 duration = time.time() - start_time
-                self.latency_record(COMPONENT_REST_API, duration)
-                self.record_state(COMPONENT_REST_API,
-                                  component_states.fail, err)
-                component_state = component_states.fail
-                reason = err
-            if component_state == component_states.fail:
-                time.sleep(1)
                 attempts += 1
-            else:
-                attempts = retries + 1  # break out of loop
-
-        self.record_state(COMPONENT_REST_API, component_state, reason)
-        return component_state
-
-    def check_object_store_health_check(self, logger):
-
-        component = COMPONENT_HEALTHCHECK_API
+                if getattr(err, 'http_status', None) == 401:
+                    # The cached token is no good: get a new one and retry
+                    # with it, if there is time
+                    self.token_rejected(token, deadline - 1)
+                    if self.token == token:
+                        attempts = retries + 1  # no point retrying
+                # Only retry if there is time to do so before the deadline
+                if attempts > retries or time.time() + 1 >= deadline:
+                    headers = getattr(err, 'http_response_headers', None)
+                    return ProbeResult(component_states.fail, err, duration,
+                                       backend_name(headers,
+                                                    self.proxy_header),
+                                       operations)
+                self.logger.debug('rest-api attempt failed: %s' % err)
+            time.sleep(1)
+
+    def probe_health_check(self, deadline):
+        """
+        GET /healthcheck on a new connection.
+
+        :param deadline: time by which the probe must have finished
+        :returns: ProbeResult
+        """
         retries = 3
         attempts = 0
-        component_state = component_states.ok
-        reason = 'success'
+        url = self.object_store_url
+        backend = None
+        if self.health_check_urls:
+            with self.probe_lock:
+                backend, url = next(self.health_check_urls)
 
-        while attempts <= retries:
+        while True:
             start_time = time.time()
             try:
-                self.http_conn = None  # Force new connection
-                logger.debug('Doing GET /healthcheck')
-                start_time = time.time()
-                health_check(self.object_store_url, self.logger)
+                self.logger.debug('Doing GET /healthcheck')
+                headers = health_check(url, self.logger,
+                                       timeout=self.probe_timeout(deadline))
                 duration = time.time() - start_time
-                self.latency_record(component, duration)
-                logger.debug('Ok in %s' % duration)
-                component_state = component_states.ok
-                reason = 'success'
+                self.logger.debug('Ok in %s' % duration)
+                return ProbeResult(
+                    component_states.ok, 'success', duration,
+                    backend or backend_name(headers, self.proxy_header), {})
             except (socket.error, HTTPException, ClientException,
                     RequestException, ConnectionError) as err:
                 duration = time.time() - start_time
-                self.latency_record(component, duration)
-                self.record_state(component, component_states.fail, err)
-                component_state = component_states.fail
-                reason = err
-            if component_state == component_states.fail:
-                time.sleep(1)
                 attempts += 1
+                if attempts > retries or time.time() + 1 >= deadline:
+                    return ProbeResult(component_states.fail, err, duration,
+                                       backend, {})
+                self.logger.debug('healthcheck-api attempt failed: %s' % err)
+            time.sleep(1)
+
+    def run_probes(self, probes, count, parallelism, deadline):
+        """
+        Run count probes of each component, at most parallelism at a time.
+
+        Once a probe of a component fails no more probes of that
+        component are started. Probes still running at the deadline are
+        abandoned and count as failures, so a cycle never runs past its
+        deadline however slow the proxies are.
+
+        :param probes: dictionary of component name to a probe function
+                       returning a ProbeResult, e.g. probe_object_store
+        :param count: number of probes of each component
+        :param parallelism: number of probes to run at once
+        :param deadline: time by which the probes must have finished
+        :returns: dictionary of component name to component state
+        """
+        jobs = [(component, n) for n in range(count)
+                for component in sorted(probes)]
+        workers = min(max(1, parallelism), len(jobs))
+        outcomes = dict((component, []) for component in probes)
+        running = [None] * workers
+        lock = self.probe_lock
+        self.cycle += 1
+        cycle = self.cycle
+
+        def worker(w):
+            for component, _ in jobs[w::workers]:
+                if time.time() >= deadline:
+                    break
+                with lock:
+                    if any(state == component_states.fail
+                           for state, _ in outcomes[component]):
+                        continue
+                running[w] = component
+                result = probes[component](deadline)
+                with lock:
+                    # A probe abandoned at the deadline of an earlier
+                    # cycle must not count in this one
+                    if cycle != self.cycle:
+                        return
+                    running[w] = None
+                    if result.duration is not None:
+                        self.latency_record(component, result.duration,
+                                            result.backend)
+                    for operation, duration in result.operations.items():
+                        self.histogram_record(operation, duration)
+                    outcomes[component].append((result.state, result.reason))
+
+        results = run_in_threads(worker, range(workers),
+                                 max(0.0, deadline - time.time()))
+        with lock:
+            self.cycle += 1
+            for result in results:
+                if result.error is not None and running[result.item]:
+                    outcomes[running[result.item]].append(
+                        (component_states.fail,
+                         'probe failed: %s' % result.error))
+                elif not result.done and running[result.item]:
+                    outcomes[running[result.item]].append(
+                        (component_states.fail,
+                         'probe did not complete before the cycle deadline'))
+
+        states = dict()
+        for component in sorted(probes):
+            failures = [reason for state, reason in outcomes[component]
+                        if state != component_states.ok]
+            if failures:
+                state, reason = component_states.fail, failures[0]
+            elif not outcomes[component]:
+                state, reason = (component_states.fail,
+                                 'no probe started before the cycle deadline')
             else:
-                attempts = retries + 1  # break out of loop
+                state, reason = component_states.ok, 'success'
+            self.record_state(component, state, reason)
+            states[component] = state
+        return states
+
+    def probe_object_profile(self, profile, deadline):
+        """
+        PUT, GET and DELETE an object of an ObjectProfile.
+
+        :param profile: ObjectProfile
+        :param deadline: time by which the probe must have finished
+        :returns: dictionary of time to first byte of the GET, and PUT and
+                  GET throughput in bytes per second, or None on failure
+        """
+        if not self.token:
+            return None
+        # Unique to this run: a run abandoned at an earlier deadline may
+        # still be cleaning up its own object and segments
+        name = 'profile-%s-%s-%s' % (profile.name, uuid.uuid4().hex,
+                                     socket.gethostname())
+        segments = []
+        conn = Connection(preauthurl=self.url, preauthtoken=self.token,
+                          retries=0, timeout=self.probe_timeout(deadline))
+        try:
+            start_time = time.time()
+            conn.put_container(TEST_CONTAINER)
+            if profile.segment_size:
+                conn.put_container(SEGMENT_CONTAINER)
+                manifest = []
+                for offset in range(0, profile.size, profile.segment_size):
+                    size = min(profile.segment_size, profile.size - offset)
+                    segment = '%s/%012d' % (name, offset)
+                    segments.append(segment)
+                    etag = conn.put_object(SEGMENT_CONTAINER, segment,
+                                           PatternReader(size),
+                                           content_length=size)
+                    manifest.append({'path': '/%s/%s' % (SEGMENT_CONTAINER,
+                                                         segment),
+                                     'etag': etag, 'size_bytes': size})
+                if profile.manifest == 'dlo':
+                    conn.put_object(TEST_CONTAINER, name, '', headers={
+                        'X-Object-Manifest': '%s/%s/' % (SEGMENT_CONTAINER,
+                                                         name)})
+                else:
+                    conn.put_object(TEST_CONTAINER, name,
+                                    json.dumps(manifest),
+                                    query_string='multipart-manifest=put')
+            else:
+                conn.put_object(TEST_CONTAINER, name,
+                                PatternReader(profile.size),
+                                content_length=profile.size)
+            put_time = time.time() - start_time
 
-        self.record_state(component, component_state, reason)
-        return component_state
+            start_time = time.time()
+            headers, body = conn.get_object(TEST_CONTAINER, name,
+                                            resp_chunk_size=PATTERN_SIZE)
+            ttfb = None
+            received = 0
+            for chunk in body:
+                if ttfb is None:
+                    ttfb = time.time() - start_time
+                received += len(chunk)
+            get_time = time.time() - start_time
+            if received != profile.size:
+                raise ClientException('GET of %s returned %d of %d bytes'
+                                      % (name, received, profile.size))
+        except (socket.error, HTTPException, ClientException,
+                ConnectionError) as err:
+            self.logger.warning('Object profile %s failed: %s'
+                                % (profile.name, err))
+            return None
+        finally:
+            # A plain DELETE of a manifest leaves its segments alone
+            for container, obj in ([(TEST_CONTAINER, name)] +
+                                   [(SEGMENT_CONTAINER, segment)
+                                    for segment in segments]):
+                try:
+                    conn.delete_object(container, obj)
+                except (socket.error, HTTPException, ClientException,
+                        ConnectionError):
+                    pass
+        return {'ttfb': ttfb or get_time,
+                'put_bytes_per_sec': profile.size / max(put_time, 1e-6),
+                'get_bytes_per_sec': profile.size / max(get_time, 1e-6)}
+
+    def run_object_profiles(self, profiles, deadline):
+        """
+        Run a probe of each ObjectProfile, all at once, and report the
+        time to first byte and throughput of those that finish by the
+        deadline.
+        """
+        results = run_in_threads(
+            lambda profile: self.probe_object_profile(profile, deadline),
+            profiles, max(0.0, deadline - time.time()))
+        for result in results:
+            if not result.done:
+                self.logger.warning('Object profile %s did not complete'
+                                    ' before the cycle deadline'
+                                    % result.item.name)
+                continue
+            if result.error is not None:
+                self.logger.warning('Object profile %s failed: %s'
+                                    % (result.item.name, result.error))
+                continue
+            if result.value is None:
+                continue
+            dimensions = common_dimensions.copy()
+            dimensions['component'] = COMPONENT_REST_API
+            dimensions['profile'] = result.item.name
+            dimensions['url'] = self.object_store_url
+            dimensions['hostname'] = '_'
+            for metric, key in ((OBJECT_TTFB, 'ttfb'),
+                                (OBJECT_PUT_RATE, 'put_bytes_per_sec'),
+                                (OBJECT_GET_RATE, 'get_bytes_per_sec')):
+                self.metric_data.append(
+                    dict(metric=metric, value=result.value[key],
+                         dimensions=dimensions, timestamp=timestamp()))
+
+    def check_object_store(self, count=1, parallelism=1, deadline=None):
+        if deadline is None:
+            deadline = time.time() + PROBE_TIMEOUT
+        return self.run_probes({COMPONENT_REST_API: self.probe_object_store},
+                               count, parallelism,
+                               deadline)[COMPONENT_REST_API]
+
+    def check_object_store_health_check(self, logger, count=1,
+                                        parallelism=1, deadline=None):
+        if deadline is None:
+            deadline = time.time() + PROBE_TIMEOUT
+        return self.run_probes(
+            {COMPONENT_HEALTHCHECK_API: self.probe_health_check},
+            count, parallelism, deadline)[COMPONENT_HEALTHCHECK_API]
 
 
 def main_loop(parsed_arguments, logger):
@@ -528,7 +1098,10 @@ def main_loop(parsed_arguments, logger):
                            auth_version=parsed_arguments['auth_version'],
                            os_options=os_options,
                            latency_log_interval=parsed_arguments[
-                               'latencyLogInterval'])
+                               'latencyLogInterval'],
+                           proxy_header=parsed_arguments['proxy_header'],
+                           proxy_hosts=parsed_arguments['proxy_hosts'],
+                           token_lifetime=parsed_arguments['token_lifetime'])
 
     common_dimensions['observer_host'] = socket.gethostname()
     common_dimensions['service'] = SERVICE_NAME
@@ -540,25 +1113,38 @@ def main_loop(parsed_arguments, logger):
     time.sleep(sleep_interval(parsed_arguments['main_loop_interval'],
                               conn.loop_end_time, WAKE_UP_SECOND))
     conn.loop_end_time = time.time()
+    cycle_number = 0
 
     while True:
+        # However slow the proxies are the metrics are written by deadline
+        deadline = time.time() + parsed_arguments['cycle_timeout']
         conn.latency_reset()
         conn.metric_data_reset()
+        probes = {COMPONENT_HEALTHCHECK_API: conn.probe_health_check}
         if conn.user != "None":
-            service_state = conn.check_keystone_get_token()
-        if conn.user != "None":
-            for proxy in range(0, parsed_arguments['objectChecksPerInterval']):
-                service_state = conn.check_object_store()
-                if service_state != component_states.ok:
-                    break
-        if service_state == component_states.ok:
+            # keystone is checked alongside the other probes, which use
+            # the cached token unless there is none yet, or it has expired
+            # or been rejected
+            if cycle_number % parsed_arguments['keystone_check_every'] == 0 \
+                    or conn.token_refresh_due(time.time()):
+                conn.start_keystone_check()
+            if conn.token_expired(time.time()):
+                conn.wait_keystone_check(deadline)
+            probes[COMPONENT_REST_API] = conn.probe_object_store
+        states = conn.run_probes(probes,
+                                 parsed_arguments['objectChecksPerInterval'],
+                                 parsed_arguments['probe_concurrency'],
+                                 deadline)
+        if states.get(COMPONENT_REST_API) == component_states.ok:
             conn.uptime_record(SWIFT_UP)
         else:
             conn.uptime_record(SWIFT_DOWN)
-        for proxy in range(0, parsed_arguments['objectChecksPerInterval']):
-            service_state = conn.check_object_store_health_check(logger)
-            if service_state != component_states.ok:
-                break
+        profiles = [profile for profile in parsed_arguments['object_profiles']
+                    if cycle_number % profile.every == 0]
+        if profiles and conn.user != "None":
+            conn.run_object_profiles(profiles, deadline)
+        cycle_number += 1
+        conn.wait_keystone_check(deadline)
         conn.latency_write_log()
         conn.emit_avail_metrics()
         conn.dump_metric_data()
@@ -577,8 +1163,14 @@ This program performs a set of operations as follows
 at each cycle:
 
 1/ Gets a token from the Keystone service (keystone-get-token)
+   This runs in the background, alongside the other operations, and
+   the token is cached until shortly before it expires (with auth_version
+   3 keystone says when that is; otherwise see token_lifetime below).
+   The Keystone service is checked every keystone_check_every cycles and
+   whenever the token needs refreshing. If the token has expired, or
+   Swift rejects it, the other operations wait for a new one.
 2/ Performs a number of HEAD operations against the account using
-   this token and the Swift URL/account (rest-api)
+   the cached token and the Swift URL/account (rest-api)
    If we cannot get a token from the keystone service, we continue
    to use the existing token. If this becomes invalid, the
    rest-api is marked failed.
@@ -588,7 +1180,10 @@ at each cycle:
 For rest-api and healthcheck-api operations, they are repeated
 many times each cycle. The idea is to make the load balancers
 round robin us through all the proxies. See checks_per_interval
-below.
+below. The operations are run concurrently, each on a new connection
+(see probe_concurrency below). Operations that have not completed by
+the cycle deadline (see cycle_timeout below) are counted as failures
+so that the availability data is written on time even in an outage.
 
 Writes to syslog LOG_LOCAL0 facility as follows:
 - A record of each transition from ok to failure and vice vera
@@ -624,6 +1219,22 @@ Writes to syslog LOG_LOCAL0 facility as follows:
   We measure latency of keystone-get-token, rest-api and healthcheck-api
   components.
 
+- The median latency of each proxy server, and the proxy with the
+  highest median latency, are reported for the rest-api and
+  healthcheck-api components. A proxy is identified by the suffix of
+  the X-Trans-Id it returns (so give each proxy a distinct
+  trans_id_suffix), or by a header named by proxy_header (e.g. one
+  added by the load balancer), or by its address if proxy_hosts is set.
+
+- The 95th and 99th percentile latencies of each component, and of each
+  operation of the rest-api component (head-account, put-container,
+  put-object, get-object and delete-object), over the last one to two
+  hours. The histograms they are taken from are saved in the directory
+  of cache_file_path so they survive a restart.
+
+- For each object profile (see below), the time to the first byte of
+  the GET, and the PUT and GET throughput in bytes per second.
+
 FILES
 
 The configuration file is specifed using the -c/--config option. This files
@@ -642,6 +1253,28 @@ looks something like:
     # than number of proxy servers
     checks_per_interval:70
 
+    # Number of operations run at once
+    probe_concurrency:10
+
+    # Seconds from the start of a cycle by which all its operations must
+    # have completed. Defaults to three quarters of the interval
+    cycle_timeout:45
+
+    # Lifetime of a keystone token in seconds, used when keystone does not
+    # say when the token expires; the token is refreshed when a quarter of
+    # its lifetime is left
+    token_lifetime:3600
+
+    # Check the keystone service every this many cycles
+    keystone_check_every:1
+
+    # Optional header that identifies the proxy that served a request
+    proxy_header: X-Backend-Server
+
+    # Optional list of proxy host:port. If set, healthcheck-api
+    # operations go to each proxy in turn instead of the object_store_url
+    proxy_hosts: 192.168.1.10:8080, 192.168.1.11:8080
+
     #The file path where the uptime stats are written
     cache_file_path: /var/cache/swift/swiftlm_uptime_monitor/uptime.stats
 
@@ -663,6 +1296,20 @@ looks something like:
     project-id: 12345678912345
     project_name: myproject
     auth_version:2 # if not specified defaults to 2
+
+    # Optional object profiles, each PUT, GET and DELETE an object of the
+    # given size every few cycles, to measure the bulk data path. With
+    # segment_size, the object is uploaded in segments under an SLO (or
+    # with manifest: dlo, a DLO) manifest.
+    [object_profile:1MiB]
+    size: 1MiB
+    every: 5
+
+    [object_profile:64MiB-slo]
+    size: 64MiB
+    segment_size: 8MiB
+    manifest: slo
+    every: 60
 """
 
 
@@ -721,6 +1368,39 @@ def validate_args(config):
             config.get('latency_monitor', 'checks_per_interval'))
     except ConfigParser.NoOptionError:
         parsed_arguments['objectChecksPerInterval'] = 40
+    try:
+        parsed_arguments['probe_concurrency'] = int(
+            config.get('latency_monitor', 'probe_concurrency'))
+    except ConfigParser.NoOptionError:
+        parsed_arguments['probe_concurrency'] = PROBE_CONCURRENCY
+    try:
+        parsed_arguments['cycle_timeout'] = float(
+            config.get('latency_monitor', 'cycle_timeout'))
+    except ConfigParser.NoOptionError:
+        parsed_arguments['cycle_timeout'] = \
+            0.75 * parsed_arguments['main_loop_interval']
+    try:
+        parsed_arguments['token_lifetime'] = int(
+            config.get('latency_monitor', 'token_lifetime'))
+    except ConfigParser.NoOptionError:
+        parsed_arguments['token_lifetime'] = TOKEN_LIFETIME
+    try:
+        parsed_arguments['keystone_check_every'] = max(1, int(
+            config.get('latency_monitor', 'keystone_check_every')))
+    except ConfigParser.NoOptionError:
+        parsed_arguments['keystone_check_every'] = 1
+    try:
+        parsed_arguments['proxy_header'] = config.get('latency_monitor',
+                                                      'proxy_header')
+    except ConfigParser.NoOptionError:
+        parsed_arguments['proxy_header'] = None
+    try:
+        parsed_arguments['proxy_hosts'] = [
+            host.strip() for host in config.get('latency_monitor',
+                                                'proxy_hosts').split(',')
+            if host.strip()]
+    except ConfigParser.NoOptionError:
+        parsed_arguments['proxy_hosts'] = []
     try:
         parsed_arguments['latencyLogInterval'] = int(
             config.get('latency_monitor', 'latency_log_interval'))
@@ -796,9 +1476,44 @@ def validate_args(config):
         logger.exception(message)
         raise UPtimeMonException(message)
 
+    parsed_arguments['object_profiles'] = get_object_profiles(config, logger)
+
     return parsed_arguments, logger
 
 
+def get_object_profiles(config, logger):
+    """
+    Read the [object_profile:<name>] sections of the config file.
+
+    :returns: list of ObjectProfile
+    :raises UPtimeMonException: if a profile is invalid
+    """
+    profiles = []
+    for section in sorted(config.sections()):
+        if not section.startswith(OBJECT_PROFILE_SECTION):
+            continue
+        name = section[len(OBJECT_PROFILE_SECTION):]
+        options = dict(config.items(section))
+        try:
+            size = parse_size(options['size'])
+            segment_size = None
+            if options.get('segment_size'):
+                segment_size = parse_size(options['segment_size'])
+            manifest = options.get('manifest', 'slo').lower()
+            every = int(options.get('every', 1))
+            if not name or not size or segment_size == 0 or every < 1 or \
+                    manifest not in ('slo', 'dlo'):
+                raise ValueError('Invalid option')
+        except (KeyError, ValueError) as err:
+            msg = ("Invalid object profile %s (%s), Quitting swift uptime mon"
+                   % (section, err))
+            logger.exception(msg)
+            raise UPtimeMonException(msg)
+        profiles.append(ObjectProfile(name, size, segment_size, manifest,
+                                      every))
+    return profiles
+
+
 def main():
     args = parse_args(sys.argv[1:])
 
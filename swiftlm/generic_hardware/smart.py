@@ -0,0 +1,406 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Drive health from SMART (SATA and SAS drives) and the NVMe health log.
+
+Drives are found in sysfs. NVMe drives are read with the admin passthrough
+ioctl and SATA drives with HDIO_DRIVE_CMD, so no process is forked for
+them. smartctl is only run for drives that cannot be read that way, such
+as SAS drives or SATA drives behind a SAS HBA. Each drive is read in its
+own thread.
+
+Readings are kept in SWIFTLM_STATE_DIR and reused for READING_TTL seconds.
+A drive that could not be read is not tried again until READING_TTL has
+passed either, so an unreadable drive does not fork smartctl every run.
+When a drive is read again, the growth of its error counters since the
+previous reading is reported as a rate per day, so that a drive that is
+getting worse can be alerted on before its counts look alarming.
+"""
+
+import array
+import ctypes
+import fcntl
+import json
+import os
+import re
+import struct
+import time
+from collections import namedtuple
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+from swiftlm import CONFIG_FILE
+from swiftlm.utils.metricdata import MetricData
+from swiftlm.utils.utility import run_cmd, run_in_threads
+from swiftlm.utils.utility import load_state, save_state
+
+SYS_BLOCK = '/sys/block'
+DEV = '/dev'
+SMARTCTL = 'smartctl'
+SMART_STATE = 'smart_health.json'
+READING_TTL = 300
+DRIVE_TIMEOUT = 30
+SECONDS_PER_DAY = 86400.0
+
+DRIVE_NAME = re.compile(r'^(sd[a-z]+|nvme\d+n\d+)$')
+
+# HDIO_DRIVE_CMD takes the command, sector number, feature and sector
+# count registers followed by room for the returned sectors
+HDIO_DRIVE_CMD = 0x031f
+ATA_SMART_CMD = 0xb0
+ATA_SMART_READ_VALUES = 0xd0
+ATA_SECTOR_SIZE = 512
+
+ATA_REALLOCATED_SECTORS = 5
+ATA_REPORTED_UNCORRECTABLE = 187
+ATA_TEMPERATURE = (194, 190)
+ATA_PENDING_SECTORS = 197
+# Normalised values of these count down from 100 as an SSD wears
+ATA_WEAR = (177, 231, 233, 202)
+
+# struct nvme_admin_cmd from linux/nvme_ioctl.h
+NVME_ADMIN_CMD = struct.Struct('<BBHIIIQQIIIIIIIIII')
+NVME_IOCTL_ADMIN_CMD = 0xc0484e41
+NVME_ADMIN_GET_LOG_PAGE = 0x02
+NVME_LOG_HEALTH = 0x02
+NVME_HEALTH_LOG_SIZE = 512
+NVME_NSID_ALL = 0xffffffff
+
+# smartctl exit status bits meaning the drive could not be read at all
+SMARTCTL_FATAL = 0x03
+
+COUNTERS = ('reallocated_sectors', 'pending_sectors', 'media_errors')
+READING_METRICS = COUNTERS + ('temperature', 'wear_level')
+
+Drive = namedtuple('Drive', ['name', 'transport', 'drive_id'])
+
+BASE_RESULT = MetricData(
+    name=__name__,
+    messages={}
+)
+
+
+def read_sysfs(*path):
+    try:
+        with open(os.path.join(*path)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_drives(sys_block=None):
+    """
+    Find the SATA, SAS and NVMe drives.
+
+    :returns: list of Drive. transport is one of 'ata', 'scsi' or 'nvme'.
+              drive_id identifies the drive itself (rather than the slot)
+              where sysfs reports it, or is None.
+    """
+    sys_block = sys_block or SYS_BLOCK
+    drives = []
+    for name in sorted(os.listdir(sys_block)):
+        if not DRIVE_NAME.match(name):
+            continue
+        path = os.path.join(sys_block, name)
+        if read_sysfs(path, 'removable') == '1':
+            continue
+        if name.startswith('nvme'):
+            transport = 'nvme'
+            drive_id = (read_sysfs(path, 'wwid') or
+                        read_sysfs(path, 'device', 'serial'))
+        else:
+            if read_sysfs(path, 'device', 'vendor') == 'ATA':
+                transport = 'ata'
+            else:
+                transport = 'scsi'
+            drive_id = read_sysfs(path, 'device', 'wwid')
+        drives.append(Drive(name, transport, drive_id))
+    return drives
+
+
+def parse_ata_smart(data):
+    """
+    Parse the response to SMART READ DATA.
+
+    :param data: the 512 byte data structure
+    :returns: dictionary of attribute id to (normalised value, raw value)
+    """
+    attributes = {}
+    # 30 attributes of 12 bytes after the 2 byte revision number
+    for offset in range(2, 2 + 30 * 12, 12):
+        attr_id, _, value, _, raw_low, raw_high = struct.unpack_from(
+            '<BHBBIH', data, offset)
+        if attr_id:
+            attributes[attr_id] = (value, raw_low | raw_high << 32)
+    return attributes
+
+
+def ata_reading(attributes):
+    """
+    :param attributes: dictionary of attribute id to (normalised value,
+                       raw value)
+    :returns: dictionary of READING_METRICS
+    """
+    reading = {}
+    for key, attr_id in (('reallocated_sectors', ATA_REALLOCATED_SECTORS),
+                         ('pending_sectors', ATA_PENDING_SECTORS),
+                         ('media_errors', ATA_REPORTED_UNCORRECTABLE)):
+        if attr_id in attributes:
+            reading[key] = attributes[attr_id][1]
+    for attr_id in ATA_TEMPERATURE:
+        if attr_id in attributes:
+            # The upper bytes hold the min/max on some drives
+            reading['temperature'] = attributes[attr_id][1] & 0xff
+            break
+    for attr_id in ATA_WEAR:
+        if attr_id in attributes:
+            reading['wear_level'] = max(0, 100 - attributes[attr_id][0])
+            break
+    return reading
+
+
+def read_ata_smart(path):
+    """
+    Read the SMART attributes of a SATA drive with HDIO_DRIVE_CMD.
+
+    :raises IOError, OSError: if the drive does not support it
+    """
+    buf = array.array('B', [ATA_SMART_CMD, 0, ATA_SMART_READ_VALUES, 1] +
+                      [0] * ATA_SECTOR_SIZE)
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, HDIO_DRIVE_CMD, buf, True)
+    finally:
+        os.close(fd)
+    return ata_reading(parse_ata_smart(bytes(bytearray(buf[4:]))))
+
+
+def parse_nvme_health(data):
+    """
+    Parse the NVMe SMART / Health Information log page.
+
+    :param data: the 512 byte log page
+    :returns: dictionary of READING_METRICS
+    """
+    _, temperature, _, _, used = struct.unpack_from('<BHBBB', data, 0)
+    media_low, media_high = struct.unpack_from('<QQ', data, 160)
+    reading = {'wear_level': used,
+               'media_errors': media_low | media_high << 64}
+    if temperature:
+        # Kelvin
+        reading['temperature'] = temperature - 273
+    return reading
+
+
+def read_nvme_health(path):
+    """
+    Read the health log of an NVMe drive with the admin passthrough ioctl.
+
+    :raises IOError, OSError: if the log cannot be read
+    """
+    log = ctypes.create_string_buffer(NVME_HEALTH_LOG_SIZE)
+    cdw10 = (NVME_HEALTH_LOG_SIZE // 4 - 1) << 16 | NVME_LOG_HEALTH
+    cmd = array.array('B', NVME_ADMIN_CMD.pack(
+        NVME_ADMIN_GET_LOG_PAGE, 0, 0, NVME_NSID_ALL, 0, 0, 0,
+        ctypes.addressof(log), 0, NVME_HEALTH_LOG_SIZE, cdw10,
+        0, 0, 0, 0, 0, 0, 0))
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd, True)
+    finally:
+        os.close(fd)
+    return parse_nvme_health(log.raw)
+
+
+def smartctl_reading(j):
+    """
+    :param j: the output of smartctl --json -A
+    :returns: dictionary of READING_METRICS, or None if smartctl could not
+              read the drive
+    """
+    if j.get('smartctl', {}).get('exit_status', 0) & SMARTCTL_FATAL:
+        return None
+    reading = {}
+    if 'ata_smart_attributes' in j:
+        reading = ata_reading(dict(
+            (attr['id'], (attr.get('value', 0), attr['raw']['value']))
+            for attr in j['ata_smart_attributes'].get('table', [])))
+    elif 'nvme_smart_health_information_log' in j:
+        log = j['nvme_smart_health_information_log']
+        reading = {'media_errors': log.get('media_errors'),
+                   'wear_level': log.get('percentage_used')}
+    else:
+        reading = {
+            'reallocated_sectors': j.get('scsi_grown_defect_list'),
+            'wear_level': j.get(
+                'scsi_percentage_used_endurance_indicator')}
+        counters = j.get('scsi_error_counter_log')
+        if counters:
+            reading['media_errors'] = sum(
+                counters.get(op, {}).get('total_uncorrected_errors', 0)
+                for op in ('read', 'write', 'verify'))
+    temperature = j.get('temperature', {}).get('current')
+    if temperature is not None:
+        reading['temperature'] = temperature
+    reading = dict((k, v) for k, v in reading.items() if v is not None)
+    return reading or None
+
+
+def smartctl_installed(path=None):
+    """
+    :returns: True if SMARTCTL is an executable in one of the directories
+              of path (by default $PATH)
+    """
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    return any(os.access(os.path.join(directory, SMARTCTL), os.X_OK)
+               for directory in path.split(os.pathsep) if directory)
+
+
+def read_smartctl(path):
+    rc = run_cmd('%s --json -A %s' % (SMARTCTL, path))
+    try:
+        return smartctl_reading(json.loads(rc.output))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def read_drive(drive, dev=None, smartctl=True):
+    """
+    Read the health of a drive, with an ioctl if possible and otherwise
+    with smartctl.
+
+    :param smartctl: False if smartctl is known not to be installed
+
+    :returns: dictionary of READING_METRICS, or None if the drive could
+              not be read
+    """
+    path = os.path.join(dev or DEV, drive.name)
+    reading = None
+    try:
+        if drive.transport == 'nvme':
+            reading = read_nvme_health(path)
+        elif drive.transport == 'ata':
+            reading = read_ata_smart(path)
+    except (IOError, OSError, struct.error):
+        reading = None
+    if not reading and smartctl:
+        reading = read_smartctl(path)
+    return reading
+
+
+def drive_entry(drive, reading, previous, now):
+    """
+    :param previous: the saved entry from the last time the drive was
+                     read, or None
+    :param reading: dictionary of READING_METRICS, or None if the drive
+                    could not be read
+    :returns: the entry to save for the drive, including the rate per day
+              at which each counter has grown since the previous reading.
+              If the drive could not be read, the entry keeps the last
+              good reading in last_good so that the next rate covers the
+              gap.
+    """
+    if previous and previous.get('drive_id') != drive.drive_id:
+        previous = None
+    if previous and not previous.get('reading'):
+        previous = previous.get('last_good')
+    if not reading:
+        return {'drive_id': drive.drive_id, 'time': now, 'reading': None,
+                'last_good': previous}
+    rates = {}
+    if (previous and previous.get('drive_id') == drive.drive_id and
+            now > previous.get('time', now)):
+        days = (now - previous['time']) / SECONDS_PER_DAY
+        for key in COUNTERS:
+            old = previous.get('reading', {}).get(key)
+            if key in reading and old is not None and reading[key] >= old:
+                rates[key] = (reading[key] - old) / days
+    return {'drive_id': drive.drive_id, 'time': now, 'reading': reading,
+            'rates': rates}
+
+
+def drive_results(drive, entry):
+    dimensions = {'component': 'physical_drive', 'device': drive.name}
+    results = []
+    for key in READING_METRICS:
+        if entry['reading'].get(key) is None:
+            continue
+        r = BASE_RESULT.child(name=key, dimensions=dimensions)
+        r.value = entry['reading'][key]
+        results.append(r)
+    for key in COUNTERS:
+        if key not in entry['rates']:
+            continue
+        r = BASE_RESULT.child(name=key + '_per_day', dimensions=dimensions)
+        r.value = round(entry['rates'][key], 3)
+        results.append(r)
+    return results
+
+
+def check_drives(ttl=READING_TTL, now=None):
+    """
+    Report the health of each drive, reading the drives whose saved
+    reading is older than ttl in parallel.
+    """
+    if now is None:
+        now = time.time()
+    state = load_state(SMART_STATE)
+    drives = get_drives()
+    new_state = {}
+    to_read = []
+    for drive in drives:
+        entry = state.get(drive.name)
+        if entry and entry.get('drive_id') != drive.drive_id:
+            # The drive has been replaced
+            entry = None
+        if entry and 0 <= now - entry.get('time', 0) < ttl:
+            new_state[drive.name] = entry
+        else:
+            to_read.append(drive)
+
+    # Look for smartctl once rather than failing to run it for each drive
+    smartctl = bool(to_read) and smartctl_installed()
+    for drive, _, reading, _ in run_in_threads(
+            lambda drive: read_drive(drive, smartctl=smartctl), to_read,
+            DRIVE_TIMEOUT):
+        # reading is None if the drive could not be read or did not
+        # respond within DRIVE_TIMEOUT; either way it is not read again
+        # until ttl has passed
+        new_state[drive.name] = drive_entry(drive, reading,
+                                            state.get(drive.name), now)
+
+    results = []
+    for drive in drives:
+        entry = new_state.get(drive.name)
+        if entry and entry.get('reading'):
+            results.extend(drive_results(drive, entry))
+    save_state(SMART_STATE, new_state)
+    return results
+
+
+def main():
+    """Check drive health with SMART and the NVMe health log"""
+    ttl = READING_TTL
+    cp = configparser.RawConfigParser()
+    try:
+        cp.read(CONFIG_FILE)
+        ttl = cp.getint('smart', 'cache_ttl')
+    except Exception:
+        pass
+    return check_drives(ttl=ttl)
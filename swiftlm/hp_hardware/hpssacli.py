@@ -19,6 +19,7 @@
 # Python library for running hpssacli commnads
 
 import re
+import time
 try:
     import configparser
 except ImportError:
@@ -26,11 +27,18 @@ except ImportError:
 from collections import OrderedDict
 from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.values import Severity
-from swiftlm.utils.utility import run_cmd
+from swiftlm.utils.utility import run_cmd, CommandResult
+from swiftlm.utils.utility import load_state, save_state
 from swiftlm import CONFIG_FILE
 
 
 LOCK_FILE_COMMAND = '/usr/bin/flock -w 10 /var/lock/hpssacli-swiftlm.lock '
+# hpssacli is slow and controller state changes rarely, so successful
+# output is reused for OUTPUT_CACHE_TTL seconds (cache_ttl in the [hpssacli]
+# section of swiftlm-scan.conf). The lock above serialises hpssacli, so the
+# commands are not run in parallel.
+OUTPUT_CACHE = 'hpssacli_output.json'
+OUTPUT_CACHE_TTL = 120
 BASE_RESULT = MetricData(
     name=__name__,
     messages={
@@ -58,13 +66,7 @@ METRIC_KEYS = ['array', 'physicaldrive', 'logical_drive', 'caching',
 
 
 def indent_at(line):
-    indent = 0
-    for char in line:
-        if char.isspace():
-            indent += 1
-        else:
-            break
-    return indent
+    return len(line) - len(line.lstrip())
 
 
 class TextBlock(object):
@@ -89,6 +91,43 @@ class TextBlock(object):
         return subblock
 
 
+def scan_blocks(lines, depth):
+    """
+    Scan column-aligned text, yielding the blocks at one depth as they
+    are completed.
+
+    The blocks that are yielded are not kept in the tree, so only the
+    ancestors of the current block are held in memory.
+
+    :param lines: an iterable of lines of text
+    :param depth: the depth of the blocks to yield; 1 is the outermost
+                  (unindented) lines
+    :returns: generator of (ancestors, block) where ancestors is the list
+              of the text of the enclosing blocks, outermost first
+    """
+    root = TextBlock('root')
+    # (indent, block) of the current block and its ancestors
+    stack = [(-1, root)]
+    for line in lines:
+        if not line or line.isspace():
+            continue
+        indent = indent_at(line)
+        while stack[-1][0] >= indent:
+            _, block = stack.pop()
+            if len(stack) == depth:
+                yield [b.text for _, b in stack[1:]], block
+        parent = stack[-1][1]
+        if len(stack) == depth:
+            block = TextBlock(line.strip())
+        else:
+            block = parent.make_subblock(line.strip())
+        stack.append((indent, block))
+    while len(stack) > 1:
+        _, block = stack.pop()
+        if len(stack) == depth:
+            yield [b.text for _, b in stack[1:]], block
+
+
 class TextScanner(object):
     """
     Scans blocks of text
@@ -101,43 +140,56 @@ class TextScanner(object):
     """
 
     def __init__(self, lines):
-        self.line_index = None
         self.root_block = TextBlock('root')
         self.scan_text_blocks(lines, -1, self.root_block)
 
     def scan_text_blocks(self, lines, indent, block):
-        '''
-        Scan blocks of text recursively
+        """
+        Scan blocks of text in a single pass.
 
-        Normally each line is scanned once (incrementing self.line_index)
-        However, if we're called and realise the line is
-        an outer block (because indent is less than current), we
-        decrement line_index so that we reprocess that line.
+        A stack holds the block of each indentation level that is still
+        open; a line closes every open block indented as far or further
+        than itself and becomes a subblock of the innermost one left.
 
-        :param lines: an array of lines of text
-        :param indent: the current indentation level
+        :param lines: an iterable of lines of text
+        :param indent: the indentation level of block
         :param block: the outer block
-        '''
-        if self.line_index is None:
-            self.line_index = 0
-        while self.line_index < len(lines):
-            line = lines[self.line_index]
-            self.line_index += 1
+        """
+        stack = [(indent, block)]
+        for line in lines:
             if not line or line.isspace():
                 continue
-            if indent_at(line) <= indent:
-                # Text is outer block -- out block has ended
-                self.line_index += -1
-                return
-            # Text at same level as our peers -- save the text
-            subblock = block.make_subblock(line.strip())
-            # Look for more lines
-            self.scan_text_blocks(lines, indent_at(line), subblock)
+            line_indent = indent_at(line)
+            while stack[-1][0] >= line_indent:
+                stack.pop()
+                if not stack:
+                    # Text is outside the outer block
+                    return
+            subblock = stack[-1][1].make_subblock(line.strip())
+            stack.append((line_indent, subblock))
 
     def get_root_block(self):
         return self.root_block
 
 
+def run_hpssacli(args, output_cache=None):
+    """
+    Run hpssacli under the lock, reusing recent output if there is any.
+
+    :param args: the hpssacli arguments, e.g. 'ctrl all show detail'
+    :param output_cache: dictionary of args to the time and output of
+                         recent successful runs (see main), or None to not
+                         cache. New output is added to it.
+    :returns: CommandResult
+    """
+    if output_cache is not None and args in output_cache:
+        return CommandResult(0, output_cache[args]['output'])
+    rc = run_cmd(LOCK_FILE_COMMAND + 'hpssacli ' + args)
+    if output_cache is not None and rc.exitcode == 0:
+        output_cache[args] = {'time': time.time(), 'output': rc.output}
+    return rc
+
+
 def parse_array_name(text):
     return text.split()[0], text.split()[1].strip(), text
 
@@ -183,7 +235,7 @@ def get_smart_array_info():
     return get_controller_info()
 
 
-def get_controller_info():
+def get_controller_info(output_cache=None):
     """
     parses controller data from hpssacli in the form.
     returns a dict.
@@ -256,7 +308,7 @@ def get_controller_info():
     controller_result = BASE_RESULT.child()
     controller_result.name += '.' + 'smart_array'
 
-    rc = run_cmd(LOCK_FILE_COMMAND + 'hpssacli ctrl all show detail')
+    rc = run_hpssacli('ctrl all show detail', output_cache)
 
     if rc.exitcode != 0:
         if 'Error: No controllers detected.' in str(rc.output):
@@ -374,7 +426,7 @@ def check_controller(c, base):
     return results
 
 
-def get_physical_drive_info(controller_slot):
+def get_physical_drive_info(controller_slot, output_cache=None):
     """
     Parses drive data from hpssacli in the form.
     There are multiple drives in the output.
@@ -405,9 +457,8 @@ def get_physical_drive_info(controller_slot):
         'controller_slot': str(controller_slot)
     })
     drive_result.name += '.physical_drive'
-    rc = run_cmd(
-        LOCK_FILE_COMMAND + 'hpssacli ctrl slot=%s pd all show detail'
-                            % controller_slot)
+    rc = run_hpssacli('ctrl slot=%s pd all show detail' % controller_slot,
+                      output_cache)
 
     if rc.exitcode != 0:
         if len(rc.output) > 1847:
@@ -424,37 +475,34 @@ def get_physical_drive_info(controller_slot):
                             rc.output, controller_slot, rc.exitcode))
 
     drive_info = []
-    text_scanner = TextScanner(lines)
-    root = text_scanner.get_root_block()
 
-    # Extract drive information
-    for controller in root.subblocks:
-        line = controller.text
-        if line.startswith("Smart Array"):
-            _, controller_key = parse_controller_name(line)
-            for assignment in controller.subblocks:
-                line = assignment.text
-                if "array" in line:
-                    # drives assigned to a LUN
-                    pass
-                elif "hba drives" in line.lower():
-                    # controller in HBA mode
-                    pass
-                elif "unassigned" in line.lower():
-                    # Unassigned drives are probably unassigned for a reason
-                    # (such as failed) so we'll ignore them
-                    continue
-                else:
-                    # Unrecognised assignment - ignore
-                    continue
+    # Extract drive information. Each drive is a block under a controller
+    # and assignment:
+    #
+    # Smart Array P410 in Slot 1
+    #    array A
+    #       physicaldrive 2C:1:1
+    for (controller, assignment), pd in scan_blocks(lines, 3):
+        if not controller.startswith("Smart Array"):
+            continue
+        if "array" in assignment:
+            # drives assigned to a LUN
+            pass
+        elif "hba drives" in assignment.lower():
+            # controller in HBA mode
+            pass
+        else:
+            # Unassigned drives are probably unassigned for a reason
+            # (such as failed) so we'll ignore them. Also ignore
+            # unrecognised assignments.
+            continue
 
-                for pd in assignment.subblocks:
-                    # Parse drive attributes
-                    pd_data = {}
-                    for attribute in pd.subblocks:
-                        parse_cont_attribute(attribute, pd_data)
+        # Parse drive attributes
+        pd_data = {}
+        for attribute in pd.subblocks:
+            parse_cont_attribute(attribute, pd_data)
 
-                    drive_info.append(pd_data)
+        drive_info.append(pd_data)
 
     # Now walk drive_info to get metrics' data from the controller(s),
     # array(s), physical drive(s), and logical drive(s)
@@ -479,7 +527,8 @@ def check_physical_drive(d, base):
     return [r]
 
 
-def get_logical_drive_info(controller_slot, cache_check=True):
+def get_logical_drive_info(controller_slot, cache_check=True,
+                           output_cache=None):
     """
     array L
       Logical Drive: 12
@@ -506,9 +555,8 @@ def get_logical_drive_info(controller_slot, cache_check=True):
         'controller_slot': controller_slot
         })
     drive_result.name += '.' + 'logical_drive'
-    rc = run_cmd(
-        LOCK_FILE_COMMAND + 'hpssacli ctrl slot=%s ld all show detail'
-                            % controller_slot)
+    rc = run_hpssacli('ctrl slot=%s ld all show detail' % controller_slot,
+                      output_cache)
 
     if rc.exitcode != 0:
         if len(rc.output) > 1847:
@@ -525,37 +573,30 @@ def get_logical_drive_info(controller_slot, cache_check=True):
                             rc.output, controller_slot, rc.exitcode))
 
     drive_info = []
-    text_scanner = TextScanner(lines)
-    root = text_scanner.get_root_block()
 
-    # Extract logical drive information
-    for controller in root.subblocks:
-        line = controller.text
-        if line.startswith("Smart Array"):
-            for array in controller.subblocks:
-                line = array.text
-                if "array" in line:
-                    _, array_letter, array_name = parse_array_name(line)
-                    for lun in array.subblocks:
-                        line = lun.text
-                        if "Logical Drive:" in line:
-                            logical_drive = line.strip()
-                            try:
-                                _, ld_num = parse_ld_name(line)
-                                ld_data = {'array': array_letter,
-                                           'logical_drive': ld_num}
-                            except ValueError:
-                                continue
-                            for attribute in lun.subblocks:
-                                line = attribute.text
-                                try:
-                                    k, v = parse_attribute(line,
-                                                           underscoring=False)
-                                except ValueError:
-                                    continue
-                                if any(k in s for s in METRIC_KEYS):
-                                    ld_data.update({k: v})
-                            drive_info.append(ld_data)
+    # Extract logical drive information. Each logical drive is a block
+    # under a controller and array
+    for (controller, array), lun in scan_blocks(lines, 3):
+        if not controller.startswith("Smart Array") or "array" not in array:
+            continue
+        _, array_letter, array_name = parse_array_name(array)
+        line = lun.text
+        if "Logical Drive:" in line:
+            try:
+                _, ld_num = parse_ld_name(line)
+                ld_data = {'array': array_letter,
+                           'logical_drive': ld_num}
+            except ValueError:
+                continue
+            for attribute in lun.subblocks:
+                line = attribute.text
+                try:
+                    k, v = parse_attribute(line, underscoring=False)
+                except ValueError:
+                    continue
+                if any(k in s for s in METRIC_KEYS):
+                    ld_data.update({k: v})
+            drive_info.append(ld_data)
 
     # Now walk the LUNs and check them
     for ld_data in drive_info:
@@ -599,20 +640,36 @@ def check_logical_drive(d, base, cache_check):
 def main():
     """Check controller and drive information with hpssacli"""
     cache_check = True
+    ttl = OUTPUT_CACHE_TTL
+    cp = configparser.RawConfigParser()
     try:
-        cp = configparser.RawConfigParser()
         cp.read(CONFIG_FILE)
         cc = cp.getboolean('hpssacli', 'check_cache')
         if not cc:
             cache_check = False
     except Exception:
         pass
+    try:
+        ttl = cp.getint('hpssacli', 'cache_ttl')
+    except Exception:
+        pass
 
-    results, controller_slots = get_controller_info()
-
-    for controller_slot in controller_slots:
-        results.extend(get_physical_drive_info(controller_slot))
-        results.extend(get_logical_drive_info(controller_slot,
-                                              cache_check=cache_check))
+    # Entries older than the ttl are dropped so the file does not keep
+    # output for controllers that have gone
+    now = time.time()
+    output_cache = dict(
+        (args, entry) for args, entry in load_state(OUTPUT_CACHE).items()
+        if 0 <= now - entry.get('time', 0) < ttl)
+    try:
+        results, controller_slots = get_controller_info(output_cache)
+
+        for controller_slot in controller_slots:
+            results.extend(get_physical_drive_info(controller_slot,
+                                                   output_cache))
+            results.extend(get_logical_drive_info(controller_slot,
+                                                  cache_check=cache_check,
+                                                  output_cache=output_cache))
+    finally:
+        save_state(OUTPUT_CACHE, output_cache)
 
     return results
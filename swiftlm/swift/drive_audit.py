@@ -17,23 +17,51 @@
 
 
 import ast
+import errno
+import json
 import subprocess
 import os
+import re
+import time
 import ConfigParser
 
 from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.values import Severity
+from swiftlm.utils.utility import get_mounts, load_state, save_state
 
 ERRORS_PATTERN = 'drive-audit: Errors found:'
 DEVICES_PATTERN = 'drive-audit: Devices found:'
 DRIVE_AUDIT_CONF = '/etc/swift/drive-audit.conf'
+FSTAB = '/etc/fstab'
+TRUE_VALUES = ('true', '1', 'yes', 'on', 't', 'y')
+
+# Rather than run swift-drive-audit (which re-reads the whole kernel log on
+# every run) the kernel log is read from /dev/kmsg. The sequence number of
+# the last record seen is persisted so only new records are matched, and
+# error counts are kept in KMSG_BUCKET second buckets so they can be summed
+# over the drive-audit.conf "minutes" window.
+KMSG = '/dev/kmsg'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+PROC_UPTIME = '/proc/uptime'
+KMSG_STATE = 'drive_audit_kmsg.json'
+KMSG_BUCKET = 60
+KMSG_READ_SIZE = 8192
+
+# The same defaults as swift-drive-audit
+DEFAULT_ERROR_PATTERNS = (
+    r'\berror\b.*\b(sd[a-z]{1,2}\d?)\b',
+    r'\b(sd[a-z]{1,2}\d?)\b.*\berror\b',
+)
 
 BASE_RESULT = MetricData(
     name=__name__,
     messages={
         'ok': 'No errors found on device mounted at: {mount_point}',
         'warn': 'No devices found',
-        'fail': 'Errors found on device mounted at: {mount_point}',
+        'fail': 'Errors found on device mounted at: {mount_point}'
+                ' ({errors} errors)',
+        'unmounted': 'Errors found on device mounted at: {mount_point}'
+                     ' ({errors} errors), unmounted',
         'unknown': 'Unrecoverable error: {error}'
     }
 )
@@ -99,9 +127,10 @@ def check_errors(drive_recon_file):
     for dev in found_devs:
         dimensions = dict(dev)
         del dimensions['kernel_device']
-        result = BASE_RESULT.child(dimensions=dimensions)
-        if dev.get('kernel_device') in error_devices.keys():
-            # TODO might like to include error count in value_meta
+        errors = error_devices.get(dev.get('kernel_device'), 0)
+        result = BASE_RESULT.child(dimensions=dimensions,
+                                   msgkeys={'errors': errors})
+        if errors:
             result.value = Severity.fail
         else:
             result.value = Severity.ok
@@ -109,17 +138,313 @@ def check_errors(drive_recon_file):
     return results
 
 
-def main():
+def get_drive_audit_conf(conf_file=DRIVE_AUDIT_CONF):
+    """
+    Read the options of drive-audit.conf that the kernel log scan uses.
 
+    :returns: dictionary of recon_cache_path, device_dir, minutes,
+              error_limit, unmount_failed_device and error_re (a list of
+              compiled patterns)
+    """
+    conf = {'recon_cache_path': '/var/cache/swift',
+            'device_dir': '/srv/node',
+            'minutes': 60,
+            'error_limit': 1,
+            'unmount_failed_device': True}
+    patterns = []
     parser = ConfigParser.RawConfigParser()
-    parser.read(DRIVE_AUDIT_CONF)
+    parser.read(conf_file)
+    if parser.has_section('drive-audit'):
+        for key, value in parser.items('drive-audit'):
+            if key.startswith('regex_pattern_'):
+                patterns.append(value)
+            elif key in ('recon_cache_path', 'device_dir'):
+                conf[key] = value
+            elif key in ('minutes', 'error_limit'):
+                try:
+                    conf[key] = int(value)
+                except ValueError:
+                    pass
+            elif key == 'unmount_failed_device':
+                conf[key] = value.strip().lower() in TRUE_VALUES
+    conf['error_re'] = []
+    for pattern in patterns or DEFAULT_ERROR_PATTERNS:
+        try:
+            conf['error_re'].append(re.compile(pattern))
+        except re.error:
+            pass
+    return conf
+
+
+def disk_name(kernel_device):
+    """
+    :returns: the whole disk name of a kernel device or partition name,
+              e.g. sdb for sdb1 and nvme0n1 for nvme0n1p1
+    """
+    match = re.match(r'((?:nvme\d+n|mmcblk)\d+)(?:p\d+)?$', kernel_device)
+    if match:
+        return match.group(1)
+    return re.sub(r'(?<=\D)\d+$', '', kernel_device)
+
+
+def get_kernel_devices(mounts, device_dir):
+    """
+    Map the disks mounted below device_dir to their mount points.
+
+    :param mounts: as returned by get_mounts()
+    :returns: dictionary of disk name to mount point
+    """
+    prefix = device_dir.rstrip('/') + '/'
+    devices = {}
+    for mount, entry in mounts.items():
+        if not (mount.startswith(prefix) and
+                entry.device.startswith('/dev/')):
+            continue
+        kernel_device = os.path.basename(os.path.realpath(entry.device))
+        devices[disk_name(kernel_device)] = mount
+    return devices
+
+
+def read_kmsg(after_seq, kmsg=KMSG):
+    """
+    Read the kernel log records after a sequence number.
+
+    Each read() of /dev/kmsg returns one record, which looks like:
+
+        3,1234,5678901,-;sd 2:0:0:0: [sdb] error message
+         SUBSYSTEM=scsi
+
+    Reading is non-blocking, so this stops at the end of the log rather
+    than waiting for more records.
 
+    :param after_seq: sequence number of the last record already seen
+    :returns: list of (sequence number, microseconds since boot, message)
+              tuples
+    :raises OSError: if kmsg cannot be opened
+    """
+    records = []
+    fd = os.open(kmsg, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while True:
+            try:
+                record = os.read(fd, KMSG_READ_SIZE)
+            except OSError as e:
+                if e.errno == errno.EPIPE:
+                    # records were overwritten before we read them
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not record:
+                break
+            header, _, message = record.partition(';')
+            try:
+                fields = header.split(',')
+                seq = int(fields[1])
+                usec = int(fields[2])
+            except (IndexError, ValueError):
+                continue
+            if seq > after_seq:
+                records.append((seq, usec, message.split('\n')[0]))
+    finally:
+        os.close(fd)
+    return records
+
+
+def get_boot_id(boot_id_file=BOOT_ID):
+    try:
+        with open(boot_id_file, 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def get_uptime(proc_uptime=PROC_UPTIME):
+    """
+    :returns: seconds since boot, or None if they cannot be read
+    """
     try:
-        drive_recon_dir = parser.get("drive-audit", "recon_cache_path")
-    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
-        drive_recon_dir = "/var/cache/swift"
+        with open(proc_uptime, 'r') as f:
+            return float(f.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+
 
-    drive_recon_file = os.path.join(drive_recon_dir, "drive.recon")
+def scan_kernel_log(state, error_re, now, kmsg=KMSG):
+    """
+    Count the errors in the kernel log records that are new since the
+    last scan.
+
+    :param state: as loaded from KMSG_STATE; updated in place with the new
+                  cursor and error counts
+    :param error_re: list of compiled patterns whose first group is the
+                     kernel device name
+    :param now: time of the scan
+    :raises OSError: if kmsg cannot be opened
+
+    Errors are counted in the bucket of the time the kernel logged them, so
+    that on the first scan after a reboot or lost state, errors logged long
+    ago fall outside the minutes window rather than being counted now. The
+    record timestamps do not include time suspended, which is close enough
+    on a server.
+    """
+    boot_id = get_boot_id()
+    if state.get('boot_id') != boot_id:
+        # sequence numbers restart at boot
+        state['boot_id'] = boot_id
+        state['seq'] = -1
+    errors = state.setdefault('errors', {})
+    uptime = get_uptime()
+    for seq, usec, message in read_kmsg(state.get('seq', -1), kmsg):
+        state['seq'] = seq
+        devices = set()
+        for err in error_re:
+            devices.update(disk_name(d) for d in err.findall(message))
+        if not devices:
+            continue
+        logged = now
+        if uptime is not None:
+            logged = min(now, now - uptime + usec / 1e6)
+        bucket = str(int(logged) // KMSG_BUCKET * KMSG_BUCKET)
+        for device in devices:
+            counts = errors.setdefault(device, {})
+            counts[bucket] = counts.get(bucket, 0) + 1
+
+
+def error_counts(state, minutes, now):
+    """
+    Sum the error counts in the last minutes, discarding older buckets.
+
+    :returns: dictionary of disk name to error count
+    """
+    oldest = now - minutes * 60
+    counts = {}
+    for device, buckets in state.get('errors', {}).items():
+        for bucket in list(buckets):
+            if int(bucket) + KMSG_BUCKET <= oldest:
+                del buckets[bucket]
+        if buckets:
+            counts[device] = sum(buckets.values())
+        else:
+            del state['errors'][device]
+    return counts
 
+
+def write_drive_recon(drive_recon_file, recon_errors):
+    """
+    Update drive.recon as swift-drive-audit would so that
+    swift-recon --driveaudit keeps working.
+    """
+    try:
+        with open(drive_recon_file, 'r') as f:
+            recon = json.load(f)
+    except (IOError, ValueError):
+        recon = {}
+    recon.update(recon_errors)
+    recon['drive_audit_errors'] = sum(recon_errors.values())
+    tmp_file = '%s.%d.tmp' % (drive_recon_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(recon, f)
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, drive_recon_file)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+def comment_fstab(mount_point, fstab=FSTAB):
+    """
+    Comment out the fstab entries of mount_point, as swift-drive-audit
+    does, so the failed device is not mounted again at boot.
+    """
+    with open(fstab, 'r') as f:
+        lines = f.readlines()
+    tmp_file = '%s.%d.tmp' % (fstab, os.getpid())
+    with open(tmp_file, 'w') as f:
+        for line in lines:
+            fields = line.split()
+            if (len(fields) > 2 and fields[1] == mount_point and
+                    not line.startswith('#')):
+                line = '#' + line
+            f.write(line)
+    os.chmod(tmp_file, os.stat(fstab).st_mode & 0o7777)
+    os.rename(tmp_file, fstab)
+
+
+def unmount_device(mount_point):
+    """
+    Unmount a failed device and comment it out of fstab, as
+    swift-drive-audit does when unmount_failed_device is set.
+
+    :returns: True if the device was unmounted
+    """
+    if subprocess.call(['umount', '-fl', mount_point]) != 0:
+        return False
+    try:
+        comment_fstab(mount_point)
+    except (IOError, OSError):
+        pass
+    return True
+
+
+def check_kernel_log(conf, now=None):
+    """
+    Check the kernel log for errors on the devices below device_dir.
+    Devices with error_limit or more errors are unmounted if
+    unmount_failed_device is set.
+
+    :raises OSError: if the kernel log cannot be read
+    """
+    now = time.time() if now is None else now
+    state = load_state(KMSG_STATE)
+    scan_kernel_log(state, conf['error_re'], now)
+    counts = error_counts(state, conf['minutes'], now)
+    save_state(KMSG_STATE, state)
+
+    try:
+        devices = get_kernel_devices(get_mounts(), conf['device_dir'])
+    except IOError as e:
+        result = BASE_RESULT.child(dimensions={'error': str(e)})
+        result.value = Severity.unknown
+        return result
+    if not devices:
+        result = BASE_RESULT.child()
+        result.value = Severity.warn
+        return result
+
+    results = []
+    recon_errors = {}
+    for device, mount_point in sorted(devices.items()):
+        errors = counts.get(device, 0)
+        result = BASE_RESULT.child(dimensions={'mount_point': mount_point},
+                                   msgkeys={'errors': errors})
+        if errors >= max(conf['error_limit'], 1):
+            result.value = Severity.fail
+            recon_errors[mount_point] = errors
+            if (conf['unmount_failed_device'] and
+                    unmount_device(mount_point)):
+                result.message = 'unmounted'
+        else:
+            result.value = Severity.ok
+            recon_errors[mount_point] = 0
+        results.append(result)
+    write_drive_recon(os.path.join(conf['recon_cache_path'], 'drive.recon'),
+                      recon_errors)
+    return results
+
+
+def main():
     """Checks for corrupted sectors on drives."""
+    conf = get_drive_audit_conf()
+    try:
+        return check_kernel_log(conf)
+    except OSError:
+        # /dev/kmsg is not readable (e.g. in a container), so fall back
+        # to running swift-drive-audit
+        pass
+
+    drive_recon_file = os.path.join(conf['recon_cache_path'], 'drive.recon')
     return check_errors(drive_recon_file)
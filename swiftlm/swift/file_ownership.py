@@ -18,12 +18,19 @@
 
 import os
 import os.path
-import pwd
+import stat
+import time
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 from swiftlm.utils.utility import server_type
 from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.values import Severity, ServerType
 from swiftlm.utils.utility import get_swift_mount_point
+from swiftlm.utils.utility import load_state, save_state
+from swiftlm.utils.users import get_uid, SWIFT_USER
 
 SWIFT_DIR = '/etc/swift'
 CONF_DIR = '/etc'
@@ -32,6 +39,15 @@ NODE_DIR = get_swift_mount_point()
 ZERO_BYTE_EXCLUDE = frozenset(['reload-trigger', 'swauth_to_tenant_map.gz'])
 SWIFT_OWNED_EXCLUDE = frozenset(['lost+found'])
 
+# The trees below /srv/node/<device> are too big to walk in one run. They
+# are walked a little at a time, SCAN_TIME_BUDGET seconds per run shared
+# between the devices, resuming where the previous run stopped.
+SCAN_STATE = 'file_ownership_scan.json'
+SCAN_TIME_BUDGET = 5.0
+# Paths found with the wrong owner are remembered (and re-checked) so they
+# stay reported while the scan moves on. Only the first few are kept.
+SCAN_MAX_REMEMBERED = 100
+
 
 def add_result(results, path, reason):
     messages = {
@@ -44,10 +60,11 @@ def add_result(results, path, reason):
         results.append(c)
 
 
-def _is_swift_owned(results, p):
+def _is_swift_owned(results, p, st=None):
     # True = good, False = bad
-    owner = pwd.getpwuid(os.stat(p).st_uid).pw_name
-    if owner == 'swift':
+    if st is None:
+        st = os.stat(p)
+    if st.st_uid == get_uid(SWIFT_USER):
         return True
     else:
         if os.path.basename(p) not in SWIFT_OWNED_EXCLUDE:
@@ -55,17 +72,46 @@ def _is_swift_owned(results, p):
             return False
 
 
-def not_swift_owned_config(results):
-    # Check /etc/swift and its children
+def _stat_tree(top):
+    """
+    Walk a tree (following links) and stat each path once.
+
+    :param top: directory to walk
+    :returns: list of (path, stat result) for everything below top. The
+              stat result is None if the path cannot be stat'ed, e.g. a
+              dangling link.
+    """
+    entries = []
+    pending = [top]
+    while pending:
+        try:
+            children = list(scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in children:
+            try:
+                st = entry.stat()
+            except OSError:
+                st = None
+            entries.append((entry.path, st))
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                pending.append(entry.path)
+    return entries
+
+
+def not_swift_owned_config(results, entries=None):
+    """
+    Check /etc/swift and its children
+
+    :param entries: result of _stat_tree(SWIFT_DIR), if already known
+    """
     p = SWIFT_DIR
     if os.path.isdir(p):
-        for root, dirs, files in os.walk(p, followlinks=True):
-            for d in dirs:
-                x = os.path.join(root, d)
-                _is_swift_owned(results, x)
-            for f in files:
-                x = os.path.join(root, f)
-                _is_swift_owned(results, x)
+        if entries is None:
+            entries = _stat_tree(p)
+        for x, st in entries:
+            if st is not None:
+                _is_swift_owned(results, x, st)
     else:
         add_result(results, p, 'missing')
     return results
@@ -90,14 +136,161 @@ def not_swift_owned_data(results):
     return results
 
 
-def _is_empty_file(results, p):
+def _walk_sorted(top, resume=(), lo=0.0, hi=1.0):
+    """
+    Walk a tree depth first in name order, starting after a given path.
+
+    The file type comes from the directory entry so only entries that are
+    checked need to be stat'ed.
+
+    :param top: directory to walk
+    :param resume: path components (relative to top) of the last entry
+                   yielded by a previous walk. The walk continues after it.
+    :param lo, hi: the fraction of the whole tree that top represents
+    :returns: generator of (entry, path components relative to top,
+              estimated fraction of the tree walked before entry)
+    """
+    try:
+        entries = sorted(scandir(top), key=lambda e: e.name)
+    except OSError:
+        # Directories come and go as objects are written and deleted
+        return
+    step = (hi - lo) / len(entries) if entries else 0.0
+    for i, entry in enumerate(entries):
+        child_lo = lo + i * step
+        if resume:
+            if entry.name < resume[0]:
+                continue
+            if entry.name == resume[0]:
+                # Already yielded, carry on inside it
+                if entry.is_dir(follow_symlinks=False):
+                    for child, parts, done in _walk_sorted(
+                            entry.path, resume[1:], child_lo,
+                            child_lo + step):
+                        yield child, [entry.name] + parts, done
+                resume = ()
+                continue
+            resume = ()
+        yield entry, [entry.name], child_lo
+        if entry.is_dir(follow_symlinks=False):
+            for child, parts, done in _walk_sorted(entry.path, (), child_lo,
+                                                   child_lo + step):
+                yield child, [entry.name] + parts, done
+
+
+def _scan_device(device, state, deadline):
+    """
+    Continue the ownership scan of one device until deadline.
+
+    :param device: path of the device, e.g. /srv/node/disk0
+    :param state: the scan state of the device, updated in place
+    :param deadline: time at which to stop
+    """
+    swift_uid = get_uid(SWIFT_USER)
+
+    # Re-check what was found before; it stays reported until fixed
+    bad = []
+    for rel_path in state.get('bad', []):
+        try:
+            uid = os.lstat(os.path.join(device, rel_path)).st_uid
+        except OSError:
+            continue
+        if uid != swift_uid:
+            bad.append(rel_path)
+
+    cursor = state.get('cursor', [])
+    scanned = state.get('scanned', 0)
+    progress = state.get('progress', 0.0)
+    finished = True
+    for entry, parts, progress in _walk_sorted(device, cursor):
+        if time.time() >= deadline:
+            finished = False
+            break
+        cursor = parts
+        scanned += 1
+        if entry.name in SWIFT_OWNED_EXCLUDE:
+            continue
+        try:
+            uid = entry.stat(follow_symlinks=False).st_uid
+        except OSError:
+            continue
+        rel_path = os.path.join(*parts)
+        if (uid != swift_uid and rel_path not in bad and
+                len(bad) < SCAN_MAX_REMEMBERED):
+            bad.append(rel_path)
+
+    if finished:
+        state['passes'] = state.get('passes', 0) + 1
+        state['last_pass'] = time.time()
+        state['last_pass_scanned'] = scanned
+        cursor, scanned, progress = [], 0, 0.0
+    state.update({'cursor': cursor, 'scanned': scanned,
+                  'progress': progress, 'bad': bad})
+
+
+def scan_node_data(results, budget=None):
+    """
+    Check the ownership of everything under /srv/node/<device>.
+
+    Each run continues the walk of each device from where the previous run
+    stopped, for at most budget seconds in total. Ownership problems
+    anywhere in the trees are found eventually at a bounded cost per run.
+
+    :param results: list that ownership problems are added to
+    :param budget: seconds to spend, defaults to SCAN_TIME_BUDGET
+    :returns: list of MetricData reporting the coverage of each device
+    """
+    metrics = []
+    if not os.path.isdir(NODE_DIR):
+        return metrics
+    if budget is None:
+        budget = SCAN_TIME_BUDGET
+
+    devices = sorted(d for d in os.listdir(NODE_DIR)
+                     if d not in SWIFT_OWNED_EXCLUDE and
+                     os.path.isdir(os.path.join(NODE_DIR, d)))
+    old_state = load_state(SCAN_STATE)
+    state = {}
+    start = time.time()
+    for i, device in enumerate(devices):
+        # Share what is left of the budget between the remaining devices
+        deadline = time.time() + (start + budget - time.time()) / (
+            len(devices) - i)
+        device_state = old_state.get(device, {})
+        _scan_device(os.path.join(NODE_DIR, device), device_state,
+                     deadline)
+        state[device] = device_state
+
+        for rel_path in device_state['bad']:
+            add_result(results, os.path.join(NODE_DIR, device, rel_path),
+                       'ownership')
+        m = MetricData.single(
+            __name__ + '.data_scan.progress',
+            round(100.0 * device_state['progress'], 1),
+            message=('{scanned} paths checked in current pass,'
+                     ' {passes} full passes completed'),
+            msgkeys={'scanned': device_state['scanned'],
+                     'passes': device_state.get('passes', 0)})
+        m['mount'] = os.path.join(NODE_DIR, device)
+        metrics.append(m)
+
+    save_state(SCAN_STATE, state)
+    return metrics
+
+
+def _is_empty_file(results, p, st=None):
     # True = bad, False = good
     # Should think of a way to make false = bad here to match _is_swift_owned
-    if not os.path.isfile(p):
+    if st is None:
+        try:
+            st = os.stat(p)
+        except OSError:
+            pass
+    if st is None or not stat.S_ISREG(st.st_mode):
         add_result(results, p, 'missing')
         return True
 
-    if (os.stat(p).st_size == 0 and
+    if (st.st_size == 0 and
             os.path.basename(p) not in ZERO_BYTE_EXCLUDE):
         add_result(results, p, 'empty')
         return True
@@ -105,8 +298,12 @@ def _is_empty_file(results, p):
     return False
 
 
-def empty_files(results):
-    # Check individual files
+def empty_files(results, entries=None):
+    """
+    Check individual files
+
+    :param entries: result of _stat_tree(SWIFT_DIR), if already known
+    """
     if not server_type(ServerType.proxy):
         _is_empty_file(results, CONF_DIR + '/rsyncd.conf')
 
@@ -115,10 +312,11 @@ def empty_files(results):
     # Check all children in /etc/swift
     p = SWIFT_DIR
     if os.path.isdir(p):
-        for root, _, files in os.walk(p, followlinks=True):
-            for f in files:
-                x = os.path.join(root, f)
-                _is_empty_file(results, x)
+        if entries is None:
+            entries = _stat_tree(p)
+        for x, st in entries:
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                _is_empty_file(results, x, st)
     else:
         add_result(results, p, 'missing')
     return results
@@ -127,14 +325,16 @@ def empty_files(results):
 def main():
     """Check that swift owns its relevant files and directories."""
 
-    # Check /etc/swift
+    # Check /etc/swift, both checks share one walk of the tree
     config_results = []
-    not_swift_owned_config(config_results)
-    empty_files(config_results)
+    entries = _stat_tree(SWIFT_DIR) if os.path.isdir(SWIFT_DIR) else None
+    not_swift_owned_config(config_results, entries)
+    empty_files(config_results, entries)
 
     # Check files under /srv/node
     data_results = []
     not_swift_owned_data(data_results)
+    scan_metrics = scan_node_data(data_results)
 
     # Generate metrics. Use the "reason" field from the *first* failure
     # in each category to populate the msg field for Severity.fail. If there
@@ -154,6 +354,7 @@ def main():
     else:
         metrics.append(MetricData.single(__name__ + '.data', Severity.ok,
                                          message='OK'))
+    metrics.extend(scan_metrics)
     return metrics
 
 
@@ -16,13 +16,13 @@
 #
 
 
-import json
-
 from swiftlm.utils.metricdata import MetricData, timestamp, CheckFailure
 from swiftlm.utils.values import Severity, ServerType
 from swiftlm.utils.utility import SwiftlmCheckFailure
+from swiftlm.utils import recon
+from swiftlm.utils.recon import load_recon
 
-RECON_PATH = '/var/cache/swift/'
+RECON_PATH = recon.RECON_PATH
 TIMEOUT = 2
 BASE_RESULT = MetricData(
     name=__name__,
@@ -30,36 +30,108 @@ BASE_RESULT = MetricData(
 )
 
 
+def _replication_summary(j):
+    """
+    Pick out the replication details from a recon file.
+
+    The object replicator reports replication_time in minutes, the
+    account and container replicators in seconds; the summary is always
+    in seconds.
+    """
+    last = j.get('replication_last')
+    if last is None:
+        last = j.get('object_replication_last')
+    repl_time = j.get('replication_time')
+    if 'object_replication_time' in j:
+        repl_time = j['object_replication_time'] * 60
+    stats = j.get('replication_stats') or {}
+    summary = {
+        'last': last,
+        'time': repl_time,
+        'failures': stats.get('failure'),
+        'per_disk': dict(
+            (device, data.get('object_replication_last'))
+            for device, data in
+            (j.get('object_replication_per_disk') or {}).items()
+            if data.get('object_replication_last') is not None),
+        'reconstruction_last': j.get('object_reconstruction_last'),
+        'reconstruction_time': None,
+        'reconstruction_per_disk': dict(
+            (device, data.get('object_reconstruction_last'))
+            for device, data in
+            (j.get('object_reconstruction_per_disk') or {}).items()
+            if data.get('object_reconstruction_last') is not None),
+    }
+    if j.get('object_reconstruction_time') is not None:
+        summary['reconstruction_time'] = j['object_reconstruction_time'] * 60
+    return summary
+
+
+def _age_results(name, component, last, per_disk):
+    """
+    :returns: the age of the last run, and of the last run for each device
+    """
+    now = timestamp()
+    r = BASE_RESULT.child(name=name, dimensions={'component': component})
+    r.value = now - int(last)
+    results = [r]
+    device_name = name.replace('.last_', '.device.last_')
+    for device, device_last in sorted(per_disk.items()):
+        r = BASE_RESULT.child(name=device_name,
+                              dimensions={'component': component,
+                                          'device': device})
+        r.value = now - int(device_last)
+        results.append(r)
+    return results
+
+
 def _recon_check(st):
     """
-    Parses the blah.recon file and returns the last replication.
+    Parses the blah.recon file and returns the last replication, with
+    replication time, failure count and per-device details when the
+    replicator reports them. For object servers the reconstructor (EC
+    policies) is reported as well.
 
     :param st: ServerType, Used to determine the metric names and recon
         file name.
-    :param replication_field_name: string, name of the field in the json
-        file that hold the last replication data.
     """
     results = []
     if not st.is_instance:
         return results
-    r = BASE_RESULT.child(name=st.name + '.last_replication',
-                          dimensions={'component': '%s-replicator' % st.name})
+    component = '%s-replicator' % st.name
     recon_file = st.name + '.recon'
     try:
-        with open(RECON_PATH + recon_file) as f:
-            j = json.load(f)
-
-        last_replication = j.get('replication_last')
-        if last_replication is None:
-            last_replication = j.get('object_replication_last')
-
-        last_replication = int(last_replication)
-        last_replication = timestamp() - last_replication
-    except (ValueError, IOError) as e:
+        summary = load_recon(recon_file, _replication_summary,
+                             recon_path=RECON_PATH)
+        results.extend(_age_results(st.name + '.last_replication',
+                                    component, summary['last'],
+                                    summary['per_disk']))
+    except (ValueError, TypeError, IOError, OSError) as e:
         raise SwiftlmCheckFailure('Error in %s: %s' % (RECON_PATH + recon_file,
                                                        e))
-    r.value = last_replication
-    results.append(r)
+
+    if summary['time'] is not None:
+        r = BASE_RESULT.child(name=st.name + '.replication_time',
+                              dimensions={'component': component})
+        r.value = round(summary['time'], 2)
+        results.append(r)
+    if summary['failures'] is not None:
+        r = BASE_RESULT.child(name=st.name + '.replication_failures',
+                              dimensions={'component': component})
+        r.value = summary['failures']
+        results.append(r)
+
+    if summary['reconstruction_last'] is not None:
+        component = '%s-reconstructor' % st.name
+        results.extend(_age_results(st.name + '.last_reconstruction',
+                                    component,
+                                    summary['reconstruction_last'],
+                                    summary['reconstruction_per_disk']))
+        if summary['reconstruction_time'] is not None:
+            r = BASE_RESULT.child(name=st.name + '.reconstruction_time',
+                                  dimensions={'component': component})
+            r.value = round(summary['reconstruction_time'], 2)
+            results.append(r)
     return results
 
 
@@ -16,9 +16,19 @@
 #
 
 
-from swiftlm.utils.utility import server_type, get_all_proc_and_cmdlines,\
-                                  get_network_interface_conf,\
-                                  get_rsync_target_conf
+import ConfigParser
+import os
+import time
+from collections import namedtuple
+
+from swiftlm.utils import PROXY_PATH, ACCOUNT_PATH, CONTAINER_PATH
+from swiftlm.utils import OBJECT_PATH
+from swiftlm.utils.listeners import get_listeners, get_socket_inodes
+from swiftlm.utils.listeners import ip_matches
+from swiftlm.utils.utility import server_type, get_all_proc_and_cmdlines
+from swiftlm.utils.utility import load_state, save_state
+from swiftlm.utils.utility import get_network_interface_conf
+from swiftlm.utils.utility import get_rsync_target_conf
 from swiftlm.utils.metricdata import MetricData, get_base_dimensions
 from swiftlm.utils.values import Severity
 
@@ -28,6 +38,8 @@ BASE_RESULT = MetricData(
         'fail': '{component} is not running',
         'ok': '{component} is running',
         'unknown': 'no swift services running',
+        'accept_queue': '{accept_queue} connections waiting to be accepted'
+                        ' on {listener}',
     }
 )
 
@@ -50,6 +62,100 @@ SERVICES = [
     "proxy-server"
 ]
 
+PROC = '/proc'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+# Per-process counters from the previous run, used to compute CPU use and
+# I/O rates since then and to detect restarts
+USAGE_STATE = 'swift_services_usage.json'
+USAGE_METRICS = ('processes', 'rss', 'cpu_time', 'uptime', 'threads',
+                 'open_fds', 'cpu_percent', 'read_bytes_per_sec',
+                 'write_bytes_per_sec', 'restarts')
+
+# The servers whose listening address is checked, with the prefix of their
+# options in [network-interface] of swiftlm-scan.conf and the directory of
+# their own config file (used for bind_port if it is not in swiftlm-scan.conf)
+LISTENING_SERVICES = (
+    ('proxy-server', 'proxy', PROXY_PATH),
+    ('account-server', 'account', ACCOUNT_PATH),
+    ('container-server', 'container', CONTAINER_PATH),
+    ('object-server', 'object', OBJECT_PATH),
+)
+
+ProcStat = namedtuple('ProcStat', ['pid', 'start', 'cpu_ticks', 'threads',
+                                   'rss', 'open_fds', 'read_bytes',
+                                   'write_bytes'])
+
+
+class ProcessSnapshot(object):
+    """
+    The swift and rsync processes, found in a single pass over the process
+    table and shared by all of the checks.
+    """
+    def __init__(self):
+        self.services = {}
+        self.rsync = []
+        for process, cmdline in get_all_proc_and_cmdlines():
+            service = swift_service_name(cmdline)
+            if service:
+                self.services.setdefault(service, []).append(process)
+            elif (len(cmdline) >= 2 and cmdline[0].endswith('/rsync') and
+                    cmdline[1] == '--daemon'):
+                self.rsync.append(process)
+
+        self._socket_inodes = None
+        self._listeners = None
+
+    def is_running(self, service):
+        return bool(self.services.get(service))
+
+    def processes(self, service):
+        return self.services.get(service, [])
+
+    def pids(self, service):
+        if service == 'rsync':
+            return set(p.pid for p in self.rsync)
+        return set(p.pid for p in self.processes(service))
+
+    def listeners(self, service):
+        """
+        :returns: the listening sockets of a service (or rsync)
+        """
+        if self._listeners is None:
+            pids = [p.pid for p in self.rsync]
+            for procs in self.services.values():
+                pids.extend(p.pid for p in procs)
+            self._socket_inodes = get_socket_inodes(pids)
+            self._listeners = get_listeners()
+        pids = self.pids(service)
+        return [l for l in self._listeners
+                if self._socket_inodes.get(l.inode) in pids]
+
+    def is_listening(self, service, ip, port):
+        """
+        :returns: True if one of the sockets of the service accepts
+                  connections to ip:port
+        """
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            return False
+        return any(l.port == port and ip_matches(l.ip, ip)
+                   for l in self.listeners(service))
+
+
+def swift_service_name(cmdline):
+    """
+    :returns: the service name (e.g. object-server) if cmdline is that of
+              a swift service, otherwise None. Swift services are run as
+              <python> <path>/swift-<service> <conf file>.
+    """
+    if len(cmdline) >= 3 and cmdline[2].endswith('.conf'):
+        name = os.path.basename(cmdline[1])
+        if name.startswith('swift-'):
+            return name[len('swift-'):]
+    return None
+
 
 def services_to_check():
     # Filter SERVICES down to what should be running on the node.
@@ -60,7 +166,7 @@ def services_to_check():
     return services
 
 
-def check_swift_processes():
+def check_swift_processes(snapshot=None):
     results = []
 
     services = services_to_check()
@@ -70,10 +176,12 @@ def check_swift_processes():
         c.value = Severity.unknown
         return c
 
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
     for service in services:
         c = BASE_RESULT.child(dimensions={'component': service})
 
-        if not is_service_running(service):
+        if not is_service_running(service, snapshot):
             c.value = Severity.fail
         else:
             c.value = Severity.ok
@@ -83,46 +191,262 @@ def check_swift_processes():
     return results
 
 
-def is_service_running(service):
-    for _, cmdline in get_all_proc_and_cmdlines():
-        if len(cmdline) >= 3:
-            if (cmdline[1].endswith("swift-" + service) and
-                    cmdline[2].endswith(".conf")):
-                return True
-    # Reach here if no matching process not found in /proc/cmdline
-    return False
+def is_service_running(service, snapshot=None):
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+    return snapshot.is_running(service)
+
+
+def read_proc_stat(pid, proc=None):
+    """
+    Read the resource usage of a process from /proc/<pid>/stat, status, fd
+    and io.
+
+    :returns: ProcStat, or None if the process has exited. read_bytes and
+              write_bytes are None if /proc/<pid>/io cannot be read.
+    """
+    pid_dir = os.path.join(proc or PROC, str(pid))
+    try:
+        with open(os.path.join(pid_dir, 'stat')) as f:
+            stat = f.read()
+        # the command name is in parentheses and may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        rss = 0
+        with open(os.path.join(pid_dir, 'status')) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+        open_fds = len(os.listdir(os.path.join(pid_dir, 'fd')))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+    io = {}
+    try:
+        with open(os.path.join(pid_dir, 'io')) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                io[key] = int(value)
+    except (IOError, ValueError):
+        pass
+    return ProcStat(pid=pid,
+                    start=int(fields[19]),
+                    cpu_ticks=int(fields[11]) + int(fields[12]),
+                    threads=int(fields[17]),
+                    rss=rss,
+                    open_fds=open_fds,
+                    read_bytes=io.get('read_bytes'),
+                    write_bytes=io.get('write_bytes'))
+
+
+def get_boot_time(proc=None):
+    with open(os.path.join(proc or PROC, 'stat')) as f:
+        for line in f:
+            if line.startswith('btime '):
+                return int(line.split()[1])
+    return 0
+
+
+def get_boot_id():
+    try:
+        with open(BOOT_ID) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
 
+def service_usage(stats, previous, elapsed, boot_time, now):
+    """
+    Sum the resource usage of the processes of a service.
+
+    :param stats: list of ProcStat of the processes of the service
+    :param previous: the state saved for the service by the previous run,
+                     or an empty dict
+    :param elapsed: seconds since the previous run, or None if unknown
+    :returns: (usage, state) where usage is a dictionary with the keys of
+              USAGE_METRICS (the rates are omitted without a previous
+              run), and state is to be saved for the next run. usage is
+              None if all the processes have exited.
+    """
+    if not stats:
+        return None, previous
+    started = min(st.start for st in stats)
+    usage = {
+        'processes': len(stats),
+        'rss': sum(st.rss for st in stats),
+        'threads': sum(st.threads for st in stats),
+        'open_fds': sum(st.open_fds for st in stats),
+        'cpu_time': round(float(sum(st.cpu_ticks for st in stats)) /
+                          CLK_TCK, 2),
+        'uptime': max(int(now - boot_time - float(started) / CLK_TCK), 0),
+        'restarts': previous.get('restarts', 0),
+    }
+    if previous.get('start') not in (None, started):
+        usage['restarts'] += 1
+
+    # A process is only compared with itself if the pid has the same start
+    # time; otherwise it is new since the previous run and all of its usage
+    # is counted.
+    pids = previous.get('pids', {})
+    delta = {'cpu_ticks': 0, 'read_bytes': 0, 'write_bytes': 0}
+    for st in stats:
+        before = pids.get(str(st.pid))
+        if before and before[0] != st.start:
+            before = None
+        for i, key in enumerate(('cpu_ticks', 'read_bytes', 'write_bytes')):
+            value = getattr(st, key)
+            if value is None or delta[key] is None:
+                delta[key] = None
+                continue
+            if before and before[i + 1] is not None:
+                value = max(value - before[i + 1], 0)
+            delta[key] += value
+    if elapsed:
+        usage['cpu_percent'] = round(
+            100.0 * delta['cpu_ticks'] / CLK_TCK / elapsed, 2)
+        for key in ('read_bytes', 'write_bytes'):
+            if delta[key] is not None:
+                usage[key + '_per_sec'] = round(delta[key] / elapsed, 2)
+
+    state = {
+        'start': started,
+        'restarts': usage['restarts'],
+        'pids': dict((str(st.pid), [st.start, st.cpu_ticks, st.read_bytes,
+                                    st.write_bytes]) for st in stats),
+    }
+    return usage, state
+
+
+def check_service_resources(snapshot=None):
+    """
+    Report the resource usage of each running swift service: process
+    count, memory, threads, open files, CPU and I/O since the previous
+    run, uptime and the number of restarts seen.
+    """
+    results = []
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+    now = time.time()
+    state = load_state(USAGE_STATE)
+    boot_id = get_boot_id()
+    if state.get('boot_id') != boot_id:
+        # pids and start times are meaningless after a reboot; keep only
+        # the restart counts
+        state = {'services': dict(
+            (service, {'restarts': saved.get('restarts', 0) + 1})
+            for service, saved in state.get('services', {}).items())}
+    elapsed = None
+    if state.get('time') is not None and now > state['time']:
+        elapsed = now - state['time']
+    try:
+        boot_time = get_boot_time()
+    except IOError:
+        boot_time = 0
+
+    services_state = state.get('services', {})
+    for service in services_to_check():
+        stats = [read_proc_stat(p.pid) for p in snapshot.processes(service)]
+        usage, services_state[service] = service_usage(
+            [st for st in stats if st], services_state.get(service, {}),
+            elapsed, boot_time, now)
+        if usage is None:
+            continue
+        for key in USAGE_METRICS:
+            if key not in usage:
+                continue
+            c = BASE_RESULT.child(name=key,
+                                  dimensions={'component': service})
+            c.value = usage[key]
+            results.append(c)
+    save_state(USAGE_STATE, {'boot_id': boot_id, 'time': now,
+                             'services': services_state})
+    return results
 
-def get_rsync_bind_ip():
-    rsync_running = False
 
+def get_rsync_bind_ip(snapshot=None):
     data = get_network_interface_conf()
-    rsync_bind_ip_conf = data["rsync_bind_ip"]
+    rsync_bind_ip_conf = data.get("rsync_bind_ip")
     port = get_rsync_target_conf()
     rsync_bind_port_conf = port["rsync_bind_port"]
 
-    for process, cmdline in get_all_proc_and_cmdlines():
-        if len(cmdline) >= 2:
-            if cmdline[0].endswith('/rsync') and cmdline[1] == '--daemon':
-                rsync_running = True
-                rsync_laddr = process.connections()
-                rsync_laddr_ip, rsync_laddr_port = rsync_laddr[0].laddr
-                continue
-
-    if not rsync_running:
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+    if not snapshot.rsync:
         return False, False
 
-    ip_port_match = False
-    if (rsync_bind_ip_conf == rsync_laddr_ip and
-            rsync_bind_port_conf == str(rsync_laddr_port)):
-        ip_port_match = True
+    # rsync may listen on several addresses; any of them will do
+    return True, snapshot.is_listening('rsync', rsync_bind_ip_conf,
+                                       rsync_bind_port_conf)
+
+
+def get_bind_port(prefix, conf_dir, network_conf):
+    """
+    :returns: the configured port of a server from swiftlm-scan.conf,
+              or failing that from bind_port in its own config file,
+              or None if neither has it
+    """
+    port = network_conf.get('%s_bind_port' % prefix)
+    if port:
+        return port
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(conf_dir, '%s-server.conf' % prefix))
+    try:
+        return parser.get('DEFAULT', 'bind_port')
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        return None
+
 
-    return rsync_running, ip_port_match
+def check_listeners(snapshot=None):
+    """
+    Check that each running swift server is listening on the ip and port
+    it is configured for, and report the accept queue of each socket that
+    the servers (and rsync) listen on.
+    """
+    metrics = []
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+    network_conf = get_network_interface_conf()
+    services = services_to_check()
+    for service, prefix, conf_dir in LISTENING_SERVICES:
+        if service not in services or not snapshot.is_running(service):
+            continue
+        ip = network_conf.get('%s_bind_ip' % prefix)
+        port = get_bind_port(prefix, conf_dir, network_conf)
+        if not (ip and port):
+            continue
+        dimensions = get_base_dimensions()
+        dimensions["component"] = service
+        if snapshot.is_listening(service, ip, port):
+            metrics.append(MetricData.single(
+                'swiftlm.swift.swift_services.check_ip_port', Severity.ok,
+                message='OK', dimensions=dimensions))
+        else:
+            metrics.append(MetricData.single(
+                'swiftlm.swift.swift_services.check_ip_port', Severity.fail,
+                message='{component} is not listening on the correct ip or'
+                        ' port', dimensions=dimensions))
+
+    for service in services + ['rsync']:
+        # With SO_REUSEPORT there can be several sockets for one address
+        queues = {}
+        for l in snapshot.listeners(service):
+            queues[(l.ip, l.port)] = (queues.get((l.ip, l.port), 0) +
+                                      l.accept_queue)
+        for (ip, port), accept_queue in sorted(queues.items()):
+            c = BASE_RESULT.child(name='accept_queue',
+                                  dimensions={'component': service,
+                                              'listener': '%s:%d' % (ip,
+                                                                     port)},
+                                  msgkeys={'accept_queue': accept_queue})
+            c.value = accept_queue
+            c.message = 'accept_queue'
+            metrics.append(c)
+    return metrics
 
 
-def check_rsync():
+def check_rsync(snapshot=None):
     metrics = []
-    rsync_running, ip_port_match = get_rsync_bind_ip()
+    rsync_running, ip_port_match = get_rsync_bind_ip(snapshot)
     if not rsync_running:
         dimensions = get_base_dimensions()
         dimensions["component"] = "rsync"
@@ -158,7 +482,10 @@ def main():
     """Check that the relevant services are running."""
     metrics = []
 
-    metrics.extend(check_swift_processes())
-    metrics.extend(check_rsync())
+    snapshot = ProcessSnapshot()
+    metrics.extend(check_swift_processes(snapshot))
+    metrics.extend(check_service_resources(snapshot))
+    metrics.extend(check_rsync(snapshot))
+    metrics.extend(check_listeners(snapshot))
 
     return metrics
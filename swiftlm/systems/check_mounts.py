@@ -17,11 +17,10 @@
 
 from __future__ import print_function
 
-import grp
 from math import ceil as ceil
 import os
-import pwd
 import json
+import time
 from collections import namedtuple
 
 from swiftlm.utils.values import Severity
@@ -29,10 +28,33 @@ from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.utility import run_cmd
 from swiftlm.utils.utility import Aggregate, SwiftlmCheckFailure
 from swiftlm.utils.utility import get_swift_mount_point
+from swiftlm.utils.utility import get_mounts, get_labels
+from swiftlm.utils.utility import load_state, save_state
+from swiftlm.utils.utility import run_in_threads, get_diskusage_conf
+from swiftlm.utils.users import get_uid, get_gid, SWIFT_USER, SWIFT_GROUP
+from swiftlm.utils.users import get_user_name, get_group_name
 
 DEVICES = '/etc/ansible/facts.d/swift_drive_info.fact'
 LABEL_CHECK_DISABLED = '---NA---'
 
+# xfs_info results are reused for this many seconds, or until the
+# filesystem is remounted.
+XFS_INFO_STATE = 'check_mounts_xfs_info.json'
+XFS_INFO_TTL = 3600
+
+# Seconds to wait for the checks of a drive before reporting it as hung
+DRIVE_TIMEOUT = 10
+
+# The XFS free space summary (xfs_db freesp) reads the free space btrees so
+# it is only gathered every xfs_freesp_interval seconds (see [diskusage] in
+# swiftlm-scan.conf, 0 disables it). Free space in extents smaller than
+# FRAG_EXTENT_BYTES counts as fragmented.
+FREESP_STATE = 'diskusage_xfs_freesp.json'
+FRAG_EXTENT_BYTES = 1024 * 1024
+
+# Per drive values that are summarised as max, min and avg for the host
+AGGREGATED_KEYS = ('usage', 'inodes_usage', 'freesp_frag')
+
 Device = namedtuple('Device', ['device', 'mount', 'label'])
 
 MOUNT_PATH = get_swift_mount_point()
@@ -74,11 +96,63 @@ def get_devices():
     return devices
 
 
-def is_mounted(d, r):
-    return os.path.ismount(d.mount)
-
+class MountSnapshot(object):
+    """
+    The mount table, filesystem labels and xfs_info results for one run.
 
-def is_mounted_775(d, r):
+    The mount table is read once from /proc/self/mountinfo and labels are
+    read once from /dev/disk/by-label (or the blkid cache) so checking a
+    drive does not need to fork mount, grep or xfs_admin.
+    """
+    def __init__(self):
+        try:
+            self.mounts = get_mounts()
+        except IOError as err:
+            raise SwiftlmCheckFailure('Failure reading mount table: %s' % err)
+        self._labels = None
+        self.xfs_info = load_state(XFS_INFO_STATE)
+        self._xfs_info_changed = False
+
+    def mount_entry(self, d):
+        return self.mounts.get(os.path.normpath(d.mount))
+
+    def labels(self, d):
+        """Labels of the device mounted at d.mount and of d.device"""
+        if self._labels is None:
+            self._labels = get_labels()
+        devices = set([os.path.realpath(d.device)])
+        entry = self.mount_entry(d)
+        if entry is not None:
+            devices.add(os.path.realpath(entry.device))
+        return set(self._labels[dev] for dev in devices if dev in self._labels)
+
+    def xfs_info_ok(self, d):
+        entry = self.mount_entry(d)
+        mount_id = entry.mount_id if entry else None
+        now = time.time()
+        cached = self.xfs_info.get(d.mount)
+        if (cached and cached.get('mount_id') == mount_id and
+                0 <= now - cached.get('time', 0) < XFS_INFO_TTL):
+            return cached.get('ok')
+
+        rc = run_cmd('xfs_info %s' % d.mount)
+        self.xfs_info[d.mount] = {'mount_id': mount_id, 'time': now,
+                                  'ok': rc.exitcode == 0}
+        self._xfs_info_changed = True
+        return rc.exitcode == 0
+
+    def save(self):
+        if self._xfs_info_changed:
+            # Copy, a thread on a hung drive may still update the dict
+            save_state(XFS_INFO_STATE, self.xfs_info.copy())
+            self._xfs_info_changed = False
+
+
+def is_mounted(d, r, snapshot):
+    return snapshot.mount_entry(d) is not None
+
+
+def is_mounted_775(d, r, snapshot):
     # Take the last three digits of the octal repr of the permissions.
     perms = oct(os.stat(d.mount).st_mode)[-3:]
     if perms == '755':
@@ -88,47 +162,34 @@ def is_mounted_775(d, r):
         return False
 
 
-def is_ug_swift(d, r):
+def is_ug_swift(d, r, snapshot):
     """Checks mount point is owned by swift"""
     stats = os.stat(d.mount)
     uid = stats.st_uid
     gid = stats.st_gid
 
-    user = pwd.getpwuid(uid).pw_name
-    group = grp.getgrgid(gid).gr_name
-    if user == group == 'swift':
+    if uid == get_uid(SWIFT_USER) and gid == get_gid(SWIFT_GROUP):
         return True
     else:
-        r.msgkey('user', user)
-        r.msgkey('group', group)
+        r.msgkey('user', get_user_name(uid))
+        r.msgkey('group', get_group_name(gid))
         return False
 
 
-def is_valid_label(d, r):
+def is_valid_label(d, r, snapshot):
     if d.label == LABEL_CHECK_DISABLED:
         return True
 
-    rc = run_cmd('xfs_admin -l %s | grep -q %s' % (d.mount, d.label))
-    if rc.exitcode == 0:
-        return True
-    else:
-        return False
+    return d.label in snapshot.labels(d)
 
 
-def is_xfs(d, r):
-    rc = run_cmd('mount | grep -qE "%s.*xfs"' % d.mount)
-    if rc.exitcode == 0:
-        return True
-    else:
-        return False
+def is_xfs(d, r, snapshot):
+    entry = snapshot.mount_entry(d)
+    return entry is not None and entry.fstype == 'xfs'
 
 
-def is_valid_xfs(d, r):
-    rc = run_cmd('xfs_info %s' % d.mount)
-    if rc.exitcode == 0:
-        return True
-    else:
-        return False
+def is_valid_xfs(d, r, snapshot):
+    return snapshot.xfs_info_ok(d)
 
 
 BASE_RESULT = MetricData(
@@ -143,6 +204,9 @@ BASE_RESULT = MetricData(
                                   'label {label}'),
         is_xfs.__name__: '{device} mounted at {mount} is not XFS',
         is_valid_xfs.__name__: '{device} mounted at {mount} is corrupt',
+        'hung': ('{device} mounted at {mount} did not respond within'
+                 ' {timeout} seconds (hung)'),
+        'error': '{device} mounted at {mount} could not be checked: {error}',
         'ok': '{device} mounted at {mount} ok'
     }
 )
@@ -150,8 +214,33 @@ BASE_RESULT = MetricData(
 DISKUSAGE_RESULT = MetricData(name='diskusage.host', messages={})
 
 
-def check_mounts():
-    results = []
+def drive_failure(d, error=None):
+    """
+    :param error: the exception raised reading the drive, or None if the
+                  drive did not respond within DRIVE_TIMEOUT
+    :returns: a failed BASE_RESULT for the drive
+    """
+    result = BASE_RESULT.child(dimensions={'mount': d.mount},
+                               msgkeys={'device': d.device,
+                                        'label': d.label})
+    if error is None:
+        result.msgkey('timeout', DRIVE_TIMEOUT)
+        result.message = 'hung'
+    else:
+        result.msgkey('error', str(error) or error.__class__.__name__)
+        result.message = 'error'
+    result.value = Severity.fail
+    return result
+
+
+def check_mounts(hung=None):
+    """
+    Check each drive in its own thread.
+
+    :param hung: optional list. Devices that did not respond within
+                 DRIVE_TIMEOUT, or whose checks raised an error (e.g. EIO
+                 from a shut down filesystem), are appended to it.
+    """
     checks = (
         is_mounted,
         is_mounted_775,
@@ -165,20 +254,31 @@ def check_mounts():
         raise SwiftlmCheckFailure('No devices found to check. See %s' %
                                   DEVICES)
 
-    for d in devices:
+    snapshot = MountSnapshot()
+
+    def check_drive(d):
         result = BASE_RESULT.child(dimensions={'mount': d.mount},
                                    msgkeys={'device': d.device,
                                             'label': d.label})
         for check in checks:
-            if not check(d, result):
+            if not check(d, result, snapshot):
                 result.message = check.__name__
                 result.value = Severity.fail
                 break
         else:
             result.value = Severity.ok
+        return result
 
+    results = []
+    for d, done, result, error in run_in_threads(check_drive, devices,
+                                                 DRIVE_TIMEOUT):
+        if not done or error is not None:
+            result = drive_failure(d, error)
+            if hung is not None:
+                hung.append(d)
         results.append(result)
 
+    snapshot.save()
     return results
 
 
@@ -198,35 +298,132 @@ def get_diskusage(device):
         sizebytes = int(size * disk.f_frsize)
         usedbytes = int(used * disk.f_frsize)
         availbytes = int(avail * disk.f_frsize)
-        return {'size': sizebytes, 'used': usedbytes, 'avail': availbytes,
-                'usage': usedpercent}
+        usage = {'size': sizebytes, 'used': usedbytes, 'avail': availbytes,
+                 'usage': usedpercent}
+        # Some filesystems have no fixed number of inodes and report 0
+        if disk.f_files:
+            inodes_used = disk.f_files - disk.f_ffree
+            usage['inodes_used'] = int(inodes_used)
+            usage['inodes_free'] = int(disk.f_favail)
+            usage['inodes_usage'] = float(ceil(
+                100.0 * inodes_used / (inodes_used + disk.f_favail)))
+        return usage
     except IOError:
         return {}
 
 
-def diskusage():
+def parse_freesp(output):
+    """
+    Parses the output of "xfs_db -r -c 'sb 0' -c 'p blocksize' -c 'freesp -s'"
+
+        blocksize = 4096
+           from      to extents  blocks    pct
+              1       1      31      31   0.00
+              2       3      40     101   0.00
+        ...
+         524288 1048575       7 6418453  73.79
+        total free extents 182
+        total free blocks 8698130
+        average free extent size 47791.9
+
+    :returns: dictionary containing freesp_frag (% of free space in extents
+              smaller than FRAG_EXTENT_BYTES) and freesp_avg_extent (bytes),
+              or an empty dictionary if the output cannot be parsed
+    """
+    blocksize = None
+    avg_extent = None
+    small_pct = 0.0
+    histogram_found = False
+    for line in output.splitlines():
+        words = line.split()
+        if line.startswith('blocksize ='):
+            blocksize = int(words[-1])
+        elif line.startswith('average free extent size'):
+            avg_extent = float(words[-1])
+        elif len(words) == 5 and words[0].isdigit():
+            histogram_found = True
+            extent_end = (int(words[1]) + 1) * (blocksize or 0)
+            if blocksize and extent_end <= FRAG_EXTENT_BYTES:
+                small_pct += float(words[4])
+    if not blocksize or avg_extent is None or not histogram_found:
+        return {}
+    return {'freesp_frag': round(small_pct, 2),
+            'freesp_avg_extent': int(avg_extent * blocksize)}
+
+
+def get_freesp(device, state, interval):
+    """
+    Get the XFS free space summary of a drive, at most once per interval.
+
+    :param device: Device
+    :param state: dictionary of mount to last summary, updated in place
+    :param interval: seconds between runs of xfs_db on a drive
+    :returns: dictionary as returned by parse_freesp
+    """
+    now = time.time()
+    cached = state.get(device.mount)
+    if cached and 0 <= now - cached.get('time', 0) < interval:
+        return cached.get('freesp', {})
+
+    rc = run_cmd("xfs_db -r -c 'sb 0' -c 'p blocksize' -c 'freesp -s' %s"
+                 % device.device)
+    freesp = parse_freesp(rc.output) if rc.exitcode == 0 else {}
+    state[device.mount] = {'time': now, 'freesp': freesp}
+    return freesp
+
+
+def diskusage(skip=()):
+    """
+    Report the usage of each drive, each drive is read in its own thread.
+
+    :param skip: devices not to read, e.g. because they are known to be hung
+    """
     results = []
-    usage_aggr = Aggregate()
-    devices = get_devices()
-    for d in devices:
-        for key, value in get_diskusage(d).items():
+    aggregates = dict((key, Aggregate()) for key in AGGREGATED_KEYS)
+    devices = [d for d in get_devices() if d not in skip]
+
+    freesp_interval = get_diskusage_conf()['xfs_freesp_interval']
+    freesp_state = load_state(FREESP_STATE) if freesp_interval > 0 else {}
+
+    def drive_usage(d):
+        usage = get_diskusage(d)
+        if usage and freesp_interval > 0:
+            usage.update(get_freesp(d, freesp_state, freesp_interval))
+        return usage
+
+    for d, done, usage, error in run_in_threads(drive_usage, devices,
+                                                DRIVE_TIMEOUT):
+        if not done:
+            # Reported by check_mounts; leave it out of the aggregates
+            continue
+        if error is not None:
+            results.append(drive_failure(d, error))
+            continue
+        for key, value in usage.items():
             result = DISKUSAGE_RESULT.child(name='val.' + key,
                                             dimensions={'mount': d.mount},
                                             msgkeys={'device': d.device,
                                                      'label': d.label})
             result.value = value
             results.append(result)
-            if key == 'usage':
-                usage_aggr.add(value)
-    if usage_aggr.count:
-        result = DISKUSAGE_RESULT.child(name='max.usage')
-        result.value = usage_aggr.max
+            if key in aggregates:
+                aggregates[key].add(value)
+
+    if freesp_interval > 0:
+        save_state(FREESP_STATE, freesp_state.copy())
+
+    for key in AGGREGATED_KEYS:
+        aggr = aggregates[key]
+        if not aggr.count:
+            continue
+        result = DISKUSAGE_RESULT.child(name='max.' + key)
+        result.value = aggr.max
         results.append(result)
-        result = DISKUSAGE_RESULT.child(name='min.usage')
-        result.value = usage_aggr.min
+        result = DISKUSAGE_RESULT.child(name='min.' + key)
+        result.value = aggr.min
         results.append(result)
-        result = DISKUSAGE_RESULT.child(name='avg.usage')
-        result.value = usage_aggr.avg
+        result = DISKUSAGE_RESULT.child(name='avg.' + key)
+        result.value = aggr.avg
         results.append(result)
     return results
 
@@ -234,8 +431,9 @@ def diskusage():
 def main():
     """Checks the relevant swift mount points and diskusage"""
     results = []
-    results.extend(check_mounts())
-    results.extend(diskusage())
+    hung = []
+    results.extend(check_mounts(hung))
+    results.extend(diskusage(skip=hung))
     return results
 
 
@@ -0,0 +1,268 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+I/O rates, latency and utilisation of the swift drives.
+
+The kernel counters in /proc/diskstats are sampled once per run and the
+sample is kept in SWIFTLM_STATE_DIR, so the rates cover the time since the
+previous run. If there is no usable previous sample (the first run, after
+a reboot or after a long gap) a second sample is taken SAMPLE_INTERVAL
+seconds after the first.
+"""
+
+from __future__ import division
+
+import os
+import time
+from collections import namedtuple
+
+from swiftlm.utils.values import Severity
+from swiftlm.utils.metricdata import MetricData
+from swiftlm.utils.utility import Aggregate
+from swiftlm.utils.utility import load_state, save_state
+from swiftlm.systems.check_mounts import get_devices
+
+PROC_DISKSTATS = '/proc/diskstats'
+SYS_CLASS_BLOCK = '/sys/class/block'
+SECTOR_SIZE = 512
+
+DISKSTATS_STATE = 'diskstats.json'
+SAMPLE_INTERVAL = 1.0
+MAX_SAMPLE_AGE = 3600
+
+# A drive is an outlier if its await or utilisation is more than
+# OUTLIER_FACTOR times the median of the other drives on the node, and
+# above the floor for the metric (so that idle drives are not flagged)
+OUTLIER_FACTOR = 3.0
+OUTLIER_FLOORS = {'await': 20.0, 'util': 20.0}
+OUTLIER_MIN_DRIVES = 3
+
+RATE_KEYS = ('read_iops', 'write_iops', 'read_bytes_per_sec',
+             'write_bytes_per_sec', 'await', 'util', 'queue_depth')
+AGGREGATED_KEYS = ('await', 'util')
+
+DiskStats = namedtuple('DiskStats', [
+    'reads', 'read_sectors', 'read_ms', 'writes', 'write_sectors',
+    'write_ms', 'in_flight', 'io_ms', 'weighted_ms'])
+
+BASE_RESULT = MetricData(
+    name=__name__,
+    messages={
+        'ok': 'OK',
+        'outlier': ('{device} mounted at {mount} is slow: {key} of {value}'
+                    ' is over {factor} times the median of {median}'),
+    }
+)
+
+DISKSTATS_RESULT = MetricData(name='diskstats.host', messages={})
+
+
+def parse_stat_fields(fields):
+    """
+    :param fields: the counters of a device, as in /sys/block/<dev>/stat
+    :returns: DiskStats
+    """
+    f = [int(x) for x in fields[:11]]
+    return DiskStats(reads=f[0], read_sectors=f[2], read_ms=f[3],
+                     writes=f[4], write_sectors=f[6], write_ms=f[7],
+                     in_flight=f[8], io_ms=f[9], weighted_ms=f[10])
+
+
+def read_diskstats(names, proc_diskstats=None, sys_class_block=None):
+    """
+    Read the counters of the named devices.
+
+    All devices are read from /proc/diskstats in one go. A device that is
+    not there is read from its stat file in sysfs.
+
+    :param names: kernel names of the devices (e.g. sdb1)
+    :returns: dictionary of name to DiskStats
+    """
+    stats = {}
+    try:
+        with open(proc_diskstats or PROC_DISKSTATS) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 14 and fields[2] in names:
+                    stats[fields[2]] = parse_stat_fields(fields[3:])
+    except (IOError, ValueError):
+        pass
+    for name in names:
+        if name in stats:
+            continue
+        try:
+            with open(os.path.join(sys_class_block or SYS_CLASS_BLOCK,
+                                   name, 'stat')) as f:
+                stats[name] = parse_stat_fields(f.read().split())
+        except (IOError, ValueError, IndexError):
+            pass
+    return stats
+
+
+def kernel_name(device):
+    """
+    :param device: path of the device, e.g. /dev/sdb1 or a symlink to it
+    :returns: the kernel name of the device, e.g. sdb1
+    """
+    return os.path.basename(os.path.realpath(device))
+
+
+def counters_reset(old, new):
+    """
+    :returns: True if any counter has gone backwards, e.g. after a reboot
+    """
+    return any(n < o for field, n, o in zip(DiskStats._fields, new, old)
+               if field != 'in_flight')
+
+
+def io_rates(old, new, elapsed):
+    """
+    :param old: DiskStats from the previous sample
+    :param new: DiskStats from this sample
+    :param elapsed: seconds between the samples
+    :returns: dictionary of RATE_KEYS, or None if the counters have gone
+              backwards (e.g. the device was reset)
+    """
+    if counters_reset(old, new):
+        return None
+    delta = DiskStats(*[n - o for n, o in zip(new, old)])
+    ios = delta.reads + delta.writes
+    return {
+        'read_iops': round(delta.reads / elapsed, 2),
+        'write_iops': round(delta.writes / elapsed, 2),
+        'read_bytes_per_sec': int(delta.read_sectors * SECTOR_SIZE /
+                                  elapsed),
+        'write_bytes_per_sec': int(delta.write_sectors * SECTOR_SIZE /
+                                   elapsed),
+        # Milliseconds per request, including time queued
+        'await': round((delta.read_ms + delta.write_ms) / ios, 2)
+        if ios else 0.0,
+        'util': round(min(100.0, delta.io_ms / (elapsed * 10.0)), 2),
+        'queue_depth': round(delta.weighted_ms / (elapsed * 1000.0), 2),
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def find_outliers(rates):
+    """
+    :param rates: dictionary of device to dictionary of RATE_KEYS
+    :returns: dictionary of device to (key, value, median) for the drives
+              that are much slower than their peers. The median is of the
+              other drives, so that a slow drive does not raise it.
+    """
+    outliers = {}
+    if len(rates) < OUTLIER_MIN_DRIVES:
+        return outliers
+    for key in sorted(OUTLIER_FLOORS):
+        for device, r in rates.items():
+            if device in outliers:
+                continue
+            mid = median([other[key] for d, other in rates.items()
+                          if d != device])
+            if (r[key] > OUTLIER_FLOORS[key] and
+                    r[key] > OUTLIER_FACTOR * mid):
+                outliers[device] = (key, r[key], mid)
+    return outliers
+
+
+def sample(names, state):
+    """
+    Take a sample of the counters, and a second one if the saved sample
+    cannot be used.
+
+    :param names: kernel names of the devices
+    :param state: the saved sample
+    :returns: (old, new, elapsed) where old and new are dictionaries of
+              name to DiskStats
+    """
+    now = time.time()
+    new = read_diskstats(names)
+    old = dict((name, DiskStats(*stats))
+               for name, stats in state.get('stats', {}).items())
+    elapsed = now - state.get('time', now)
+    if (not 0 < elapsed <= MAX_SAMPLE_AGE or not set(new) <= set(old) or
+            any(counters_reset(old[name], new[name]) for name in new)):
+        old = new
+        time.sleep(SAMPLE_INTERVAL)
+        now = time.time()
+        new = read_diskstats(names)
+        elapsed = SAMPLE_INTERVAL
+    save_state(DISKSTATS_STATE, {'time': now, 'stats': dict(
+        (name, list(stats)) for name, stats in new.items())})
+    return old, new, elapsed
+
+
+def main():
+    """Report I/O rates, latency and utilisation of the swift drives"""
+    devices = get_devices()
+    names = dict((d, kernel_name(d.device)) for d in devices)
+    old, new, elapsed = sample(set(names.values()),
+                               load_state(DISKSTATS_STATE))
+
+    rates = {}
+    for d in devices:
+        name = names[d]
+        if name in new and name in old:
+            r = io_rates(old[name], new[name], elapsed)
+            if r is not None:
+                rates[d] = r
+
+    results = []
+    aggregates = dict((key, Aggregate()) for key in AGGREGATED_KEYS)
+    outliers = find_outliers(rates)
+    for d in devices:
+        if d not in rates:
+            continue
+        for key in RATE_KEYS:
+            result = DISKSTATS_RESULT.child(name='val.' + key,
+                                            dimensions={'mount': d.mount},
+                                            msgkeys={'device': d.device,
+                                                     'label': d.label})
+            result.value = rates[d][key]
+            results.append(result)
+            if key in aggregates:
+                aggregates[key].add(rates[d][key])
+
+        msgkeys = {'device': d.device}
+        if d in outliers:
+            key, value, mid = outliers[d]
+            msgkeys.update({'key': key, 'value': value, 'median': mid,
+                            'factor': OUTLIER_FACTOR})
+        result = BASE_RESULT.child(dimensions={'mount': d.mount},
+                                   msgkeys=msgkeys)
+        if d in outliers:
+            result.message = 'outlier'
+            result.value = Severity.warn
+        else:
+            result.value = Severity.ok
+        results.append(result)
+
+    for key in AGGREGATED_KEYS:
+        aggr = aggregates[key]
+        if not aggr.count:
+            continue
+        for stat in ('max', 'min', 'avg'):
+            result = DISKSTATS_RESULT.child(name='%s.%s' % (stat, key))
+            result.value = getattr(aggr, stat)
+            results.append(result)
+    return results
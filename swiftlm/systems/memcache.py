@@ -0,0 +1,298 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Health of the memcache servers used by the proxy servers.
+
+The stats and stats slabs output of each server in memcache.conf is read
+with the memcached text protocol. The counters are kept in
+SWIFTLM_STATE_DIR so that the hit ratio and eviction rate cover the time
+since the previous run. On the first run, or after memcached restarts, the
+hit ratio is over the life of the server and no eviction rate is reported.
+
+The share of a sample keyspace that MemcacheRing sends to each server
+shows how evenly the ring spreads keys over the servers.
+"""
+
+from __future__ import division
+
+import os
+import socket
+import time
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+from swift.common.memcached import MemcacheRing
+
+from swiftlm.utils.memcache import ring_server
+from swiftlm.utils.metricdata import MetricData, get_base_dimensions
+from swiftlm.utils.values import Severity, ServerType
+from swiftlm.utils.utility import server_type, run_in_threads
+from swiftlm.utils.utility import load_state, save_state
+
+MEMCACHE_CONF_PATH = '/etc/swift'
+DEFAULT_PORT = '11211'
+STATS_TIMEOUT = 2.0
+MEMCACHE_STATE = 'memcache_stats.json'
+MAX_SAMPLE_AGE = 3600
+SAMPLE_KEYS = 10000
+
+# Counters kept between runs
+SNAPSHOT_KEYS = ('pid', 'uptime', 'get_hits', 'get_misses', 'evictions')
+VALUE_KEYS = ('hit_ratio', 'evictions_per_sec', 'curr_connections',
+              'curr_items', 'bytes', 'limit_maxbytes', 'bytes_used_pct',
+              'active_slabs', 'total_malloced')
+
+# Like connectivity, report the observer and the server rather than the
+# normal hostname dimension
+_base_dimensions = dict(get_base_dimensions())
+_base_dimensions['observer_host'] = socket.gethostname()
+_base_dimensions['hostname'] = '_'
+
+BASE_RESULT = MetricData(
+    name=__name__,
+    messages={
+        'ok': '{url} ok',
+        'fail': '{url} {error}',
+        'evicting': ('{url} is evicting {evictions_per_sec} items per second'
+                     ' with {bytes_used_pct}% of memory used'),
+    },
+    dimensions=_base_dimensions
+)
+
+MEMCACHE_RESULT = MetricData(name='memcache.server', messages={},
+                             dimensions=_base_dimensions)
+RING_RESULT = MetricData(name='memcache.ring', messages={},
+                         dimensions=_base_dimensions)
+
+
+def get_memcache_servers(conf_path=None):
+    """
+    :returns: list of host:port of the servers in memcache.conf
+    """
+    cp = configparser.ConfigParser()
+    cp.read(os.path.join(conf_path or MEMCACHE_CONF_PATH, 'memcache.conf'))
+    try:
+        servers = cp.get('memcache', 'memcache_servers')
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return []
+    result = []
+    for server in servers.split(','):
+        server = server.strip()
+        if not server:
+            continue
+        if not server.rsplit(':', 1)[-1].isdigit():
+            server = '%s:%s' % (server, DEFAULT_PORT)
+        result.append(server)
+    return result
+
+
+def number(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_stats(text):
+    """
+    Parse the reply to a stats command, e.g.
+
+        STAT pid 1234
+        STAT 1:chunk_size 96
+        END
+
+    :returns: dictionary of name to value (an int or float where possible)
+    :raises ValueError: if memcached returned an error
+    """
+    stats = {}
+    for line in text.splitlines():
+        fields = line.split(' ', 2)
+        if fields[0] == 'STAT' and len(fields) == 3:
+            stats[fields[1]] = number(fields[2])
+        elif fields[0] in ('ERROR', 'CLIENT_ERROR', 'SERVER_ERROR'):
+            raise ValueError(line)
+    return stats
+
+
+def read_stats(server, commands=('stats', 'stats slabs'), timeout=None):
+    """
+    Send each command to a memcached server and parse the replies.
+
+    :param server: host:port
+    :returns: list of dictionaries, one for each command
+    :raises socket.error, ValueError: if the server does not answer
+    """
+    host, port = server.rsplit(':', 1)
+    sock = socket.create_connection((host.strip('[]'), int(port)),
+                                    timeout or STATS_TIMEOUT)
+    try:
+        replies = []
+        for command in commands:
+            sock.sendall(command + '\r\n')
+            data = ''
+            while not data.endswith('END\r\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise ValueError('Connection closed')
+                data += chunk
+                if data.endswith('ERROR\r\n'):
+                    break
+            replies.append(parse_stats(data))
+        return replies
+    finally:
+        sock.close()
+
+
+def usable_snapshot(old, stats, elapsed):
+    """
+    :returns: True if the counters of the previous run can be compared with
+              these, i.e. memcached has not restarted in between
+    """
+    return (bool(old) and 0 < elapsed <= MAX_SAMPLE_AGE and
+            old.get('pid') == stats.get('pid') and
+            old.get('uptime', 0) <= stats.get('uptime', 0) and
+            all(old.get(key, 0) <= stats.get(key, 0)
+                for key in ('get_hits', 'get_misses', 'evictions')))
+
+
+def server_values(stats, slabs, old, elapsed):
+    """
+    :param stats: the reply to stats
+    :param slabs: the reply to stats slabs
+    :param old: the counters of this server from the previous run, or {}
+    :param elapsed: seconds since the previous run
+    :returns: dictionary of the VALUE_KEYS that can be worked out
+    """
+    if not usable_snapshot(old, stats, elapsed):
+        old = {}
+    hits = stats.get('get_hits', 0) - old.get('get_hits', 0)
+    misses = stats.get('get_misses', 0) - old.get('get_misses', 0)
+    values = {}
+    if hits + misses:
+        values['hit_ratio'] = round(hits / (hits + misses), 4)
+    if old:
+        values['evictions_per_sec'] = round(
+            (stats.get('evictions', 0) - old['evictions']) / elapsed, 3)
+    for key in ('curr_connections', 'curr_items', 'bytes',
+                'limit_maxbytes'):
+        if key in stats:
+            values[key] = stats[key]
+    if stats.get('limit_maxbytes'):
+        values['bytes_used_pct'] = round(
+            100.0 * stats.get('bytes', 0) / stats['limit_maxbytes'], 2)
+    for key in ('active_slabs', 'total_malloced'):
+        if key in slabs:
+            values[key] = slabs[key]
+    return values
+
+
+def key_distribution(servers, sample_size=SAMPLE_KEYS):
+    """
+    :returns: dictionary of server to the fraction of a sample keyspace
+              that MemcacheRing sends to it
+    """
+    ring = MemcacheRing(servers)
+    counts = dict((server, 0) for server in servers)
+    for n in range(sample_size):
+        counts[ring_server(ring, 'swiftlm-sample-%d' % n)] += 1
+    return dict((server, count / sample_size)
+                for server, count in counts.items())
+
+
+def check_servers(servers):
+    """
+    Read the stats of each server, in parallel.
+
+    :returns: dictionary of server to ([stats, slabs], None) or
+              (None, error message)
+    """
+    def read(server):
+        try:
+            return read_stats(server), None
+        except (socket.error, socket.timeout, ValueError) as err:
+            return None, str(err) or err.__class__.__name__
+
+    replies = {}
+    for r in run_in_threads(read, servers, STATS_TIMEOUT * 3):
+        if r.error is not None:
+            replies[r.item] = (None, str(r.error) or
+                               r.error.__class__.__name__)
+        elif r.done:
+            replies[r.item] = r.value
+        else:
+            replies[r.item] = (None, 'stats did not complete')
+    return replies
+
+
+def main():
+    """Report the health of the memcache servers and ring"""
+    if not server_type(ServerType.proxy):
+        return []
+    servers = get_memcache_servers()
+    if not servers:
+        return []
+
+    now = time.time()
+    state = load_state(MEMCACHE_STATE)
+    elapsed = now - state.get('time', now)
+    snapshots = state.get('servers', {})
+    new_snapshots = {}
+    results = []
+    for server, (reply, error) in sorted(check_servers(servers).items()):
+        status = BASE_RESULT.child(dimensions={'url': server})
+        if reply is None:
+            status.msgkey('error', error)
+            status.value = Severity.fail
+            results.append(status)
+            continue
+        stats, slabs = reply
+        values = server_values(stats, slabs, snapshots.get(server, {}),
+                               elapsed)
+        new_snapshots[server] = dict((key, stats.get(key))
+                                     for key in SNAPSHOT_KEYS)
+        for key in VALUE_KEYS:
+            if key not in values:
+                continue
+            result = MEMCACHE_RESULT.child(name='val.' + key,
+                                           dimensions={'url': server})
+            result.value = values[key]
+            results.append(result)
+
+        if values.get('evictions_per_sec', 0) > 0:
+            status.msgkey('evictions_per_sec', values['evictions_per_sec'])
+            status.msgkey('bytes_used_pct', values.get('bytes_used_pct'))
+            status.message = 'evicting'
+            status.value = Severity.warn
+        else:
+            status.value = Severity.ok
+        results.append(status)
+    save_state(MEMCACHE_STATE, {'time': now, 'servers': new_snapshots})
+
+    shares = key_distribution(servers)
+    for server, share in sorted(shares.items()):
+        result = RING_RESULT.child(name='val.key_share',
+                                   dimensions={'url': server})
+        result.value = round(share, 4)
+        results.append(result)
+    result = RING_RESULT.child(name='max.imbalance')
+    result.value = round(max(shares.values()) * len(shares), 3)
+    results.append(result)
+    return results
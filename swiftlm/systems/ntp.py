@@ -1,4 +1,3 @@
-
 # (c) Copyright 2015 Hewlett Packard Enterprise Development LP
 # (c) Copyright 2017 SUSE LLC
 #
@@ -15,103 +14,328 @@
 # under the License.
 #
 
+"""
+Time synchronisation, read without forking ntpq or systemctl.
+
+The kernel clock discipline is read with adjtimex(2); that works whether
+ntpd, chronyd or neither is running. If ntpd or chronyd answers on its
+control port on localhost the stratum and the daemon's view of the
+offset are read from it too: ntpd with a mode 6 read variables request
+(as ntpq -c rv), chronyd with a cmdmon tracking request (as chronyc
+tracking).
+
+The offsets of the last few runs are kept in SWIFTLM_STATE_DIR and the
+drift rate is the slope of a least squares fit through them.
+"""
+
+from __future__ import division
 
-import re
+import ctypes
+import ctypes.util
+import socket
+import struct
+import time
 
-from swiftlm.utils.metricdata import MetricData, CheckFailure
+from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.values import Severity
-from swiftlm.utils.utility import run_cmd
+from swiftlm.utils.utility import load_state, save_state
+
+NTP_STATE = 'ntp_offsets.json'
+HISTORY_SIZE = 12
+HISTORY_AGE = 86400
+CONTROL_TIMEOUT = 1.0
+
+NTPD_ADDRESS = ('127.0.0.1', 123)
+CHRONYD_ADDRESS = ('127.0.0.1', 323)
+
+# adjtimex
+TIME_ERROR = 5
+STA_UNSYNC = 0x0040
+STA_NANO = 0x2000
+
+# ntpd mode 6 (control) messages
+NTP_CONTROL_HEADER = struct.Struct('!BBHHHHH')
+NTP_CONTROL_VERSION_MODE = (2 << 3) | 6
+NTP_CONTROL_READVAR = 2
+NTP_CONTROL_RESPONSE = 0x80
+NTP_CONTROL_ERROR = 0x40
+NTP_CONTROL_MORE = 0x20
+
+# chronyd cmdmon messages (protocol version 6)
+CHRONY_REQUEST_HEADER = struct.Struct('!BBBBHHIII')
+CHRONY_REPLY_HEADER = struct.Struct('!BBBBHHHHHHIII')
+CHRONY_TRACKING = struct.Struct('!I16sHHHHIII9I')
+CHRONY_VERSION = 6
+CHRONY_REQUEST = 1
+CHRONY_REPLY = 2
+CHRONY_REQ_TRACKING = 33
+CHRONY_RPY_TRACKING = 5
+CHRONY_STT_SUCCESS = 0
+CHRONY_TRACKING_REPLY_SIZE = CHRONY_REPLY_HEADER.size + CHRONY_TRACKING.size
 
 BASE_RESULT = MetricData(
     name=__name__,
     messages={
         'ok': 'OK',
-        'fail': 'ntpd not running: {error}',
+        'fail': 'Clock not synchronised: {error}',
     }
 )
 
 
-def check_status():
-    cmd_result = run_cmd('systemctl status ntp')
-    r = BASE_RESULT.child()
+class Timex(ctypes.Structure):
+    """struct timex from sys/timex.h"""
+    _fields_ = [
+        ('modes', ctypes.c_uint),
+        ('offset', ctypes.c_long),
+        ('freq', ctypes.c_long),
+        ('maxerror', ctypes.c_long),
+        ('esterror', ctypes.c_long),
+        ('status', ctypes.c_int),
+        ('constant', ctypes.c_long),
+        ('precision', ctypes.c_long),
+        ('tolerance', ctypes.c_long),
+        ('time_sec', ctypes.c_long),
+        ('time_usec', ctypes.c_long),
+        ('tick', ctypes.c_long),
+        ('ppsfreq', ctypes.c_long),
+        ('jitter', ctypes.c_long),
+        ('shift', ctypes.c_int),
+        ('stabil', ctypes.c_long),
+        ('jitcnt', ctypes.c_long),
+        ('calcnt', ctypes.c_long),
+        ('errcnt', ctypes.c_long),
+        ('stbcnt', ctypes.c_long),
+        ('tai', ctypes.c_int),
+        ('reserved', ctypes.c_int * 11),
+    ]
 
-    if cmd_result.exitcode != 0:
-        r['error'] = cmd_result.output
-        r.value = Severity.fail
-    else:
-        r.value = Severity.ok
-
-    return [r]
-
-
-def check_details():
-    """
-    Parses ntp data in the form:
-
-        remote           refid   st t when poll reach   delay   offset  jitter
-    ===========================================================================
-    bindcat.fhsu.ed .INIT.       16 u    - 1024    0    0.000    0.000   0.000
-    origin.towfowi. .INIT.       16 u    - 1024    0    0.000    0.000   0.000
-    time-b.nist.gov .INIT.       16 u    - 1024    0    0.000    0.000   0.000
-    services.quadra .INIT.       16 u    - 1024    0    0.000    0.000   0.000
-    associd=0 status=c011 leap_alarm, sync_unspec, 1 event, freq_not_set,
-    version="ntpd 4.2.6p5@1.2349-o Fri Apr 10 19:04:04 UTC 2015 (1)",
-    processor="x86_64", system="Linux/3.14.44-1-amd64-hlinux", leap=11,
-    stratum=16, precision=-23, rootdelay=0.000, rootdisp=26.340, refid=INIT,
-    reftime=00000000.00000000  Mon, Jan  1 1900  0:00:00.000,
-    clock=d94f932a.13f33874  Tue, Jul 14 2015 13:54:50.077, peer=0, tc=3,
-    mintc=3, offset=0.000, frequency=0.000, sys_jitter=0.000,
-    clk_jitter=0.000, clk_wander=0.000
-    """
-    results = []
-    cmd_result = run_cmd('ntpq -pcrv')
-
-    if cmd_result.exitcode != 0:
-        failed = CheckFailure.child(
-            dimensions={
-                'check': BASE_RESULT.name,
-                'error': cmd_result.output,
-            }
-        )
-        failed.value = Severity.fail
-        return [failed]
-
-    results.append(check_ntpq_fact(cmd_result, 'stratum'))
-    results.append(check_ntpq_fact(cmd_result, 'offset'))
 
-    return results
+def read_adjtimex():
+    """
+    Read the kernel clock state. modes is 0, so nothing is changed.
+
+    :returns: dictionary of the clock state; offset, estimated_error and
+              max_error are in milliseconds, frequency in ppm
+    :raises OSError: if adjtimex fails
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    tx = Timex()
+    state = libc.adjtimex(ctypes.byref(tx))
+    if state < 0:
+        raise OSError(ctypes.get_errno(), 'adjtimex failed')
+    offset_scale = 1e6 if tx.status & STA_NANO else 1e3
+    return {
+        'synchronised': state != TIME_ERROR and
+        not tx.status & STA_UNSYNC,
+        'offset': tx.offset / offset_scale,
+        'frequency': tx.freq / 65536.0,
+        'estimated_error': tx.esterror / 1e3,
+        'max_error': tx.maxerror / 1e3,
+    }
 
 
-def check_ntpq_fact(cmd_result, fact_name):
-    fact_result = BASE_RESULT.child(fact_name)
-
-    # This regex will pick out the value after a fact. e.g
-    #   stratum=16,
-    # will match and the value '16' will be stored in 'match.groups()[0]'.
-    # If output does not match the regex 'match' will be None.
-    fact_regex = re.compile(fact_name+'=(.*?),')
-
-    match = fact_regex.search(cmd_result.output)
-    if match is None:
-        failed = CheckFailure.child(
-            dimensions={
-                'check': fact_result.name,
-                'error': 'Output does not contain "%s"' % fact_name,
-            }
-        )
-        failed.value = Severity.fail
-        return failed
-    else:
-        fact_level = match.groups()[0]
-        fact_result.value = fact_level
+def _query(address, request):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(CONTROL_TIMEOUT)
+        sock.connect(address)
+        sock.send(request)
+        while True:
+            yield sock.recv(4096)
+    finally:
+        sock.close()
 
-    return fact_result
 
+def parse_ntpd_variables(text):
+    """
+    Parse the variables in a read variables response, e.g.
 
-def main():
-    """Checks that ntp is running on the server."""
-    results = []
-    results.extend(check_status())
-    results.extend(check_details())
+        version="ntpd 4.2.8p10", leap=00, stratum=2, precision=-23,
+        rootdelay=1.612, rootdisp=21.542, refid=10.1.1.1, offset=0.123,
+        frequency=-12.345, sys_jitter=0.081, clk_jitter=0.054
+
+    :returns: dictionary of name to value (as a string)
+    """
+    variables = {}
+    for item in text.replace('\r\n', ' ').split(','):
+        name, sep, value = item.partition('=')
+        if sep:
+            variables[name.strip()] = value.strip().strip('"')
+    return variables
+
+
+def query_ntpd(address=NTPD_ADDRESS):
+    """
+    Read the system variables of ntpd.
+
+    :returns: dictionary with stratum, offset (milliseconds) and frequency
+              (ppm)
+    :raises socket.error, ValueError: if ntpd does not answer
+    """
+    sequence = 1
+    request = NTP_CONTROL_HEADER.pack(NTP_CONTROL_VERSION_MODE,
+                                      NTP_CONTROL_READVAR, sequence, 0, 0,
+                                      0, 0)
+    fragments = {}
+    # Fragments can arrive in any order; the last has the more bit clear
+    length = None
+    for packet in _query(address, request):
+        if len(packet) < NTP_CONTROL_HEADER.size:
+            raise ValueError('Short response')
+        _, op, seq, _, _, offset, count = NTP_CONTROL_HEADER.unpack_from(
+            packet)
+        if seq != sequence or not op & NTP_CONTROL_RESPONSE:
+            continue
+        if op & NTP_CONTROL_ERROR:
+            raise ValueError('ntpd returned an error')
+        data = packet[NTP_CONTROL_HEADER.size:NTP_CONTROL_HEADER.size + count]
+        fragments[offset] = data.decode('ascii', 'replace')
+        if not op & NTP_CONTROL_MORE:
+            length = offset + count
+        if length == sum(len(f) for f in fragments.values()):
+            break
+    variables = parse_ntpd_variables(
+        ''.join(fragments[offset] for offset in sorted(fragments)))
+    return {'stratum': int(variables['stratum']),
+            'offset': float(variables['offset']),
+            'frequency': float(variables['frequency'])}
+
+
+def chrony_float(value):
+    """
+    Convert chrony's network float: a 7 bit exponent and 25 bit
+    coefficient, both signed.
+    """
+    exp = value >> 25
+    if exp >= 1 << 6:
+        exp -= 1 << 7
+    coef = value & ((1 << 25) - 1)
+    if coef >= 1 << 24:
+        coef -= 1 << 25
+    return coef * 2.0 ** (exp - 25)
+
+
+def query_chronyd(address=CHRONYD_ADDRESS):
+    """
+    Read the tracking report of chronyd.
+
+    :returns: dictionary with stratum, offset (milliseconds) and frequency
+              (ppm)
+    :raises socket.error, ValueError: if chronyd does not answer
+    """
+    sequence = int(time.time()) & 0xffffffff
+    request = CHRONY_REQUEST_HEADER.pack(CHRONY_VERSION, CHRONY_REQUEST, 0,
+                                         0, CHRONY_REQ_TRACKING, 0,
+                                         sequence, 0, 0)
+    # chronyd ignores requests shorter than the reply
+    request += b'\0' * (CHRONY_TRACKING_REPLY_SIZE - len(request))
+    for packet in _query(address, request):
+        if len(packet) < CHRONY_TRACKING_REPLY_SIZE:
+            continue
+        (version, pkt_type, _, _, _, reply, status, _, _, _, seq, _,
+         _) = CHRONY_REPLY_HEADER.unpack_from(packet)
+        if pkt_type != CHRONY_REPLY or seq != sequence:
+            continue
+        if reply != CHRONY_RPY_TRACKING or status != CHRONY_STT_SUCCESS:
+            raise ValueError('chronyd returned status %d' % status)
+        fields = CHRONY_TRACKING.unpack_from(packet, CHRONY_REPLY_HEADER.size)
+        floats = [chrony_float(f) for f in fields[-9:]]
+        # current_correction is the offset in seconds that chronyd is
+        # slewing out; like the ntpd offset, positive means the clock is
+        # slow
+        return {'stratum': fields[4],
+                'offset': floats[0] * 1000.0,
+                'frequency': floats[3]}
+
+
+def query_daemon():
+    """
+    :returns: (name, dictionary) from the first of ntpd and chronyd to
+              answer, or (None, {}) if neither does
+    """
+    for name, query in (('ntpd', query_ntpd), ('chronyd', query_chronyd)):
+        try:
+            return name, query()
+        except (socket.error, ValueError, KeyError, struct.error):
+            continue
+    return None, {}
+
+
+def drift_rate(history):
+    """
+    :param history: list of [time, offset in milliseconds]
+    :returns: the least squares slope in milliseconds per hour, or None if
+              there are fewer than two points
+    """
+    if len(history) < 2:
+        return None
+    n = len(history)
+    mean_t = sum(t for t, _ in history) / n
+    mean_o = sum(o for _, o in history) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in history)
+    if not var_t:
+        return None
+    cov = sum((t - mean_t) * (o - mean_o) for t, o in history)
+    return cov / var_t * 3600
 
+
+def update_history(offset, now):
+    """
+    Add an offset to the saved history.
+
+    :returns: the history, oldest first
+    """
+    history = [entry for entry in load_state(NTP_STATE).get('history', [])
+               if 0 <= now - entry[0] < HISTORY_AGE]
+    history.append([now, offset])
+    history = history[-HISTORY_SIZE:]
+    save_state(NTP_STATE, {'history': history})
+    return history
+
+
+def check_sync():
+    """
+    Report whether the clock is synchronised, its offset and error, and
+    the rate at which the offset is drifting.
+    """
+    try:
+        clock = read_adjtimex()
+    except (OSError, AttributeError, TypeError) as err:
+        status = BASE_RESULT.child(msgkeys={'error': 'adjtimex failed: %s'
+                                            % err})
+        status.value = Severity.fail
+        return [status]
+
+    daemon, tracking = query_daemon()
+    if clock['synchronised']:
+        status = BASE_RESULT.child()
+        status.value = Severity.ok
+    else:
+        if daemon:
+            error = '%s is not synchronised to a server' % daemon
+        else:
+            error = 'no ntpd or chronyd is answering'
+        status = BASE_RESULT.child(msgkeys={'error': error})
+        status.value = Severity.fail
+    results = [status]
+
+    offset = tracking.get('offset', clock['offset'])
+    values = {'offset': offset,
+              'frequency': tracking.get('frequency', clock['frequency']),
+              'estimated_error': clock['estimated_error'],
+              'max_error': clock['max_error'],
+              'stratum': tracking.get('stratum')}
+    values['drift_rate'] = drift_rate(update_history(offset, time.time()))
+    for key in ('stratum', 'offset', 'frequency', 'estimated_error',
+                'max_error', 'drift_rate'):
+        if values[key] is None:
+            continue
+        r = BASE_RESULT.child(key)
+        r.value = round(values[key], 3)
+        results.append(r)
     return results
+
+
+def main():
+    """Checks that the clock is synchronised."""
+    return check_sync()
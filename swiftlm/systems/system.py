@@ -16,16 +16,45 @@
 #
 
 
+from __future__ import division
+
+import os
 import re
+import time
 
 from swiftlm.utils.metricdata import MetricData, CheckFailure
 from swiftlm.utils.values import Severity
 from swiftlm.utils.utility import run_cmd
+from swiftlm.utils.utility import load_state, save_state
+
+# Counters are read from PROC on each run and kept in SYSTEM_STATE; rates
+# and percentages cover the time since the previous run. Nothing is
+# reported for them on the first run.
+PROC = '/proc'
+SYSTEM_STATE = 'system.json'
+
+CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq',
+              'steal')
+CPU_METRICS = ('user', 'system', 'iowait', 'steal')
+MEMINFO_BYTES = (('Cached', 'cached_bytes'), ('Dirty', 'dirty_bytes'),
+                 ('Writeback', 'writeback_bytes'))
+PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
+NET_DEV_FIELDS = ('rx_bytes', 'rx_packets', 'rx_errors', 'rx_drops',
+                  'rx_fifo', 'rx_frame', 'rx_compressed', 'rx_multicast',
+                  'tx_bytes', 'tx_packets', 'tx_errors', 'tx_drops')
+NET_METRICS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets',
+               'rx_errors', 'tx_errors', 'rx_drops', 'tx_drops')
+TCP_FIELDS = ('OutSegs', 'RetransSegs', 'InErrs')
 
 BASE_RESULT = MetricData(
     name='load.host',
     messages={}
 )
+CPU_RESULT = MetricData(name='cpu.host', messages={})
+MEMORY_RESULT = MetricData(name='memory.host', messages={})
+PRESSURE_RESULT = MetricData(name='pressure.host', messages={})
+NET_RESULT = MetricData(name='net.host', messages={})
+TCP_RESULT = MetricData(name='tcp.host', messages={})
 
 
 def _get_proc_file(path):
@@ -39,8 +68,219 @@ def get_load_average():
     return [r]
 
 
+def parse_stat(text):
+    """
+    :returns: dictionary of CPU_FIELDS to jiffies, from the cpu line of
+              /proc/stat
+    """
+    for line in text.splitlines():
+        fields = line.split()
+        if fields and fields[0] == 'cpu':
+            return dict(zip(CPU_FIELDS, [int(v) for v in fields[1:9]]))
+    return {}
+
+
+def parse_meminfo(text):
+    """
+    :returns: dictionary of /proc/meminfo field to value in bytes
+    """
+    meminfo = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        value = int(fields[1])
+        if len(fields) > 2 and fields[2] == 'kB':
+            value *= 1024
+        meminfo[fields[0].rstrip(':')] = value
+    return meminfo
+
+
+def parse_pressure(text):
+    """
+    :returns: dictionary of 'some' and 'full' to the total stall time in
+              microseconds, from a /proc/pressure file
+    """
+    pressure = {}
+    for line in text.splitlines():
+        fields = line.split()
+        for field in fields[1:]:
+            if field.startswith('total='):
+                pressure[fields[0]] = int(field[len('total='):])
+    return pressure
+
+
+def parse_net_dev(text):
+    """
+    :returns: dictionary of interface to dictionary of NET_DEV_FIELDS
+    """
+    interfaces = {}
+    for line in text.splitlines()[2:]:
+        name, _, counters = line.partition(':')
+        name = name.strip()
+        if not counters or name == 'lo':
+            continue
+        interfaces[name] = dict(zip(NET_DEV_FIELDS,
+                                    [int(v) for v in counters.split()]))
+    return interfaces
+
+
+def parse_snmp_tcp(text):
+    """
+    :returns: dictionary of TCP_FIELDS from /proc/net/snmp. The Tcp lines
+              are a header line followed by a line of values.
+    """
+    lines = [line.split() for line in text.splitlines()
+             if line.startswith('Tcp:')]
+    if len(lines) < 2:
+        return {}
+    tcp = dict(zip(lines[0][1:], lines[1][1:]))
+    return dict((k, int(tcp[k])) for k in TCP_FIELDS if k in tcp)
+
+
+def read_snapshot(proc=None):
+    """
+    Read the counters from /proc, each file once.
+
+    Files that are not there (e.g. /proc/pressure before Linux 4.20) are
+    left out.
+
+    :returns: JSON serialisable dictionary
+    """
+    proc = proc or PROC
+    snapshot = {'time': time.time()}
+    for key, path, parse in (('cpu', 'stat', parse_stat),
+                             ('meminfo', 'meminfo', parse_meminfo),
+                             ('net', 'net/dev', parse_net_dev),
+                             ('tcp', 'net/snmp', parse_snmp_tcp)):
+        try:
+            snapshot[key] = parse(_get_proc_file(os.path.join(proc, path)))
+        except (IOError, OSError, ValueError):
+            pass
+    pressure = {}
+    for resource in PRESSURE_RESOURCES:
+        try:
+            pressure[resource] = parse_pressure(_get_proc_file(
+                os.path.join(proc, 'pressure', resource)))
+        except (IOError, OSError, ValueError):
+            pass
+    if pressure:
+        snapshot['pressure'] = pressure
+    return snapshot
+
+
+def _deltas(old, new, keys):
+    """
+    :returns: dictionary of key to the growth of the counter, or None if
+              any counter has gone backwards (e.g. after a reboot)
+    """
+    deltas = {}
+    for key in keys:
+        if key not in old or key not in new:
+            continue
+        if new[key] < old[key]:
+            return None
+        deltas[key] = new[key] - old[key]
+    return deltas
+
+
+def cpu_results(old, new):
+    deltas = _deltas(old.get('cpu', {}), new.get('cpu', {}), CPU_FIELDS)
+    total = sum(deltas.values()) if deltas else 0
+    results = []
+    if not total:
+        return results
+    for key in CPU_METRICS:
+        r = CPU_RESULT.child(name='val.' + key)
+        r.value = round(100.0 * deltas.get(key, 0) / total, 2)
+        results.append(r)
+    return results
+
+
+def memory_results(snapshot):
+    meminfo = snapshot.get('meminfo', {})
+    results = []
+    if meminfo.get('MemTotal') and 'MemAvailable' in meminfo:
+        r = MEMORY_RESULT.child(name='val.available_percent')
+        r.value = round(100.0 * meminfo['MemAvailable'] /
+                        meminfo['MemTotal'], 2)
+        results.append(r)
+    for field, key in MEMINFO_BYTES:
+        if field in meminfo:
+            r = MEMORY_RESULT.child(name='val.' + key)
+            r.value = meminfo[field]
+            results.append(r)
+    return results
+
+
+def pressure_results(old, new, elapsed):
+    results = []
+    for resource in PRESSURE_RESOURCES:
+        deltas = _deltas(old.get('pressure', {}).get(resource, {}),
+                         new.get('pressure', {}).get(resource, {}),
+                         ('some', 'full'))
+        for key, delta in sorted((deltas or {}).items()):
+            # Percent of the time that tasks were stalled
+            r = PRESSURE_RESULT.child(name='val.%s_%s' % (resource, key))
+            r.value = round(min(100.0, delta / (elapsed * 10000.0)), 2)
+            results.append(r)
+    return results
+
+
+def net_results(old, new, elapsed):
+    results = []
+    for interface, counters in sorted(new.get('net', {}).items()):
+        deltas = _deltas(old.get('net', {}).get(interface, {}), counters,
+                         NET_METRICS)
+        for key in NET_METRICS:
+            if not deltas or key not in deltas:
+                continue
+            r = NET_RESULT.child(name='val.%s_per_sec' % key,
+                                 dimensions={'interface': interface})
+            r.value = round(deltas[key] / elapsed, 2)
+            results.append(r)
+    return results
+
+
+def tcp_results(old, new, elapsed):
+    deltas = _deltas(old.get('tcp', {}), new.get('tcp', {}), TCP_FIELDS)
+    results = []
+    if not deltas or 'RetransSegs' not in deltas:
+        return results
+    r = TCP_RESULT.child(name='val.retrans_segs_per_sec')
+    r.value = round(deltas['RetransSegs'] / elapsed, 2)
+    results.append(r)
+    if deltas.get('OutSegs'):
+        r = TCP_RESULT.child(name='val.retrans_percent')
+        r.value = round(100.0 * deltas['RetransSegs'] / deltas['OutSegs'],
+                        3)
+        results.append(r)
+    return results
+
+
+def get_host_stats():
+    """
+    Report CPU, memory pressure, network and TCP retransmit figures. The
+    counters are compared with those saved by the previous run.
+    """
+    new = read_snapshot()
+    old = load_state(SYSTEM_STATE)
+    save_state(SYSTEM_STATE, new)
+
+    results = memory_results(new)
+    elapsed = new['time'] - old.get('time', new['time'])
+    if elapsed <= 0:
+        return results
+    results.extend(cpu_results(old, new))
+    results.extend(pressure_results(old, new, elapsed))
+    results.extend(net_results(old, new, elapsed))
+    results.extend(tcp_results(old, new, elapsed))
+    return results
+
+
 def main():
     """ Get system data (such as load average) """
     results = []
     results.extend(get_load_average())
+    results.extend(get_host_stats())
     return results
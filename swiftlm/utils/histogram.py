@@ -0,0 +1,162 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Latency histogram in the style of HdrHistogram.
+
+Each power of two between min_value and max_value is split into
+sub_buckets linear buckets, so every value is counted in a bucket no more
+than 1 / sub_buckets (about 3% by default) wider than the value, and the
+bucket of a value is found in constant time with frexp. Memory is fixed
+however many values are recorded.
+"""
+
+import math
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, min_value=0.001, max_value=100.0, sub_buckets=32):
+        """
+        :param min_value: values up to this are counted in the first bucket
+        :param max_value: values above this are counted in the last bucket,
+                          so percentiles saturate a little above max_value
+        :param sub_buckets: buckets per power of two
+        """
+        self.min_value = min_value
+        self.max_value = max_value
+        self.sub_buckets = sub_buckets
+        self.counts = [0] * (self.bucket(max_value) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """
+        :returns: the index of the bucket that value is counted in
+        """
+        ratio = value / float(self.min_value)
+        if ratio <= 1:
+            return 0
+        mantissa, exponent = math.frexp(ratio)
+        # ratio is in [2 ** (exponent - 1), 2 ** exponent)
+        return (1 + (exponent - 1) * self.sub_buckets +
+                int((2 * mantissa - 1) * self.sub_buckets))
+
+    def upper_bound(self, index):
+        """
+        :returns: the upper bound of the values counted in a bucket; the
+                  next bucket counts values from this one up
+        """
+        if index == 0:
+            return self.min_value
+        power, sub = divmod(index - 1, self.sub_buckets)
+        return (self.min_value * 2 ** power *
+                (1 + (sub + 1) / float(self.sub_buckets)))
+
+    def record(self, value):
+        self.counts[min(self.bucket(value), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values of another histogram, e.g. from another worker.
+
+        :raises ValueError: if the histograms have different buckets
+        """
+        if (other.min_value, other.max_value, other.sub_buckets) != \
+                (self.min_value, self.max_value, self.sub_buckets):
+            raise ValueError('Histograms have different buckets')
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        :returns: the highest value of the bucket holding the value at the
+                  given percentile, limited to the range of values recorded,
+                  or None if there are no values
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(self.upper_bound(index), self.min), self.max)
+
+    def summary(self, percents=PERCENTILES):
+        """
+        :returns: dictionary of count, mean, min, max and the values at the
+                  given percentiles, keyed 'p50', 'p99.9' etc.
+        """
+        result = {'count': self.count, 'mean': self.mean(),
+                  'min': self.min, 'max': self.max}
+        for percent in percents:
+            result['p%g' % percent] = self.percentile(percent)
+        return result
+
+    def to_dict(self):
+        """
+        :returns: a JSON serialisable dictionary; the counts of empty
+                  buckets are left out
+        """
+        return {'min_value': self.min_value, 'max_value': self.max_value,
+                'sub_buckets': self.sub_buckets, 'total': self.total,
+                'min': self.min, 'max': self.max,
+                'counts': dict((str(index), count)
+                               for index, count in enumerate(self.counts)
+                               if count)}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state: a dictionary from to_dict
+        :returns: LatencyHistogram
+        :raises KeyError, TypeError, ValueError: if state is not valid
+        """
+        histogram = cls(state['min_value'], state['max_value'],
+                        state['sub_buckets'])
+        for index, count in state['counts'].items():
+            index = int(index)
+            if not 0 <= index < len(histogram.counts):
+                raise ValueError('Bucket %d out of range' % index)
+            histogram.counts[index] += count
+            histogram.count += count
+        histogram.total = float(state['total'])
+        histogram.min = state['min']
+        histogram.max = state['max']
+        return histogram
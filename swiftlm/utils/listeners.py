@@ -0,0 +1,116 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Inventory of listening TCP sockets, read from /proc/net/tcp and tcp6.
+
+A socket is matched to the process that owns it through the socket inode,
+which is also the target of the process's /proc/<pid>/fd/<n> link
+("socket:[<inode>]").
+"""
+
+import os
+import socket
+import struct
+from collections import namedtuple
+
+PROC = '/proc'
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = '0A'
+WILDCARD_IPS = frozenset(['0.0.0.0', '::'])
+
+Listener = namedtuple('Listener', ['ip', 'port', 'inode', 'accept_queue'])
+
+
+def _decode_ip(hex_ip):
+    # The address is printed as 32 bit words in host (little endian) order
+    words = [int(hex_ip[i:i + 8], 16) for i in range(0, len(hex_ip), 8)]
+    packed = b''.join(struct.pack('<I', w) for w in words)
+    if len(words) == 1:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    ip = socket.inet_ntop(socket.AF_INET6, packed)
+    if ip.startswith('::ffff:') and '.' in ip:
+        # IPv4 mapped address
+        return ip[len('::ffff:'):]
+    return ip
+
+
+def get_listeners(proc_net_tcp=PROC_NET_TCP):
+    """
+    Read the listening TCP sockets in a single pass.
+
+    Lines of /proc/net/tcp look like:
+
+        0: 0100007F:0369 00000000:0000 0A 00000000:00000002 ... 0 0 12345 ...
+
+    For a listening socket rx_queue (00000002) is the number of
+    connections waiting to be accepted.
+
+    :returns: list of Listener
+    """
+    listeners = []
+    for path in proc_net_tcp:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            try:
+                if fields[3] != TCP_LISTEN:
+                    continue
+                hex_ip, hex_port = fields[1].split(':')
+                listeners.append(Listener(
+                    ip=_decode_ip(hex_ip),
+                    port=int(hex_port, 16),
+                    inode=int(fields[9]),
+                    accept_queue=int(fields[4].split(':')[1], 16)))
+            except (IndexError, ValueError, socket.error, struct.error):
+                continue
+    return listeners
+
+
+def get_socket_inodes(pids, proc=None):
+    """
+    :param pids: the processes to look at
+    :returns: dictionary of socket inode to pid
+    """
+    inodes = {}
+    for pid in pids:
+        fd_dir = os.path.join(proc or PROC, str(pid), 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                try:
+                    inodes[int(target[8:-1])] = pid
+                except ValueError:
+                    pass
+    return inodes
+
+
+def ip_matches(listener_ip, ip):
+    """
+    :returns: True if a socket listening on listener_ip accepts
+              connections to ip
+    """
+    return listener_ip == ip or listener_ip in WILDCARD_IPS
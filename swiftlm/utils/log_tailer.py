@@ -19,6 +19,8 @@ from collections import defaultdict
 import os
 from stat import ST_INO
 
+from swiftlm.utils.histogram import LatencyHistogram
+
 
 class LogTailer(object):
     """
@@ -143,10 +145,13 @@ class AccessStatsRecorder(object):
     def __init__(self):
         self.ops = OpsRecorder()
         self.projects = defaultdict(ProjectRecorder)
+        self.latency = LatencyHistogram()
 
     def record_op(self, verb, http_status, bytes_transferred,
-                  project=None, container=None, obj=None):
+                  project=None, container=None, obj=None, request_time=None):
         self.ops.record_op('total', verb, http_status, bytes_transferred, obj)
+        if request_time is not None:
+            self.latency.record(request_time)
         if project:
             self.projects[project].record_op(project, verb, http_status,
                                              bytes_transferred, container,
@@ -248,6 +253,8 @@ def parse_proxy_log_message(line, reseller_prefixes):
                                operation does not involve a container)
             obj                Name of object (or None if operation does not
                                involve an object)
+            request_time       Seconds taken to execute the transaction
+                               (or None if not logged)
         or a string indicating why the line is not proxy-logging message (this
         is a debug aid)
     """
@@ -285,9 +292,16 @@ def parse_proxy_log_message(line, reseller_prefixes):
         if not bytes_sent == '-':
             content_size = int(bytes_sent)
 
+        request_time = None
+        try:
+            request_time = float(pieces[20])
+        except ValueError:
+            pass
+
         return {'http_status': response, 'verb': verb,
                 'bytes_transferred': content_size, 'project': project,
-                'container': container, 'obj': obj}
+                'container': container, 'obj': obj,
+                'request_time': request_time}
 
     except Exception:  # noqa
         # Line too short, missing information, not of interest.
@@ -0,0 +1,28 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from bisect import bisect
+
+from swift.common.memcached import md5hash
+
+
+def ring_server(memcache_ring, key):
+    """
+    :returns: the server that MemcacheRing sends key to (unless that server
+              is error limited)
+    """
+    sorted_hashes = memcache_ring._sorted
+    pos = (bisect(sorted_hashes, md5hash(key)) + 1) % len(sorted_hashes)
+    return memcache_ring._ring[sorted_hashes[pos]]
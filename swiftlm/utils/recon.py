@@ -0,0 +1,81 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Reader for the swift recon cache files (object.recon etc.).
+
+object.recon can be large on a busy object server because it holds
+per-device replication stats. A file is only parsed again when its
+inode, mtime or size have changed. Callers pass an extract function to
+pick out what they need; the extracted value is kept in memory and in
+SWIFTLM_STATE_DIR so that the next swiftlm-scan run can reuse it too.
+"""
+
+import json
+import os
+
+from swiftlm.utils.utility import load_state, save_state
+
+RECON_PATH = '/var/cache/swift/'
+RECON_STATE = 'recon_cache.json'
+
+_cache = {}
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [st.st_ino, st.st_mtime, st.st_size]
+
+
+def load_recon(recon_file, extract=None, recon_path=RECON_PATH):
+    """
+    Load a recon cache file, or the part of it that extract picks out.
+
+    :param recon_file: name of the file, e.g. 'object.recon'
+    :param extract: function taking the parsed file and returning a JSON
+                    serialisable value. Its name is part of the cache key.
+    :param recon_path: directory holding the recon files
+    :returns: the parsed file, or extract() of it
+    :raises OSError, IOError: if the file cannot be read
+    :raises ValueError: if the file is not valid JSON
+    """
+    path = os.path.join(recon_path, recon_file)
+    key = (path, extract.__name__ if extract else None)
+    signature = _signature(path)
+    cached = _cache.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    state = None
+    if extract:
+        state = load_state(RECON_STATE)
+        saved = state.get(path, {}).get(key[1])
+        if saved and saved.get('signature') == signature:
+            _cache[key] = (signature, saved['value'])
+            return saved['value']
+
+    with open(path) as f:
+        value = json.load(f)
+    if extract:
+        value = extract(value)
+        state.setdefault(path, {})[key[1]] = {'signature': signature,
+                                              'value': value}
+        save_state(RECON_STATE, state)
+    _cache[key] = (signature, value)
+    return value
+
+
+def clear_cache():
+    _cache.clear()
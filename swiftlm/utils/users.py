@@ -0,0 +1,86 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+"""
+Cached user and group lookups.
+
+With NSS backed by LDAP (or similar) each pwd/grp lookup can be a network
+round trip. Checks should compare ownership numerically against get_uid()
+and get_gid() and only look up names when reporting a mismatch.
+"""
+
+import grp
+import pwd
+
+SWIFT_USER = 'swift'
+SWIFT_GROUP = 'swift'
+
+_uids = {}
+_gids = {}
+_user_names = {}
+_group_names = {}
+
+
+def get_uid(user_name):
+    """
+    :returns: uid of user_name, or None if there is no such user
+    """
+    if user_name not in _uids:
+        try:
+            _uids[user_name] = pwd.getpwnam(user_name).pw_uid
+        except KeyError:
+            _uids[user_name] = None
+    return _uids[user_name]
+
+
+def get_gid(group_name):
+    """
+    :returns: gid of group_name, or None if there is no such group
+    """
+    if group_name not in _gids:
+        try:
+            _gids[group_name] = grp.getgrnam(group_name).gr_gid
+        except KeyError:
+            _gids[group_name] = None
+    return _gids[group_name]
+
+
+def get_user_name(uid):
+    """
+    :returns: name of the user, or the uid as a string if it has no name
+    """
+    if uid not in _user_names:
+        try:
+            _user_names[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            _user_names[uid] = str(uid)
+    return _user_names[uid]
+
+
+def get_group_name(gid):
+    """
+    :returns: name of the group, or the gid as a string if it has no name
+    """
+    if gid not in _group_names:
+        try:
+            _group_names[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            _group_names[gid] = str(gid)
+    return _group_names[gid]
+
+
+def clear_cache():
+    for cache in (_uids, _gids, _user_names, _group_names):
+        cache.clear()
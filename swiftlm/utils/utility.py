@@ -22,6 +22,7 @@ except ImportError:
     import subprocess as commands_wrapper
 import random
 import os.path
+import re
 from collections import namedtuple
 
 from swiftlm.utils.ringdata import RingData
@@ -34,6 +35,7 @@ import syslog
 import signal
 import time
 import fcntl
+import threading
 from contextlib import contextmanager
 import errno
 import json
@@ -44,11 +46,23 @@ import ConfigParser
 
 swiftlm_scan_conf = "/etc/swiftlm/swiftlm-scan.conf"
 
+# Directory holding state that checks persist between swiftlm-scan runs
+SWIFTLM_STATE_DIR = '/var/cache/swiftlm'
+
+MOUNTINFO = '/proc/self/mountinfo'
+DISK_BY_LABEL = '/dev/disk/by-label'
+BLKID_CACHE_FILES = ('/run/blkid/blkid.tab', '/etc/blkid.tab')
+
 # namedtuple for use with the results from RingData.devs
 RingDeviceEntry = namedtuple('RingDeviceEntry', ['ip', 'port', 'device',
                              'replication_ip'])
 # More descriptive wrapper around the results of run_command
 CommandResult = namedtuple('CommandResult', ['exitcode', 'output'])
+# Outcome of one call made by run_in_threads
+ThreadResult = namedtuple('ThreadResult', ['item', 'done', 'value', 'error'])
+# One line of /proc/self/mountinfo
+MountEntry = namedtuple('MountEntry', ['mount_id', 'device', 'mount',
+                                       'fstype', 'options'])
 
 LOG_LEVEL_MAP = {'debug': logging.DEBUG,
                  'info': logging.INFO,
@@ -157,7 +171,7 @@ class Aggregate(object):
     def add(self, value):
         self._count += 1
         self._total += value
-        if not self._min:
+        if self._min is None:
             self._min = value
         if value < self._min:
             self._min = value
@@ -183,6 +197,55 @@ class Aggregate(object):
             raise AttributeError
 
 
+class _ItemThread(threading.Thread):
+
+    def __init__(self, func, item):
+        threading.Thread.__init__(self)
+        # A thread stuck on a hung drive must not stop the process exiting
+        self.daemon = True
+        self.func = func
+        self.item = item
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(self.item)
+        except Exception as err:
+            self.error = err
+
+
+def run_in_threads(func, items, timeout):
+    """
+    Call func(item) for each item, each call in its own thread.
+
+    Calls that have not returned within timeout seconds of starting are
+    abandoned so that one blocked call (e.g. statvfs on a hung drive) does
+    not hold up the results for the other items.
+
+    :param func: function taking a single item
+    :param items: iterable of items
+    :param timeout: seconds to wait for all the calls to return
+    :returns: list of ThreadResult in the same order as items. done is
+              False, and value is None, if the call timed out. error is the
+              exception raised by the call, if any, in which case value is
+              None; one failed call does not lose the results of the others.
+    """
+    threads = [_ItemThread(func, item) for item in items]
+    for t in threads:
+        t.start()
+
+    deadline = time.time() + timeout
+    results = []
+    for t in threads:
+        t.join(max(0.0, deadline - time.time()))
+        if t.is_alive():
+            results.append(ThreadResult(t.item, False, None, None))
+            continue
+        results.append(ThreadResult(t.item, True, t.value, t.error))
+    return results
+
+
 def run_cmd(cmd):
     # Wrapper around commands and subprocess.
     # we dont want to have to do try..except ImportError
@@ -216,13 +279,17 @@ def get_swift_bind_ips(interface=None):
 
 def get_network_interface_conf():
     """
-    Get unique list of bind ips from [network-interface] in swiftlm-scan.conf
+    Get unique list of bind ips (and ports, if set) from [network-interface]
+    in swiftlm-scan.conf
 
-    :returns: a dictionary of bind ips
+    :returns: a dictionary of bind ips and ports
     """
     network_interface_data = {}
     network_interface_ips = ["proxy_bind_ip", "account_bind_ip",
-                             "container_bind_ip", "rsync_bind_ip"]
+                             "container_bind_ip", "object_bind_ip",
+                             "rsync_bind_ip", "proxy_bind_port",
+                             "account_bind_port", "container_bind_port",
+                             "object_bind_port"]
     parser = ConfigParser.RawConfigParser()
     parser.read(swiftlm_scan_conf)
     for net_ip in network_interface_ips:
@@ -251,6 +318,24 @@ def get_rsync_target_conf():
     return rsync_conf_data
 
 
+def get_diskusage_conf():
+    """
+    Gets options from [diskusage] in swiftlm-scan.conf
+
+    :returns: a dictionary of values
+    """
+    diskusage_conf_data = {'xfs_freesp_interval': 0}
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read(swiftlm_scan_conf)
+        diskusage_conf_data['xfs_freesp_interval'] = parser.getint(
+            'diskusage', 'xfs_freesp_interval')
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError,
+            ValueError):
+        pass
+    return diskusage_conf_data
+
+
 def get_swift_mount_point():
     """
     Get mount points from swiftlm-scan.conf
@@ -267,6 +352,85 @@ def get_swift_mount_point():
     return mount_point
 
 
+def _unescape_octal(s):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), s)
+
+
+def get_mounts(mountinfo=MOUNTINFO):
+    """
+    Parse the mount table in a single pass.
+
+    Each line of /proc/self/mountinfo looks like:
+
+        36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - xfs /dev/sdb1 rw,attr2
+
+    The optional fields (master:1) are terminated by a lone '-'.
+
+    :param mountinfo: path of the mountinfo file
+    :returns: dictionary of mount point to MountEntry. If a mount point is
+              stacked, the last (visible) mount wins.
+    """
+    mounts = {}
+    with open(mountinfo, 'r') as f:
+        for line in f:
+            fields = line.split()
+            try:
+                sep = fields.index('-', 6)
+                mount = _unescape_octal(fields[4])
+                mounts[mount] = MountEntry(
+                    mount_id=fields[0],
+                    device=_unescape_octal(fields[sep + 2]),
+                    mount=mount,
+                    fstype=fields[sep + 1],
+                    options=fields[5])
+            except (ValueError, IndexError):
+                continue
+    return mounts
+
+
+def _unescape_udev(s):
+    # udev encodes unsafe characters in /dev/disk/by-* names as \xNN
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)),
+                  s)
+
+
+def get_labels(by_label_dir=DISK_BY_LABEL, blkid_files=BLKID_CACHE_FILES):
+    """
+    Get filesystem labels without running xfs_admin or blkid.
+
+    Labels are taken from the udev maintained /dev/disk/by-label symlinks.
+    Devices not found there are looked up in the blkid cache, which has
+    entries like:
+
+        <device DEVNO="0x0811" LABEL="disk0" TYPE="xfs">/dev/sdb1</device>
+
+    :returns: dictionary of (resolved) device path to label
+    """
+    labels = {}
+    try:
+        for name in os.listdir(by_label_dir):
+            link = os.path.join(by_label_dir, name)
+            labels[os.path.realpath(link)] = _unescape_udev(name)
+    except OSError:
+        pass
+
+    device_re = re.compile(r'<device ([^>]*)>([^<]+)</device>')
+    label_re = re.compile(r'\bLABEL="([^"]*)"')
+    for blkid_file in blkid_files:
+        try:
+            with open(blkid_file, 'r') as f:
+                content = f.read()
+        except IOError:
+            continue
+        for attrs, device in device_re.findall(content):
+            match = label_re.search(attrs)
+            if match:
+                labels.setdefault(os.path.realpath(device.strip()),
+                                  match.group(1))
+    return labels
+
+
 def ip_to_interface():
     """
     Obtain an ip to interface map by parsing netstat -ie output.
@@ -483,6 +647,50 @@ def dump_swiftlm_uptime_data(data_list, uptime_stats_file, logger,
         logger.exception('Exception dumping swiftlm uptime cache')
 
 
+def load_state(name, state_dir=None):
+    """
+    Load state that a check persisted on a previous run.
+
+    :param name: name of the state file in SWIFTLM_STATE_DIR
+    :param state_dir: directory to use instead of SWIFTLM_STATE_DIR
+    :returns: the saved object, or an empty dict if there is none
+    """
+    try:
+        with open(os.path.join(state_dir or SWIFTLM_STATE_DIR, name),
+                  'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(name, state, state_dir=None):
+    """
+    Persist state for the next run of a check.
+
+    The file is replaced atomically so a concurrent reader never sees a
+    partial write. State is an optimisation, so failure to save it is
+    not an error.
+
+    :param name: name of the state file in SWIFTLM_STATE_DIR
+    :param state: JSON serialisable object
+    :param state_dir: directory to use instead of SWIFTLM_STATE_DIR
+    """
+    state_dir = state_dir or SWIFTLM_STATE_DIR
+    path = os.path.join(state_dir, name)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, TypeError, ValueError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
 def get_swiftlm_uptime_mon_data(uptime_stats_file, logger, openr=open):
     """retrieve values from a swiftlm uptime mon cache file
 
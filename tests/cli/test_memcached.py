@@ -0,0 +1,168 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import random
+import socket
+import unittest
+
+import mock
+from swift.common.memcached import MemcacheRing, md5hash
+
+from swiftlm.cli import memcached
+
+SERVERS = ['192.168.245.5:11211', '192.168.245.6:11211',
+           '192.168.245.7:11211']
+
+
+class TestKeyChooser(unittest.TestCase):
+
+    def test_uniform(self):
+        chooser = memcached.KeyChooser(10, rand=random.Random(1))
+        keys = [chooser.choose() for _ in range(1000)]
+        self.assertEqual(set(range(1, 11)), set(keys))
+
+    def test_zipfian(self):
+        chooser = memcached.KeyChooser(1000, 'zipfian', 1.0,
+                                       rand=random.Random(1))
+        keys = [chooser.choose() for _ in range(10000)]
+        self.assertTrue(all(1 <= k <= 1000 for k in keys))
+        # Key 1 is chosen about 1 / H(1000), i.e. 13%, of the time
+        self.assertTrue(1000 < keys.count(1) < 1600)
+        self.assertGreater(keys.count(1), 5 * keys.count(10))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, memcached.KeyChooser, 10, 'normal')
+
+
+class FakeConnection(object):
+    """The fp and sock of a connection to an in memory memcached"""
+
+    def __init__(self, server, store, failing):
+        self.server = server
+        self.store = store
+        self.failing = failing
+        self.reply = ''
+
+    def sendall(self, data):
+        if self.server in self.failing:
+            raise socket.error(104, 'ECONNRESET')
+        command, rest = data.split('\r\n', 1)
+        words = command.split()
+        if words[0] == 'get':
+            value = self.store.get((self.server, words[1]))
+            if value is not None:
+                self.reply += 'VALUE %s 0 %d\r\n%s\r\n' % (
+                    words[1], len(value), value)
+            self.reply += 'END\r\n'
+        elif words[0] == 'set':
+            self.store[(self.server, words[1])] = rest[:int(words[4])]
+            self.reply += 'STORED\r\n'
+
+    def readline(self):
+        line, self.reply = self.reply.split('\r\n', 1)
+        return line + '\r\n'
+
+    def read(self, size):
+        data, self.reply = self.reply[:size], self.reply[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class TestLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = MemcacheRing(SERVERS)
+        self.store = {}
+        self.failing = set()
+
+        for server in SERVERS:
+            conn = FakeConnection(server, self.store, self.failing)
+            pool = self.ring._client_cache[server]
+            mock.patch.object(pool, 'get', lambda c=conn: (c, c)).start()
+            mock.patch.object(pool, 'put', lambda item: None).start()
+        mock.patch('swift.common.memcached.logging').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_server_op(self):
+        server = memcached.ring_server(self.ring, 'k')
+        self.assertFalse(memcached.server_op(self.ring, server, 'k'))
+        memcached.server_op(self.ring, server, 'k', 'value', 60)
+        self.assertEqual({(server, md5hash('k')): 'value'}, self.store)
+        self.assertTrue(memcached.server_op(self.ring, server, 'k'))
+
+        # A failure is raised rather than retried on another server
+        self.failing.add(server)
+        self.assertRaises(socket.error, memcached.server_op, self.ring,
+                          server, 'k', 'other', 60)
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(1, len(self.ring._errors[server]))
+
+        # and once the server is error limited it is not tried
+        self.ring._error_limited[server] = float('inf')
+        self.assertRaises(memcached.ServerUnavailable, memcached.server_op,
+                          self.ring, server, 'k')
+        self.assertEqual(1, len(self.ring._errors[server]))
+
+    def test_load(self):
+        options = {'servers': SERVERS, 'number_of_keys': 50,
+                   'distribution': 'zipfian', 'zipf_alpha': 1.0,
+                   'value_sizes': [10, 1000], 'run_time': 0.2,
+                   'clients': 4, 'get_ratio': 0.8, 'rate': 200}
+        stats = memcached.load(self.ring, options)
+        ops = stats['gets'] + stats['sets']
+        # Paced to about 200 ops/sec
+        self.assertTrue(10 <= ops <= 80, ops)
+        self.assertEqual(0, stats['misses'])
+        self.assertEqual(0, stats['errors'])
+        self.assertEqual(ops, sum(b.count
+                                  for b in stats['servers'].values()))
+        self.assertEqual(set(SERVERS),
+                         set(server for server, _ in self.store))
+        report = memcached.format_load_report(stats)
+        for server in SERVERS:
+            self.assertIn(server, report)
+
+    def test_load_failing_server(self):
+        self.failing.add(SERVERS[1])
+        options = {'servers': SERVERS, 'number_of_keys': 50,
+                   'distribution': 'uniform', 'zipf_alpha': 1.0,
+                   'value_sizes': [10], 'run_time': 0.2,
+                   'clients': 4, 'get_ratio': 0.8, 'rate': 500}
+        stats = memcached.load(self.ring, options)
+        errors = stats['server_errors']
+        self.assertGreater(errors[SERVERS[1]], 0)
+        self.assertEqual(0, errors[SERVERS[0]] + errors[SERVERS[2]])
+        self.assertEqual(errors[SERVERS[1]], stats['errors'])
+        # Operations on the failing server are errors rather than misses,
+        # and no latency is recorded for them under any server
+        self.assertEqual(0, stats['misses'])
+        self.assertEqual(0, stats['servers'][SERVERS[1]].count)
+        self.assertEqual(stats['gets'] + stats['sets'] - stats['errors'],
+                         sum(b.count for b in stats['servers'].values()))
+        report = memcached.format_load_report(stats)
+        self.assertIn('%-24s %8d %8d' % (SERVERS[1], errors[SERVERS[1]], 0),
+                      report.splitlines())
+
+    def test_format_latency(self):
+        latencies = memcached.new_histogram()
+        for latency in (0.1, 0.3, 0.3, 0.5, 100.0):
+            latencies.record(latency)
+        self.assertEqual('Count: 5  Average: 20.240 ms\n'
+                         'p50: 0.305 ms  p90: 100.000 ms  p99: 100.000 ms  '
+                         'p99.9: 100.000 ms\n'
+                         'Range 0.1 ms - 100.0 ms',
+                         memcached.format_latency(latencies))
@@ -16,14 +16,23 @@
 #
 
 
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from shutil import rmtree
 import StringIO
 import logging
 import ConfigParser
+import mock
+from swiftclient import ClientException
 from swiftlm.cli import uptime_mon
 from swiftlm.cli.uptime_mon import UPtimeMonException
 from swiftlm.cli.uptime_mon import TrackConnection
 from swiftlm.cli.uptime_mon import component_states
+from swiftlm.cli.uptime_mon import ProbeResult
 
 
 class TestArgumentParser(unittest.TestCase):
@@ -69,6 +78,62 @@ auth_version: 2
         self.data = None
         self.config = None
 
+    def test_probe_defaults(self):
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual(uptime_mon.PROBE_CONCURRENCY,
+                         parsed['probe_concurrency'])
+        self.assertEqual(45.0, parsed['cycle_timeout'])
+
+        self.config.set('latency_monitor', 'probe_concurrency', '4')
+        self.config.set('latency_monitor', 'cycle_timeout', '20')
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual(4, parsed['probe_concurrency'])
+        self.assertEqual(20.0, parsed['cycle_timeout'])
+
+    def test_token_options(self):
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual(uptime_mon.TOKEN_LIFETIME, parsed['token_lifetime'])
+        self.assertEqual(1, parsed['keystone_check_every'])
+
+        self.config.set('latency_monitor', 'token_lifetime', '7200')
+        self.config.set('latency_monitor', 'keystone_check_every', '5')
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual(7200, parsed['token_lifetime'])
+        self.assertEqual(5, parsed['keystone_check_every'])
+
+    def test_proxy_options(self):
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertIsNone(parsed['proxy_header'])
+        self.assertEqual([], parsed['proxy_hosts'])
+
+        self.config.set('latency_monitor', 'proxy_header', 'X-Backend')
+        self.config.set('latency_monitor', 'proxy_hosts', 'p1:8080, p2:8080')
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual('X-Backend', parsed['proxy_header'])
+        self.assertEqual(['p1:8080', 'p2:8080'], parsed['proxy_hosts'])
+
+    def test_object_profiles(self):
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual([], parsed['object_profiles'])
+
+        self.config.add_section('object_profile:small')
+        self.config.set('object_profile:small', 'size', '4KiB')
+        self.config.add_section('object_profile:large')
+        self.config.set('object_profile:large', 'size', '64MiB')
+        self.config.set('object_profile:large', 'segment_size', '8M')
+        self.config.set('object_profile:large', 'manifest', 'DLO')
+        self.config.set('object_profile:large', 'every', '60')
+        parsed, _ = uptime_mon.validate_args(self.config)
+        self.assertEqual(
+            [uptime_mon.ObjectProfile('large', 64 * 1024 * 1024,
+                                      8 * 1024 * 1024, 'dlo', 60),
+             uptime_mon.ObjectProfile('small', 4096, None, 'slo', 1)],
+            parsed['object_profiles'])
+
+        self.config.set('object_profile:small', 'size', 'lots')
+        self.assertRaises(UPtimeMonException,
+                          lambda: uptime_mon.validate_args(self.config))
+
     def test_missing_logging_section(self):
         self.config.remove_section('logging')
 
@@ -315,9 +380,546 @@ class TestTrackConnection(unittest.TestCase):
                         "REST API availability day metric not found")
 
 
+class TestObjectData(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(4096, uptime_mon.parse_size('4096'))
+        self.assertEqual(4096, uptime_mon.parse_size('4KiB'))
+        self.assertEqual(4096, uptime_mon.parse_size('4k'))
+        self.assertEqual(2 ** 20, uptime_mon.parse_size(' 1 MB '))
+        self.assertEqual(2 ** 30, uptime_mon.parse_size('1G'))
+        self.assertRaises(ValueError, uptime_mon.parse_size, '1.5M')
+        self.assertRaises(ValueError, uptime_mon.parse_size, '1T')
+
+    def test_pattern_reader(self):
+        size = 3 * uptime_mon.PATTERN_SIZE + 10
+        reader = uptime_mon.PatternReader(size)
+        chunks = []
+        while True:
+            chunk = reader.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(size, sum(len(chunk) for chunk in chunks))
+        # Whole chunks are the shared buffer, not copies
+        self.assertIs(chunks[0], chunks[1])
+        self.assertEqual(10, len(chunks[-1]))
+        self.assertEqual(5, len(uptime_mon.PatternReader(5).read()))
+
+
+class FakeSwift(object):
+    """
+    Just enough of swiftclient.Connection for object store and object
+    profile probes. A PUT of an object that is already there fails, so that
+    probes running at the same time must use different names.
+    """
+
+    def __init__(self, objects, delay=0):
+        self.objects = objects
+        self.delay = delay
+        self.names = set()
+
+    def __call__(self, **kwargs):
+        return self
+
+    def head_account(self):
+        time.sleep(self.delay)
+        return {}
+
+    def put_container(self, container):
+        pass
+
+    def put_object(self, container, obj, contents, content_length=None,
+                   headers=None, query_string=None):
+        if (container, obj) in self.objects:
+            raise ClientException('Conflict', http_status=409)
+        self.names.add((container, obj))
+        if hasattr(contents, 'read'):
+            data = contents.read(65536)
+            size = 0
+            while data:
+                size += len(data)
+                data = contents.read(65536)
+        elif query_string == 'multipart-manifest=put':
+            size = sum(s['size_bytes'] for s in json.loads(contents))
+        elif headers and 'X-Object-Manifest' in headers:
+            prefix = headers['X-Object-Manifest']
+            size = sum(size for (c, o), size in self.objects.items()
+                       if ('%s/%s' % (c, o)).startswith(prefix))
+        else:
+            size = len(contents)
+        self.objects[(container, obj)] = size
+        return 'etag'
+
+    def get_object(self, container, obj, resp_chunk_size=None):
+        time.sleep(self.delay)
+        if (container, obj) not in self.objects:
+            raise ClientException('Not Found', http_status=404)
+        size = self.objects[(container, obj)]
+        return {}, iter(['x' * min(resp_chunk_size, size - offset)
+                         for offset in range(0, size, resp_chunk_size)])
+
+    def delete_object(self, container, obj):
+        if (container, obj) not in self.objects:
+            raise ClientException('Not Found', http_status=404)
+        del self.objects[(container, obj)]
+
+
+class TestUptimeWindow(unittest.TestCase):
+    def test_record(self):
+        window = uptime_mon.UptimeWindow()
+        self.assertIsNone(window.average())
+        window.record(6000, 100)
+        # A later record in the same minute replaces the first
+        window.record(6030, 0)
+        self.assertEqual(1, window.count)
+        self.assertEqual(0, window.average())
+        # Minutes missed are backfilled with the new value
+        window.record(6000 + 4 * 60, 100)
+        self.assertEqual(5, window.count)
+        self.assertEqual(80.0, window.average())
+        self.assertEqual(100, window.last_value)
+        self.assertEqual(6240, window.last_time)
+        # Records from before the last are ignored
+        window.record(5000, 0)
+        self.assertEqual(80.0, window.average())
+
+    def test_day_window(self):
+        window = uptime_mon.UptimeWindow()
+        window.record(0, 0)
+        for minute in range(1, window.slots):
+            window.record(minute * 60, 100)
+        self.assertEqual(window.slots, window.count)
+        self.assertAlmostEqual(100.0 * 1439 / 1440, window.average())
+        # The down minute drops out of the window 24 hours later
+        window.record(window.slots * 60, 100)
+        self.assertEqual(100.0, window.average())
+        # After a gap of more than a day only the new value remains
+        window.record(10 * 86400, 0)
+        self.assertEqual(window.slots, window.count)
+        self.assertEqual(0.0, window.average())
+
+    def test_serialise(self):
+        window = uptime_mon.UptimeWindow()
+        window.record(6000, 0)
+        window.record(6120, 100)
+        copy = uptime_mon.UptimeWindow.from_dict(window.to_dict())
+        self.assertEqual(window.values, copy.values)
+        self.assertEqual((3, 200), (copy.count, copy.total))
+        self.assertEqual(6120, copy.last_time)
+        self.assertEqual(0, uptime_mon.UptimeWindow.from_dict({}).count)
+        self.assertEqual(0, uptime_mon.UptimeWindow.from_dict(
+            {'values': [100]}).count)
+
+
+class TestBackendName(unittest.TestCase):
+    def test_backend_name(self):
+        trans_id = 'txa8b6c5d4e3f2a1b0c9d8e-0059f1c2d3'
+        self.assertIsNone(uptime_mon.backend_name(None))
+        self.assertIsNone(uptime_mon.backend_name({'x-trans-id': trans_id}))
+        self.assertEqual('proxy1', uptime_mon.backend_name(
+            {'x-trans-id': trans_id + '-proxy1'}))
+        self.assertEqual('10.0.0.1', uptime_mon.backend_name(
+            {'x-trans-id': trans_id + '-proxy1', 'x-backend': '10.0.0.1'},
+            'X-Backend'))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.connection = TrackConnection('http://H:35357/v2.0',
+                                          'swift-monitor',
+                                          'changeme',
+                                          logging.getLogger(name='test'),
+                                          '/path/to/uptime.stats',
+                                          object_store_url='http://H:8080/v1/',
+                                          token_lifetime=1000)
+        self.release = threading.Event()
+        self.auths = []
+
+    def get_auth(self):
+        self.auths.append(time.time())
+        self.release.wait(5)
+        return 'http://H:8080/v1/AUTH_test', 'token-%d' % len(self.auths)
+
+    def test_refresh_due(self):
+        self.assertTrue(self.connection.token_refresh_due(0))
+        self.connection.token = 'token'
+        self.connection.token_expires = 2000
+        self.assertFalse(self.connection.token_refresh_due(1749))
+        self.assertTrue(self.connection.token_refresh_due(1750))
+
+    def test_background_check(self):
+        with mock.patch.object(self.connection, 'get_auth', self.get_auth):
+            start = time.time()
+            self.connection.start_keystone_check()
+            # Only one check at a time
+            self.connection.start_keystone_check()
+            self.assertIsNone(self.connection.token)
+            self.release.set()
+            self.connection.wait_keystone_check(time.time() + 5)
+        self.assertEqual(1, len(self.auths))
+        self.assertEqual('token-1', self.connection.token)
+        self.assertEqual('http://H:8080/v1/AUTH_test', self.connection.url)
+        self.assertLessEqual(start + 1000, self.connection.token_expires)
+        self.assertFalse(self.connection.token_refresh_due(time.time()))
+        state = self.connection.state[uptime_mon.COMPONENT_KEYSTONE_GET_TOKEN]
+        self.assertEqual(component_states.ok, state['current_state'])
+
+    def test_refresh_due_uses_real_expiry(self):
+        self.connection.token = 'token'
+        self.connection.token_issued = 1000
+        # keystone said the token lasts 400s, not token_lifetime
+        self.connection.token_expires = 1400
+        self.assertFalse(self.connection.token_refresh_due(1299))
+        self.assertTrue(self.connection.token_refresh_due(1300))
+        self.assertFalse(self.connection.token_expired(1399))
+        self.assertTrue(self.connection.token_expired(1400))
+
+    def test_get_token_expiry(self):
+        # Not available with v2
+        self.assertIsNone(self.connection.get_token_expiry('token'))
+
+        self.connection.auth_version = '3'
+        self.connection.authurl = 'http://H:5000/v3'
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            'token': {'expires_at': '2017-06-01T12:00:00.000000Z'}}
+        with mock.patch('swiftlm.cli.uptime_mon.requests.get',
+                        return_value=response) as get:
+            self.assertEqual(1496318400,
+                             self.connection.get_token_expiry('token'))
+        self.assertEqual('http://H:5000/v3/auth/tokens', get.call_args[0][0])
+        self.assertEqual('token',
+                         get.call_args[1]['headers']['X-Subject-Token'])
+
+        response.status_code = 403
+        with mock.patch('swiftlm.cli.uptime_mon.requests.get',
+                        return_value=response):
+            self.assertIsNone(self.connection.get_token_expiry('token'))
+
+    def test_check_uses_real_expiry(self):
+        self.release.set()
+        with mock.patch.object(self.connection, 'get_auth', self.get_auth):
+            with mock.patch.object(self.connection, 'get_token_expiry',
+                                   return_value=time.time() + 300):
+                self.connection.check_keystone_get_token()
+        self.assertLess(self.connection.token_expires, time.time() + 301)
+
+    def test_unauthorised_probe_gets_new_token(self):
+        swift = FakeSwift({})
+        used = []
+
+        def connection(**kwargs):
+            used.append(kwargs['preauthtoken'])
+            if kwargs['preauthtoken'] == 'stale':
+                raise uptime_mon.ClientException('Unauthorised',
+                                                 http_status=401)
+            return swift
+
+        self.release.set()
+        self.connection.token = 'stale'
+        self.connection.token_expires = time.time() + 1000
+        with mock.patch('swiftlm.cli.uptime_mon.Connection', connection):
+            with mock.patch.object(self.connection, 'get_auth',
+                                   self.get_auth):
+                result = self.connection.probe_object_store(time.time() + 10)
+        self.assertEqual(component_states.ok, result.state)
+        self.assertEqual(['stale', 'token-1'], used)
+        self.assertEqual(1, len(self.auths))
+        self.assertFalse(self.connection.token_expired(time.time()))
+
+    def test_unauthorised_probe_without_new_token(self):
+        class Unauthorised(FakeSwift):
+            def head_account(self):
+                raise uptime_mon.ClientException('Unauthorised',
+                                                 http_status=401)
+
+        self.connection.token = 'token'
+        self.connection.token_expires = time.time() + 1000
+        with mock.patch('swiftlm.cli.uptime_mon.Connection',
+                        Unauthorised({})):
+            with mock.patch.object(self.connection, 'start_keystone_check'):
+                start = time.time()
+                result = self.connection.probe_object_store(time.time() + 10)
+        # Not retried with the rejected token
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(component_states.fail, result.state)
+        self.assertTrue(self.connection.token_expired(time.time()))
+
+
+class TestRunProbes(unittest.TestCase):
+    def setUp(self):
+        self.connection = TrackConnection('http://H:35357/v2.0',
+                                          'swift-monitor',
+                                          'changeme',
+                                          logging.getLogger(name='test'),
+                                          '/path/to/uptime.stats',
+                                          object_store_url='http://H:8080/v1/',
+                                          auth_version=2,
+                                          os_options={})
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.calls = []
+
+    def probe(self, result, delay=0.05):
+        def _probe(deadline):
+            with self.lock:
+                self.calls.append(result)
+                self.active += 1
+                self.most_active = max(self.most_active, self.active)
+            time.sleep(delay)
+            with self.lock:
+                self.active -= 1
+            return result
+        return _probe
+
+    def test_concurrent_probes(self):
+        ok = ProbeResult(component_states.ok, 'success', 0.05, None, {})
+        states = self.connection.run_probes(
+            {uptime_mon.COMPONENT_REST_API: self.probe(ok),
+             uptime_mon.COMPONENT_HEALTHCHECK_API: self.probe(ok)},
+            6, 4, time.time() + 10)
+        self.assertEqual({uptime_mon.COMPONENT_REST_API: component_states.ok,
+                          uptime_mon.COMPONENT_HEALTHCHECK_API:
+                          component_states.ok}, states)
+        self.assertEqual(12, len(self.calls))
+        self.assertEqual(4, self.most_active)
+        self.assertEqual(6, self.connection.latency[
+            (uptime_mon.COMPONENT_REST_API, 'num-samples')])
+
+    def test_concurrent_object_store_probes(self):
+        swift = FakeSwift({}, delay=0.01)
+        mock.patch('swiftlm.cli.uptime_mon.Connection', swift).start()
+        self.addCleanup(mock.patch.stopall)
+        self.connection.url = 'http://H:8080/v1/AUTH_test'
+        self.connection.token = 'token'
+        self.connection.token_expires = time.time() + 3600
+        states = self.connection.run_probes(
+            {uptime_mon.COMPONENT_REST_API:
+             self.connection.probe_object_store}, 40, 10, time.time() + 10)
+        self.assertEqual(component_states.ok,
+                         states[uptime_mon.COMPONENT_REST_API])
+        # Every probe used an object of its own, and cleaned it up
+        self.assertEqual(40, len(swift.names))
+        self.assertEqual({}, swift.objects)
+
+    def test_failure_stops_component(self):
+        fail = ProbeResult(component_states.fail, 'ECONNREFUSED', 0.01, None,
+                           {})
+        states = self.connection.run_probes(
+            {uptime_mon.COMPONENT_REST_API: self.probe(fail, 0.01)},
+            10, 1, time.time() + 10)
+        self.assertEqual(component_states.fail,
+                         states[uptime_mon.COMPONENT_REST_API])
+        self.assertEqual(1, len(self.calls))
+        state = self.connection.state[uptime_mon.COMPONENT_REST_API]
+        self.assertEqual('ECONNREFUSED', state['reason'])
+
+    def test_deadline(self):
+        ok = ProbeResult(component_states.ok, 'success', 5, None, {})
+        start = time.time()
+        states = self.connection.run_probes(
+            {uptime_mon.COMPONENT_HEALTHCHECK_API: self.probe(ok, 5)},
+            2, 2, time.time() + 0.2)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(component_states.fail,
+                         states[uptime_mon.COMPONENT_HEALTHCHECK_API])
+        state = self.connection.state[uptime_mon.COMPONENT_HEALTHCHECK_API]
+        self.assertEqual('probe did not complete before the cycle deadline',
+                         state['reason'])
+
+    def test_backend_latency(self):
+        ok = component_states.ok
+        probes = iter([ProbeResult(ok, 'success', 0.01, 'proxy1', {}),
+                       ProbeResult(ok, 'success', 0.5, 'proxy2', {}),
+                       ProbeResult(ok, 'success', 0.011, 'proxy1', {}),
+                       ProbeResult(ok, 'success', 0.4, 'proxy2', {})])
+        self.connection.run_probes(
+            {uptime_mon.COMPONENT_REST_API: lambda deadline: next(probes)},
+            4, 1, time.time() + 10)
+        self.connection.latency_write_log()
+
+        medians = dict()
+        slowest = []
+        for measurement in self.connection.metric_data:
+            if measurement['metric'] == uptime_mon.BACKEND_LATENCY:
+                medians[measurement['dimensions']['backend']] = \
+                    measurement['value']
+            if measurement['metric'] == uptime_mon.SLOWEST_BACKEND:
+                slowest.append((measurement['dimensions']['backend'],
+                                measurement['value']))
+        self.assertEqual(['proxy1', 'proxy2'], sorted(medians))
+        self.assertAlmostEqual(0.01, medians['proxy1'], places=3)
+        # The median is the upper bound of the bucket holding 0.4
+        self.assertLessEqual(0.4, medians['proxy2'])
+        self.assertLess(medians['proxy2'], 0.4 * (1 + 1 / 32.0))
+        self.assertEqual([('proxy2', medians['proxy2'])], slowest)
+
+    def test_health_check_proxy_hosts(self):
+        connection = TrackConnection('http://H:35357/v2.0', 'swift-monitor',
+                                     'changeme',
+                                     logging.getLogger(name='test'),
+                                     '/path/to/uptime.stats',
+                                     object_store_url='https://H:8080/v1/',
+                                     proxy_hosts=['p1:8080', 'p2:8080'])
+        urls = []
+
+        def fake_health_check(url, logger, timeout=None):
+            urls.append(url)
+            return {}
+        with mock.patch('swiftlm.cli.uptime_mon.health_check',
+                        fake_health_check):
+            backends = [connection.probe_health_check(time.time() + 10)[3]
+                        for _ in range(3)]
+        self.assertEqual(['p1:8080', 'p2:8080', 'p1:8080'], backends)
+        self.assertEqual(['https://p1:8080/', 'https://p2:8080/',
+                          'https://p1:8080/'], urls)
+
+    def test_percentiles(self):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        cache_file_path = os.path.join(testdir, 'uptime.stats')
+        connection = TrackConnection('http://H:35357/v2.0', 'swift-monitor',
+                                     'changeme',
+                                     logging.getLogger(name='test'),
+                                     cache_file_path,
+                                     object_store_url='http://H:8080/v1/')
+        operations = dict((operation, 0.01)
+                          for operation in uptime_mon.OPERATIONS)
+        operations['put-object'] = 0.1
+        probe = ProbeResult(component_states.ok, 'success', 0.2, None,
+                            operations)
+        connection.run_probes(
+            {uptime_mon.COMPONENT_REST_API: lambda deadline: probe},
+            10, 2, time.time() + 10)
+        connection.latency_write_log()
+
+        def percentiles(connection):
+            found = dict()
+            for measurement in connection.metric_data:
+                if measurement['metric'] == uptime_mon.PERCENTILE_LATENCY % 99:
+                    dimensions = measurement['dimensions']
+                    name = dimensions.get('operation',
+                                          dimensions['component'])
+                    found[name] = measurement['value']
+            return found
+
+        found = percentiles(connection)
+        self.assertEqual(sorted(uptime_mon.OPERATIONS +
+                                (uptime_mon.COMPONENT_REST_API,)),
+                         sorted(found))
+        self.assertAlmostEqual(0.1, found['put-object'])
+        self.assertAlmostEqual(0.01, found['get-object'])
+
+        # The histograms survive a restart
+        restarted = TrackConnection('http://H:35357/v2.0', 'swift-monitor',
+                                    'changeme',
+                                    logging.getLogger(name='test'),
+                                    cache_file_path,
+                                    object_store_url='http://H:8080/v1/')
+        restarted.latency_write_log()
+        self.assertEqual(found, percentiles(restarted))
+
+        # Samples are dropped after two windows
+        restarted.histogram_roll(time.time() + uptime_mon.HISTOGRAM_WINDOW)
+        restarted.histogram_roll(time.time() +
+                                 3 * uptime_mon.HISTOGRAM_WINDOW)
+        restarted.metric_data_reset()
+        restarted.percentile_write_log()
+        self.assertEqual({}, percentiles(restarted))
+
+    def test_uptime_survives_restart(self):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        cache_file_path = os.path.join(testdir, 'uptime.stats')
+        connection = TrackConnection('http://H:35357/v2.0', 'swift-monitor',
+                                     'changeme',
+                                     logging.getLogger(name='test'),
+                                     cache_file_path,
+                                     object_store_url='http://H:8080/v1/')
+        connection.uptime_record(uptime_mon.SWIFT_DOWN)
+
+        restarted = TrackConnection('http://H:35357/v2.0', 'swift-monitor',
+                                    'changeme',
+                                    logging.getLogger(name='test'),
+                                    cache_file_path,
+                                    object_store_url='http://H:8080/v1/')
+        restarted.emit_avail_metrics()
+        values = dict((m['metric'], m['value'])
+                      for m in restarted.metric_data)
+        self.assertEqual(0, values[uptime_mon.AVAIL_MINUTE])
+        self.assertEqual(0.0, values[uptime_mon.AVAIL_DAY])
+
+    def test_object_profiles(self):
+        objects = dict()
+        self.connection.token = 'token'
+        self.connection.url = 'http://H:8080/v1/AUTH_test'
+        profiles = [uptime_mon.ObjectProfile('small', 4096, None, 'slo', 1),
+                    uptime_mon.ObjectProfile('slo', 300000, 65536, 'slo', 1),
+                    uptime_mon.ObjectProfile('dlo', 300000, 65536, 'dlo', 1)]
+        with mock.patch('swiftlm.cli.uptime_mon.Connection',
+                        FakeSwift(objects)):
+            self.connection.run_object_profiles(profiles, time.time() + 10)
+        # Everything is cleaned up, segments included
+        self.assertEqual({}, objects)
+
+        found = dict()
+        for measurement in self.connection.metric_data:
+            found[(measurement['metric'],
+                   measurement['dimensions']['profile'])] = \
+                measurement['value']
+        for profile in ('small', 'slo', 'dlo'):
+            for metric in (uptime_mon.OBJECT_TTFB, uptime_mon.OBJECT_PUT_RATE,
+                           uptime_mon.OBJECT_GET_RATE):
+                self.assertGreater(found[(metric, profile)], 0)
+
+    def test_object_profile_names_unique(self):
+        swift = FakeSwift({})
+        self.connection.token = 'token'
+        profile = uptime_mon.ObjectProfile('slo', 300000, 65536, 'slo', 1)
+        with mock.patch('swiftlm.cli.uptime_mon.Connection', swift):
+            for run in range(2):
+                self.assertIsNotNone(self.connection.probe_object_profile(
+                    profile, time.time() + 10))
+        objects = [o for c, o in swift.names
+                   if c == uptime_mon.TEST_CONTAINER]
+        self.assertEqual(2, len(set(objects)))
+        # Each run's segments are below its own object name
+        for c, o in swift.names:
+            if c == uptime_mon.SEGMENT_CONTAINER:
+                self.assertIn(o.split('/')[0], objects)
+        self.assertEqual(12, len(swift.names))
+
+    def test_object_profile_short_read(self):
+        class ShortSwift(FakeSwift):
+            def get_object(self, container, obj, resp_chunk_size=None):
+                return {}, iter(['x'])
+
+        objects = dict()
+        self.connection.token = 'token'
+        with mock.patch('swiftlm.cli.uptime_mon.Connection',
+                        ShortSwift(objects)):
+            self.assertIsNone(self.connection.probe_object_profile(
+                uptime_mon.ObjectProfile('small', 4096, None, 'slo', 1),
+                time.time() + 10))
+        self.assertEqual({}, objects)
+
+    def test_no_token(self):
+        self.connection.token = None
+        self.assertEqual(component_states.fail,
+                         self.connection.check_object_store())
+        state = self.connection.state[uptime_mon.COMPONENT_REST_API]
+        self.assertEqual('Authentication failed', state['reason'])
+
+
 if __name__ == "__main__":
     all_tests = unittest.TestSuite()
     all_tests.addTest(unittest.makeSuite(TestArgumentParser))
     all_tests.addTest(unittest.makeSuite(TestArgumentValidator))
     all_tests.addTest(unittest.makeSuite(TestTrackConnection))
+    all_tests.addTest(unittest.makeSuite(TestObjectData))
+    all_tests.addTest(unittest.makeSuite(TestUptimeWindow))
+    all_tests.addTest(unittest.makeSuite(TestBackendName))
+    all_tests.addTest(unittest.makeSuite(TestTokenCache))
+    all_tests.addTest(unittest.makeSuite(TestRunProbes))
     unittest.TextTestRunner().run(all_tests)
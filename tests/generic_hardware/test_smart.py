@@ -0,0 +1,354 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+import os
+import struct
+import tempfile
+import unittest
+from shutil import rmtree
+
+import mock
+
+from swiftlm.generic_hardware import smart
+from swiftlm.utils.utility import CommandResult
+
+
+def make_ata_smart_data(attributes):
+    """
+    :param attributes: list of (id, normalised value, raw value)
+    :returns: a SMART READ DATA response
+    """
+    data = struct.pack('<H', 16)
+    for attr_id, value, raw in attributes:
+        data += struct.pack('<BHBBIHB', attr_id, 0x33, value, value,
+                            raw & 0xffffffff, raw >> 32, 0)
+    return data + b'\0' * (512 - len(data))
+
+
+def make_nvme_health_log(temperature, used, media_errors):
+    data = struct.pack('<BHBBB', 0, temperature, 100, 10, used)
+    data += b'\0' * (160 - len(data))
+    data += struct.pack('<QQ', media_errors & (2 ** 64 - 1),
+                        media_errors >> 64)
+    return data + b'\0' * (512 - len(data))
+
+
+SMARTCTL_SAS = {
+    'smartctl': {'exit_status': 0},
+    'temperature': {'current': 31},
+    'scsi_grown_defect_list': 4,
+    'scsi_error_counter_log': {
+        'read': {'total_uncorrected_errors': 1},
+        'write': {'total_uncorrected_errors': 2},
+        'verify': {'total_uncorrected_errors': 0},
+    },
+}
+
+SMARTCTL_ATA = {
+    'smartctl': {'exit_status': 4},
+    'temperature': {'current': 29},
+    'ata_smart_attributes': {'table': [
+        {'id': 5, 'value': 100, 'raw': {'value': 3}},
+        {'id': 197, 'value': 100, 'raw': {'value': 1}},
+        {'id': 233, 'value': 93, 'raw': {'value': 0}},
+    ]},
+}
+
+SMARTCTL_NVME = {
+    'smartctl': {'exit_status': 0},
+    'temperature': {'current': 40},
+    'nvme_smart_health_information_log': {'media_errors': 0,
+                                          'percentage_used': 2},
+}
+
+
+class TestParsing(unittest.TestCase):
+
+    def test_parse_ata_smart(self):
+        data = make_ata_smart_data([(5, 100, 12), (194, 70, 0x2d00120024),
+                                    (197, 100, 2), (187, 100, 7),
+                                    (177, 88, 1234)])
+        attributes = smart.parse_ata_smart(data)
+        self.assertEqual((100, 12), attributes[5])
+        self.assertEqual((70, 0x2d00120024), attributes[194])
+        self.assertEqual(5, len(attributes))
+        self.assertEqual({'reallocated_sectors': 12,
+                          'pending_sectors': 2,
+                          'media_errors': 7,
+                          'temperature': 0x24,
+                          'wear_level': 12},
+                         smart.ata_reading(attributes))
+
+    def test_ata_reading_hdd(self):
+        data = make_ata_smart_data([(5, 100, 0), (190, 70, 30)])
+        self.assertEqual({'reallocated_sectors': 0, 'temperature': 30},
+                         smart.ata_reading(smart.parse_ata_smart(data)))
+
+    def test_parse_nvme_health(self):
+        data = make_nvme_health_log(310, 3, 2 ** 64 + 5)
+        self.assertEqual({'temperature': 37, 'wear_level': 3,
+                          'media_errors': 2 ** 64 + 5},
+                         smart.parse_nvme_health(data))
+
+    def test_smartctl_reading(self):
+        self.assertEqual({'reallocated_sectors': 4, 'media_errors': 3,
+                          'temperature': 31},
+                         smart.smartctl_reading(SMARTCTL_SAS))
+        # exit status 4 is a failed SMART command, but there is data
+        self.assertEqual({'reallocated_sectors': 3, 'pending_sectors': 1,
+                          'wear_level': 7, 'temperature': 29},
+                         smart.smartctl_reading(SMARTCTL_ATA))
+        self.assertEqual({'media_errors': 0, 'wear_level': 2,
+                          'temperature': 40},
+                         smart.smartctl_reading(SMARTCTL_NVME))
+
+    def test_smartctl_reading_failed(self):
+        self.assertIsNone(smart.smartctl_reading(
+            {'smartctl': {'exit_status': 2}}))
+        self.assertIsNone(smart.smartctl_reading(
+            {'smartctl': {'exit_status': 0}}))
+
+
+class TestGetDrives(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+
+    def make_drive(self, name, files):
+        for path, content in files.items():
+            path = os.path.join(self.testdir, name, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content + '\n')
+
+    def test_get_drives(self):
+        self.make_drive('sda', {'removable': '0',
+                                'device/vendor': 'ATA     ',
+                                'device/wwid': 'naa.5000c500a1b2c3d4'})
+        self.make_drive('sdb', {'removable': '0',
+                                'device/vendor': 'SEAGATE '})
+        self.make_drive('sdc', {'removable': '1',
+                                'device/vendor': 'Generic'})
+        self.make_drive('nvme0n1', {'removable': '0',
+                                    'wwid': 'eui.0025385b71b1d2e3'})
+        self.make_drive('nvme1n1', {'device/serial': 'S3EVNX0J'})
+        for name in ('sda1', 'loop0', 'dm-0', 'md127', 'nvme0c0n1'):
+            self.make_drive(name, {'removable': '0'})
+
+        self.assertEqual(
+            [smart.Drive('nvme0n1', 'nvme', 'eui.0025385b71b1d2e3'),
+             smart.Drive('nvme1n1', 'nvme', 'S3EVNX0J'),
+             smart.Drive('sda', 'ata', 'naa.5000c500a1b2c3d4'),
+             smart.Drive('sdb', 'scsi', None)],
+            smart.get_drives(self.testdir))
+
+
+class TestReadDrive(unittest.TestCase):
+
+    def test_ioctl(self):
+        drive = smart.Drive('sda', 'ata', None)
+        with mock.patch('swiftlm.generic_hardware.smart.read_ata_smart',
+                        return_value={'temperature': 30}) as m:
+            with mock.patch('swiftlm.generic_hardware.smart.run_cmd') as rc:
+                self.assertEqual({'temperature': 30},
+                                 smart.read_drive(drive))
+        m.assert_called_once_with('/dev/sda')
+        self.assertFalse(rc.called)
+
+    def test_smartctl_fallback(self):
+        drive = smart.Drive('nvme0n1', 'nvme', None)
+        rc = CommandResult(0, json.dumps(SMARTCTL_NVME))
+        with mock.patch('swiftlm.generic_hardware.smart.read_nvme_health',
+                        side_effect=IOError(25, 'ENOTTY')):
+            with mock.patch('swiftlm.generic_hardware.smart.run_cmd',
+                            return_value=rc) as m:
+                self.assertEqual({'media_errors': 0, 'wear_level': 2,
+                                  'temperature': 40},
+                                 smart.read_drive(drive))
+        m.assert_called_once_with('smartctl --json -A /dev/nvme0n1')
+
+    def test_sas_uses_smartctl(self):
+        drive = smart.Drive('sdb', 'scsi', None)
+        with mock.patch('swiftlm.generic_hardware.smart.run_cmd',
+                        return_value=CommandResult(
+                            0, 'smartctl: command not found')):
+            self.assertIsNone(smart.read_drive(drive))
+
+    def test_smartctl_not_installed(self):
+        drive = smart.Drive('sdb', 'scsi', None)
+        with mock.patch('swiftlm.generic_hardware.smart.run_cmd') as rc:
+            self.assertIsNone(smart.read_drive(drive, smartctl=False))
+        self.assertFalse(rc.called)
+
+    def test_smartctl_installed(self):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        empty = os.path.join(testdir, 'empty')
+        os.mkdir(empty)
+        path = os.pathsep.join([empty, testdir])
+        self.assertFalse(smart.smartctl_installed(path))
+        smartctl = os.path.join(testdir, 'smartctl')
+        with open(smartctl, 'w') as f:
+            f.write('#!/bin/sh\n')
+        self.assertFalse(smart.smartctl_installed(path))
+        os.chmod(smartctl, 0o755)
+        self.assertTrue(smart.smartctl_installed(path))
+
+
+class TestCheckDrives(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.drives = [smart.Drive('sda', 'ata', 'id-a'),
+                       smart.Drive('nvme0n1', 'nvme', 'id-n')]
+        self.readings = {'sda': {'reallocated_sectors': 10,
+                                 'pending_sectors': 0, 'temperature': 30},
+                         'nvme0n1': {'media_errors': 0, 'wear_level': 1,
+                                     'temperature': 40}}
+        self.reads = []
+        self.read_drive = smart.read_drive
+        for name, patched in (
+                ('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir),
+                ('swiftlm.generic_hardware.smart.get_drives',
+                 lambda: self.drives),
+                ('swiftlm.generic_hardware.smart.read_drive',
+                 self.fake_read_drive),
+                ('swiftlm.generic_hardware.smart.smartctl_installed',
+                 lambda: True),
+                ('swiftlm.utils.metricdata.timestamp', lambda: 123456)):
+            mock.patch(name, patched).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def fake_read_drive(self, drive, smartctl=True):
+        self.reads.append(drive.name)
+        if self.readings[drive.name] is None:
+            return None
+        return dict(self.readings[drive.name])
+
+    def values(self, results):
+        return dict(
+            ((r.name.split('.')[-1], r.dimensions['device']), r.value)
+            for r in results)
+
+    def test_check_drives(self):
+        results = smart.check_drives(now=1000)
+        self.assertEqual({('reallocated_sectors', 'sda'): 10,
+                          ('pending_sectors', 'sda'): 0,
+                          ('temperature', 'sda'): 30,
+                          ('media_errors', 'nvme0n1'): 0,
+                          ('wear_level', 'nvme0n1'): 1,
+                          ('temperature', 'nvme0n1'): 40},
+                         self.values(results))
+        r = results[0]
+        self.assertEqual('swiftlm.generic_hardware.smart.reallocated_sectors',
+                         r.name)
+        self.assertEqual('physical_drive', r.dimensions['component'])
+        self.assertEqual(['nvme0n1', 'sda'], sorted(self.reads))
+
+    def test_rates(self):
+        smart.check_drives(now=1000)
+        # Within the ttl the saved readings are reported
+        self.reads = []
+        self.readings['sda']['reallocated_sectors'] = 12
+        results = smart.check_drives(now=1100)
+        self.assertEqual([], self.reads)
+        self.assertEqual(10, self.values(results)[('reallocated_sectors',
+                                                   'sda')])
+
+        # Half a day later
+        results = smart.check_drives(now=1000 + 43200)
+        self.assertEqual(['nvme0n1', 'sda'], sorted(self.reads))
+        values = self.values(results)
+        self.assertEqual(12, values[('reallocated_sectors', 'sda')])
+        self.assertEqual(4, values[('reallocated_sectors_per_day', 'sda')])
+        self.assertEqual(0, values[('pending_sectors_per_day', 'sda')])
+        self.assertEqual(0, values[('media_errors_per_day', 'nvme0n1')])
+        self.assertNotIn(('temperature_per_day', 'sda'), values)
+
+    def test_replaced_drive(self):
+        smart.check_drives(now=1000)
+        self.drives[0] = smart.Drive('sda', 'ata', 'id-new')
+        self.readings['sda']['reallocated_sectors'] = 0
+        self.reads = []
+        results = smart.check_drives(now=1100)
+        self.assertEqual(['sda'], self.reads)
+        values = self.values(results)
+        self.assertEqual(0, values[('reallocated_sectors', 'sda')])
+        self.assertNotIn(('reallocated_sectors_per_day', 'sda'), values)
+
+    def test_unreadable_drive(self):
+        smart.check_drives(now=1000)
+        self.readings['sda'] = None
+        self.readings['nvme0n1']['media_errors'] = 2
+        results = smart.check_drives(now=1000 + 86400)
+        values = self.values(results)
+        self.assertNotIn(('temperature', 'sda'), values)
+        self.assertEqual(2, values[('media_errors_per_day', 'nvme0n1')])
+
+        # The rate is measured from the last good reading
+        self.readings['sda'] = {'reallocated_sectors': 14}
+        results = smart.check_drives(now=1000 + 2 * 86400)
+        self.assertEqual(2, self.values(results)[
+            ('reallocated_sectors_per_day', 'sda')])
+
+    def test_unreadable_drive_not_retried(self):
+        self.drives = [smart.Drive('sda', 'ata', 'id-a'),
+                       smart.Drive('sdb', 'scsi', 'id-b')]
+        mock.patch('swiftlm.generic_hardware.smart.read_drive',
+                   self.read_drive).start()
+        mock.patch('swiftlm.generic_hardware.smart.read_ata_smart',
+                   side_effect=IOError(25, 'ENOTTY')).start()
+        run_cmd = mock.patch(
+            'swiftlm.generic_hardware.smart.run_cmd',
+            return_value=CommandResult(0, json.dumps(SMARTCTL_NVME))).start()
+        first = self.values(smart.check_drives(now=1000))
+        self.assertEqual(2, run_cmd.call_count)
+        self.assertEqual(40, first[('temperature', 'sdb')])
+
+        # After the ttl smartctl fails for both drives, which are not
+        # reported
+        run_cmd.reset_mock()
+        run_cmd.return_value = CommandResult(
+            127, 'sh: smartctl: command not found')
+        self.assertEqual([], smart.check_drives(now=1000 + 300))
+        self.assertEqual(2, run_cmd.call_count)
+
+        # and are not read again within the ttl
+        run_cmd.reset_mock()
+        self.assertEqual([], smart.check_drives(now=1000 + 400))
+        self.assertFalse(run_cmd.called)
+
+        # The rate is measured from the last good reading
+        run_cmd.return_value = CommandResult(0, json.dumps(SMARTCTL_NVME))
+        results = self.values(smart.check_drives(now=1000 + 86400))
+        self.assertEqual(2, run_cmd.call_count)
+        self.assertEqual(0, results[('media_errors_per_day', 'sdb')])
+
+    def test_smartctl_looked_for_once(self):
+        self.drives = [smart.Drive('sdb', 'scsi', 'id-b'),
+                       smart.Drive('sdc', 'scsi', 'id-c')]
+        mock.patch('swiftlm.generic_hardware.smart.read_drive',
+                   self.read_drive).start()
+        installed = mock.patch(
+            'swiftlm.generic_hardware.smart.smartctl_installed',
+            return_value=False).start()
+        with mock.patch('swiftlm.generic_hardware.smart.run_cmd') as rc:
+            self.assertEqual([], smart.check_drives(now=1000))
+        self.assertFalse(rc.called)
+        self.assertEqual(1, installed.call_count)
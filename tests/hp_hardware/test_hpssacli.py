@@ -15,9 +15,13 @@
 #
 
 
+import os
+import tempfile
+import time
 import unittest
 import mock
 import pprint
+from shutil import rmtree
 
 from swiftlm.hp_hardware import hpssacli
 from swiftlm.utils.metricdata import MetricData
@@ -878,3 +882,143 @@ Controller 3 text here
                     for sbbbb in sbbb.subblocks:
                         result.append('....%s' % sbbbb.text)
         self.assertEqual(expected, result)
+
+    def test_scan_deeply_nested_text(self):
+        # One line per indent level; the scanner must not recurse
+        depth = 5000
+        lines = ['%s%d' % (' ' * n, n) for n in range(depth)]
+        block = hpssacli.TextScanner(lines).get_root_block()
+        for n in range(depth):
+            self.assertEqual(1, len(block.subblocks))
+            block = block.subblocks[0]
+            self.assertEqual(str(n), block.text)
+        self.assertEqual([], block.subblocks)
+
+    def test_scan_blocks(self):
+        lines = MULTIPLE_PHYSICAL_DRIVE_DATA.split('\n')
+        root = hpssacli.TextScanner(lines).get_root_block()
+        expected = []
+        for controller in root.subblocks:
+            for assignment in controller.subblocks:
+                for pd in assignment.subblocks:
+                    expected.append(
+                        ([controller.text, assignment.text], pd))
+
+        actual = list(hpssacli.scan_blocks(lines, 3))
+        self.assertEqual(len(expected), len(actual))
+        self.assertEqual(3, len(actual))
+        for (e_ancestors, e_pd), (ancestors, pd) in zip(expected, actual):
+            self.assertEqual(e_ancestors, ancestors)
+            self.assertEqual(e_pd.text, pd.text)
+            self.assertEqual([a.text for a in e_pd.subblocks],
+                             [a.text for a in pd.subblocks])
+
+    def test_scan_blocks_outermost(self):
+        lines = ['a', ' a1', '  a11', 'b', '', ' b1']
+        actual = [(ancestors, block.text,
+                   [sb.text for sb in block.subblocks])
+                  for ancestors, block in hpssacli.scan_blocks(lines, 1)]
+        self.assertEqual([([], 'a', ['a1']), ([], 'b', ['b1'])], actual)
+
+
+class TestScannerBenchmark(unittest.TestCase):
+    """
+    Parse hpssacli output for a controller with many drives.
+
+    Parsing should be linear in the size of the output.
+    """
+    copies = 500
+
+    def get_info(self, func, data):
+        mock_command = mock.Mock()
+        mock_command.return_value = CommandResult(0, data)
+        with mock.patch('swiftlm.hp_hardware.hpssacli.run_cmd',
+                        mock_command):
+            return func('1')
+
+    def check_scaling(self, func, data):
+        single = self.get_info(func, data)
+        start = time.time()
+        actual = self.get_info(func, data * self.copies)
+        elapsed = time.time() - start
+        self.assertEqual(len(single) * self.copies, len(actual))
+        self.assertLess(elapsed, 10)
+
+    def test_physical_drives(self):
+        self.check_scaling(hpssacli.get_physical_drive_info,
+                           MULTIPLE_PHYSICAL_DRIVE_DATA)
+
+    def test_logical_drives(self):
+        self.check_scaling(hpssacli.get_logical_drive_info,
+                           MULTIPLE_LOGICAL_DRIVE_DATA)
+
+
+class TestOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        p = mock.patch('swiftlm.utils.metricdata.timestamp',
+                       lambda: 123456)
+        p.start()
+        self.addCleanup(p.stop)
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        p = mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                       self.testdir)
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch('swiftlm.hp_hardware.hpssacli.CONFIG_FILE',
+                       os.path.join(self.testdir, 'swiftlm-scan.conf'))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def fake_run_cmd(self, cmd):
+        if 'ctrl all show detail' in cmd:
+            return CommandResult(0, SMART_ARRAY_DATA)
+        if 'pd all show detail' in cmd:
+            return CommandResult(0, PHYSICAL_DRIVE_DATA)
+        return CommandResult(0, LOGICAL_DRIVE_DATA)
+
+    def test_run_hpssacli(self):
+        run_cmd = mock.Mock(side_effect=[CommandResult(1, 'busy'),
+                                         CommandResult(0, 'output')])
+        cache = {}
+        with mock.patch('swiftlm.hp_hardware.hpssacli.run_cmd', run_cmd):
+            # failures are not cached
+            self.assertEqual(hpssacli.run_hpssacli('ctrl all show', cache),
+                             CommandResult(1, 'busy'))
+            self.assertEqual(cache, {})
+            self.assertEqual(hpssacli.run_hpssacli('ctrl all show', cache),
+                             CommandResult(0, 'output'))
+            self.assertEqual(hpssacli.run_hpssacli('ctrl all show', cache),
+                             CommandResult(0, 'output'))
+        self.assertEqual(run_cmd.call_count, 2)
+        run_cmd.assert_called_with(hpssacli.LOCK_FILE_COMMAND +
+                                   'hpssacli ctrl all show')
+
+    def test_main_reuses_output(self):
+        run_cmd = mock.Mock(side_effect=self.fake_run_cmd)
+        now = [1000.0]
+        with mock.patch('swiftlm.hp_hardware.hpssacli.run_cmd', run_cmd):
+            with mock.patch('swiftlm.hp_hardware.hpssacli.time.time',
+                            lambda: now[0]):
+                first = hpssacli.main()
+                self.assertEqual(run_cmd.call_count, 3)
+
+                now[0] += hpssacli.OUTPUT_CACHE_TTL - 1
+                second = hpssacli.main()
+                self.assertEqual(run_cmd.call_count, 3)
+                self.assertEqual([m.metric() for m in first],
+                                 [m.metric() for m in second])
+
+                now[0] += 1
+                hpssacli.main()
+                self.assertEqual(run_cmd.call_count, 6)
+
+    def test_main_cache_ttl_conf(self):
+        with open(hpssacli.CONFIG_FILE, 'w') as f:
+            f.write('[hpssacli]\ncache_ttl = 0\n')
+        run_cmd = mock.Mock(side_effect=self.fake_run_cmd)
+        with mock.patch('swiftlm.hp_hardware.hpssacli.run_cmd', run_cmd):
+            hpssacli.main()
+            hpssacli.main()
+        self.assertEqual(run_cmd.call_count, 6)
@@ -15,15 +15,20 @@
 #
 
 
+import errno
+import json
+import os
 import socket
 import subprocess
 import unittest
 import tempfile
+from shutil import rmtree
 
 from mock import patch, MagicMock
 import time
 
 from swiftlm.swift import drive_audit
+from swiftlm.utils.utility import MountEntry
 from swiftlm.utils.metricdata import MetricData
 from swiftlm.utils.values import Severity
 from tests.data.drive_audit_data import output1, output2, output3
@@ -115,9 +120,11 @@ class TestMain(unittest.TestCase):
         scenarios = (({'mount_point': '/srv/node/sdc1'}, Severity.ok,
                       'No errors found on device mounted at: /srv/node/sdc1'),
                      ({'mount_point': '/srv/node/sdb1'}, Severity.fail,
-                      'Errors found on device mounted at: /srv/node/sdb1'),
+                      'Errors found on device mounted at: /srv/node/sdb1'
+                      ' (516 errors)'),
                      ({'mount_point': '/srv/node/sdd1'}, Severity.fail,
-                      'Errors found on device mounted at: /srv/node/sdd1'))
+                      'Errors found on device mounted at: /srv/node/sdd1'
+                      ' (3 errors)'))
         expected = []
         for scenario in scenarios:
             expected_dimensions = dict(self.expected_dimensions_base)
@@ -151,3 +158,263 @@ class TestMain(unittest.TestCase):
                                     value=Severity.warn,
                                     value_meta=expected_value_meta))
         self.assertEquals(expected_metric, result.metric())
+
+
+class FakeKmsg(object):
+    """
+    Stands in for os.open/os.read/os.close of /dev/kmsg, returning one
+    record per read and EAGAIN at the end of the log.
+    """
+    def __init__(self, records):
+        self.records = list(records)
+
+    def open(self, path, flags):
+        return 99
+
+    def read(self, fd, size):
+        if not self.records:
+            raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+        record = self.records.pop(0)
+        if isinstance(record, Exception):
+            raise record
+        return record
+
+    def close(self, fd):
+        pass
+
+    def patch(self, test):
+        for name in ('open', 'read', 'close'):
+            p = patch('swiftlm.swift.drive_audit.os.%s' % name,
+                      getattr(self, name))
+            p.start()
+            test.addCleanup(p.stop)
+
+
+def kmsg_record(seq, message):
+    return '3,%d,%d,-;%s\n SUBSYSTEM=block\n' % (seq, seq * 1000, message)
+
+
+class TestKernelLog(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        p = patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        p.start()
+        self.addCleanup(p.stop)
+        p = patch('swiftlm.swift.drive_audit.get_boot_id', lambda: 'boot1')
+        p.start()
+        self.addCleanup(p.stop)
+        # The records of kmsg_record are logged in the first second of uptime
+        self.uptime = 1.0
+        self.get_uptime = drive_audit.get_uptime
+        p = patch('swiftlm.swift.drive_audit.get_uptime',
+                  lambda: self.uptime)
+        p.start()
+        self.addCleanup(p.stop)
+        self.conf = drive_audit.get_drive_audit_conf('/nonexistent')
+        self.conf['recon_cache_path'] = self.testdir
+        self.mounts = {
+            '/srv/node/disk0': MountEntry('40', '/dev/sdb1',
+                                          '/srv/node/disk0', 'xfs', 'rw'),
+            '/srv/node/disk1': MountEntry('41', '/dev/sdc1',
+                                          '/srv/node/disk1', 'xfs', 'rw'),
+            '/': MountEntry('20', '/dev/sda1', '/', 'ext4', 'rw')}
+        p = patch('swiftlm.swift.drive_audit.get_mounts',
+                  lambda: self.mounts)
+        p.start()
+        self.addCleanup(p.stop)
+        self.unmounted = []
+        self.unmount_device = drive_audit.unmount_device
+        p = patch('swiftlm.swift.drive_audit.unmount_device',
+                  lambda mount: self.unmounted.append(mount) or True)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_disk_name(self):
+        self.assertEqual(drive_audit.disk_name('sdb1'), 'sdb')
+        self.assertEqual(drive_audit.disk_name('sdb'), 'sdb')
+        self.assertEqual(drive_audit.disk_name('sdab12'), 'sdab')
+        self.assertEqual(drive_audit.disk_name('nvme0n1p1'), 'nvme0n1')
+        self.assertEqual(drive_audit.disk_name('nvme0n1'), 'nvme0n1')
+
+    def test_get_kernel_devices(self):
+        self.assertEqual(
+            drive_audit.get_kernel_devices(self.mounts, '/srv/node/'),
+            {'sdb': '/srv/node/disk0', 'sdc': '/srv/node/disk1'})
+
+    def test_get_drive_audit_conf(self):
+        with tempfile.NamedTemporaryFile('w+') as f:
+            f.write('[drive-audit]\n'
+                    'minutes = 10\n'
+                    'error_limit = 3\n'
+                    'unmount_failed_device = no\n'
+                    'regex_pattern_1 = \\bfailed\\b.*(sd[a-z]+)\n')
+            f.flush()
+            conf = drive_audit.get_drive_audit_conf(f.name)
+        self.assertEqual(conf['minutes'], 10)
+        self.assertEqual(conf['error_limit'], 3)
+        self.assertFalse(conf['unmount_failed_device'])
+        self.assertTrue(self.conf['unmount_failed_device'])
+        self.assertEqual([r.pattern for r in conf['error_re']],
+                         [r'\bfailed\b.*(sd[a-z]+)'])
+        self.assertEqual(len(self.conf['error_re']), 2)
+
+    def test_read_kmsg(self):
+        FakeKmsg([kmsg_record(1, 'one'),
+                  OSError(errno.EPIPE, 'Broken pipe'),
+                  kmsg_record(3, 'three'),
+                  'garbage',
+                  kmsg_record(4, 'four')]).patch(self)
+        self.assertEqual(drive_audit.read_kmsg(1),
+                         [(3, 3000, 'three'), (4, 4000, 'four')])
+
+    def test_scan_is_incremental(self):
+        error = 'blk_update_request: I/O error, dev sdb, sector 1234'
+        now = 1000000
+        state = {}
+        FakeKmsg([kmsg_record(1, error),
+                  kmsg_record(2, 'sd 2:0:0:0: [sdc1] attached')]).patch(self)
+        drive_audit.scan_kernel_log(state, self.conf['error_re'], now)
+        self.assertEqual(state['seq'], 2)
+        self.assertEqual(drive_audit.error_counts(state, 60, now),
+                         {'sdb': 1})
+
+        # the same records are seen again, plus one new one
+        FakeKmsg([kmsg_record(1, error),
+                  kmsg_record(2, 'sd 2:0:0:0: [sdc1] attached'),
+                  kmsg_record(3, error)]).patch(self)
+        drive_audit.scan_kernel_log(state, self.conf['error_re'], now + 60)
+        self.assertEqual(state['seq'], 3)
+        self.assertEqual(drive_audit.error_counts(state, 60, now + 60),
+                         {'sdb': 2})
+
+        # older errors drop out of the window
+        self.assertEqual(drive_audit.error_counts(state, 60, now + 3630),
+                         {'sdb': 1})
+        self.assertEqual(drive_audit.error_counts(state, 60, now + 7200),
+                         {})
+        self.assertEqual(state['errors'], {})
+
+    def test_scan_after_reboot(self):
+        state = {'boot_id': 'boot0', 'seq': 100}
+        FakeKmsg([kmsg_record(5, 'error on sdc')]).patch(self)
+        drive_audit.scan_kernel_log(state, self.conf['error_re'], 1000)
+        self.assertEqual(state['boot_id'], 'boot1')
+        self.assertEqual(state['seq'], 5)
+        self.assertEqual(drive_audit.error_counts(state, 60, 1000),
+                         {'sdc': 1})
+
+    def test_old_errors_on_first_scan(self):
+        # Up for ten days; an error at boot and one a minute ago
+        self.uptime = 864000.0
+        now = 1000000
+        error = 'blk_update_request: I/O error, dev sdb, sector 1234'
+        FakeKmsg([kmsg_record(1, error),
+                  '3,2,%d,-;%s\n' % ((self.uptime - 60) * 1e6,
+                                     'end_request: I/O error, dev sdc')
+                  ]).patch(self)
+        state = {}
+        drive_audit.scan_kernel_log(state, self.conf['error_re'], now)
+        self.assertEqual(state['seq'], 2)
+        self.assertEqual(drive_audit.error_counts(state, 60, now),
+                         {'sdc': 1})
+
+    def test_get_uptime(self):
+        with tempfile.NamedTemporaryFile('w+') as f:
+            f.write('12345.67 98765.43\n')
+            f.flush()
+            self.assertEqual(12345.67, self.get_uptime(f.name))
+        self.assertIsNone(self.get_uptime('/nonexistent'))
+
+    def test_check_kernel_log(self):
+        FakeKmsg([kmsg_record(1, 'end_request: I/O error, dev sdc, sector 9'),
+                  kmsg_record(2, 'end_request: I/O error, dev sdc, sector 10')
+                  ]).patch(self)
+        results = drive_audit.check_kernel_log(self.conf, now=1000)
+        self.assertEqual(
+            [(r.dimensions['mount_point'], r.value,
+              r.metric()['value_meta']['msg'])
+             for r in results],
+            [('/srv/node/disk0', Severity.ok,
+              'No errors found on device mounted at: /srv/node/disk0'),
+             ('/srv/node/disk1', Severity.fail,
+              'Errors found on device mounted at: /srv/node/disk1'
+              ' (2 errors), unmounted')])
+        self.assertEqual(self.unmounted, ['/srv/node/disk1'])
+        with open(os.path.join(self.testdir, 'drive.recon')) as f:
+            self.assertEqual(json.load(f),
+                             {'/srv/node/disk0': 0,
+                              '/srv/node/disk1': 2,
+                              'drive_audit_errors': 2})
+
+        # the cursor was saved, so the errors are not counted twice
+        FakeKmsg([kmsg_record(1, 'end_request: I/O error, dev sdc, sector 9'),
+                  kmsg_record(2, 'end_request: I/O error, dev sdc, sector 10')
+                  ]).patch(self)
+        results = drive_audit.check_kernel_log(self.conf, now=1030)
+        self.assertEqual(results[1].msgkeys['errors'], 2)
+
+    def test_check_kernel_log_no_unmount(self):
+        self.conf['unmount_failed_device'] = False
+        FakeKmsg([kmsg_record(1, 'end_request: I/O error, dev sdc, sector 9')
+                  ]).patch(self)
+        results = drive_audit.check_kernel_log(self.conf, now=1000)
+        self.assertEqual(results[1].value, Severity.fail)
+        self.assertEqual(results[1].metric()['value_meta']['msg'],
+                         'Errors found on device mounted at: /srv/node/disk1'
+                         ' (1 errors)')
+        self.assertEqual(self.unmounted, [])
+
+    def test_check_kernel_log_below_limit(self):
+        self.conf['error_limit'] = 2
+        FakeKmsg([kmsg_record(1, 'end_request: I/O error, dev sdc, sector 9')
+                  ]).patch(self)
+        results = drive_audit.check_kernel_log(self.conf, now=1000)
+        self.assertEqual(results[1].value, Severity.ok)
+        self.assertEqual(self.unmounted, [])
+
+    @patch('swiftlm.swift.drive_audit.comment_fstab')
+    @patch('subprocess.call')
+    def test_unmount_device(self, call, comment_fstab):
+        call.return_value = 0
+        self.assertTrue(self.unmount_device('/srv/node/disk1'))
+        call.assert_called_once_with(['umount', '-fl', '/srv/node/disk1'])
+        comment_fstab.assert_called_once_with('/srv/node/disk1')
+
+        # fstab is left alone if umount fails
+        call.return_value = 32
+        comment_fstab.reset_mock()
+        self.assertFalse(self.unmount_device('/srv/node/disk1'))
+        self.assertFalse(comment_fstab.called)
+
+    def test_comment_fstab(self):
+        fstab = os.path.join(self.testdir, 'fstab')
+        with open(fstab, 'w') as f:
+            f.write('/dev/sda1 / ext4 defaults 0 1\n'
+                    'LABEL=d1 /srv/node/disk1 xfs noatime 0 0\n'
+                    '#LABEL=d1 /srv/node/disk1 xfs noatime 0 0\n'
+                    'LABEL=d10 /srv/node/disk10 xfs noatime 0 0\n')
+        drive_audit.comment_fstab('/srv/node/disk1', fstab)
+        with open(fstab) as f:
+            self.assertEqual(f.read(),
+                             '/dev/sda1 / ext4 defaults 0 1\n'
+                             '#LABEL=d1 /srv/node/disk1 xfs noatime 0 0\n'
+                             '#LABEL=d1 /srv/node/disk1 xfs noatime 0 0\n'
+                             'LABEL=d10 /srv/node/disk10 xfs noatime 0 0\n')
+        self.assertEqual(['fstab'], os.listdir(self.testdir))
+
+    def test_check_kernel_log_no_devices(self):
+        self.mounts.clear()
+        FakeKmsg([]).patch(self)
+        result = drive_audit.check_kernel_log(self.conf, now=1000)
+        self.assertEqual(result.value, Severity.warn)
+
+    @patch('swiftlm.swift.drive_audit.check_errors')
+    @patch('swiftlm.swift.drive_audit.check_kernel_log')
+    def test_main_falls_back(self, check_kernel_log, check_errors):
+        check_kernel_log.side_effect = OSError(errno.EACCES, 'denied')
+        check_errors.return_value = ['legacy']
+        self.assertEqual(drive_audit.main(), ['legacy'])
+        check_errors.assert_called_once_with('/var/cache/swift/drive.recon')
@@ -22,6 +22,7 @@ import mock
 import unittest
 
 from swiftlm.swift import file_ownership as FO
+from swiftlm.utils import users
 from swiftlm.utils.values import ServerType
 from swiftlm.utils.metricdata import MetricData, Severity
 
@@ -40,25 +41,34 @@ class TestFileOwnership(unittest.TestCase):
         self.assertEqual(x.get('message'), 'Path: /test/path is missing')
 
     @mock.patch('os.stat')
-    @mock.patch('pwd.getpwuid')
-    def test_is_swift_owned(self, mock_owner, mock_stat):
-        mock_owner.return_value = mock.Mock(pw_name='swift')
+    @mock.patch('swiftlm.swift.file_ownership.get_uid')
+    def test_is_swift_owned(self, mock_uid, mock_stat):
+        mock_uid.return_value = 1000
+        mock_stat.return_value = mock.Mock(st_uid=1000)
         self.assertTrue(FO._is_swift_owned([], '/test/file/path'))
 
-        mock_owner.return_value = mock.Mock(pw_name='not-swift')
+        mock_stat.return_value = mock.Mock(st_uid=0)
         self.assertFalse(FO._is_swift_owned([], '/test/file/path'))
 
-    @mock.patch('os.stat')
-    @mock.patch('os.path.isfile')
-    def test_is_empty_file(self, mock_isfile, mock_stat):
-        mock_isfile.return_value = True
+        # An already known stat result is used as is
+        self.assertTrue(FO._is_swift_owned([], '/test/file/path',
+                                           mock.Mock(st_uid=1000)))
+        self.assertEqual(2, mock_stat.call_count)
 
-        mock_stat.return_value = mock.Mock(st_size=1024)
+    @mock.patch('os.stat')
+    def test_is_empty_file(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_size=1024, st_mode=0o100644)
         self.assertFalse(FO._is_empty_file([], '/test/file/path'))
 
-        mock_stat.return_value = mock.Mock(st_size=0)
+        mock_stat.return_value = mock.Mock(st_size=0, st_mode=0o100644)
         self.assertTrue(FO._is_empty_file([], '/test/file/path'))
 
+        results = []
+        mock_stat.side_effect = OSError('No such file or directory')
+        self.assertTrue(FO._is_empty_file(results, '/test/file/path'))
+        self.assertEqual('Path: /test/file/path is missing',
+                         results[0]['message'])
+
 
 class TestFileChecks(unittest.TestCase):
 
@@ -75,6 +85,12 @@ class TestFileChecks(unittest.TestCase):
         FO.SWIFT_DIR = os.path.join(self.etc_dir, 'swift')
         FO.CONF_DIR = self.etc_dir
         FO.NODE_DIR = os.path.join(self.srv_dir, 'node')
+        p = mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                       os.path.join(self.testdir, 'state'))
+        p.start()
+        self.addCleanup(p.stop)
+        users.clear_cache()
+        self.addCleanup(users.clear_cache)
 
     def tearDown(self):
         FO.SWIFT_DIR = self.orig_swift_dir
@@ -219,8 +235,8 @@ class TestFileChecks(unittest.TestCase):
         os.makedirs(bad_path3)
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x != ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='not-swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid() + 1)
                 results = []
                 FO.not_swift_owned_config(results)
                 FO.not_swift_owned_data(results)
@@ -241,8 +257,8 @@ class TestFileChecks(unittest.TestCase):
         os.makedirs(bad_path2)
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x != ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='not-swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid() + 1)
                 results = []
                 FO.not_swift_owned_config(results)
                 self.assertEqual(2, len(results))
@@ -266,8 +282,8 @@ class TestFileChecks(unittest.TestCase):
         os.makedirs(bad_path4)
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x == ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='not-swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid() + 1)
                 results = []
                 FO.not_swift_owned_data(results)
                 expected = ['Path: %s is not owned by swift' % bad_path1,
@@ -287,8 +303,8 @@ class TestFileChecks(unittest.TestCase):
         os.makedirs(path2)
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x == ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid())
                 results = []
                 FO.not_swift_owned_config(results)
                 FO.not_swift_owned_data(results)
@@ -310,6 +326,12 @@ class TestMetricGen(unittest.TestCase):
         FO.SWIFT_DIR = os.path.join(self.etc_dir, 'swift')
         FO.CONF_DIR = self.etc_dir
         FO.NODE_DIR = os.path.join(self.srv_dir, 'node')
+        p = mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                       os.path.join(self.testdir, 'state'))
+        p.start()
+        self.addCleanup(p.stop)
+        users.clear_cache()
+        self.addCleanup(users.clear_cache)
 
     def tearDown(self):
         FO.SWIFT_DIR = self.orig_swift_dir
@@ -335,18 +357,23 @@ class TestMetricGen(unittest.TestCase):
         path2 = os.path.join(self.srv_dir, 'node', '1')
         os.makedirs(path1)
         os.makedirs(path2)
+        progress = MetricData.single(
+            'swiftlm.swift.file_ownership.data_scan.progress', 0.0,
+            message='0 paths checked in current pass, 1 full passes completed')
+        progress['mount'] = path2
         expected = [MetricData.single('swiftlm.swift.file_ownership.config',
                                       Severity.ok,
                                       message='OK'),
                     MetricData.single('swiftlm.swift.file_ownership.data',
                                       Severity.ok,
-                                      message='OK')]
+                                      message='OK'),
+                    progress]
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x == ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid())
                 results = FO.main()
-        self.assertEqual(len(expected), 2)
+        self.assertEqual(len(expected), 3)
         same = metrics_are_same(results, expected)
         self.assertEqual('', same, msg=same)
 
@@ -359,9 +386,137 @@ class TestMetricGen(unittest.TestCase):
                                       message='dummy')]
         with mock.patch('swiftlm.swift.file_ownership.server_type',
                         lambda x: x == ServerType.object):
-            with mock.patch('pwd.getpwuid') as mock_pwuid:
-                mock_pwuid.return_value = mock.Mock(pw_name='swift')
+            with mock.patch('pwd.getpwnam') as mock_pwnam:
+                mock_pwnam.return_value = mock.Mock(pw_uid=os.getuid())
                 results = FO.main()
         self.assertEqual(len(expected), 2)
         same = metrics_are_similar(results, expected)
         self.assertEqual('', same, msg=same)
+
+
+class FakeDirEntry(object):
+    """Wraps a real directory entry, faking the owner of some entries"""
+    def __init__(self, entry, bad):
+        self._entry = entry
+        self._bad = bad
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        return mock.Mock(st_uid=1 if self.name in self._bad else 0)
+
+
+class TestScanNodeData(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.node_dir = os.path.join(self.testdir, 'node')
+        for disk in ('disk0', 'disk1'):
+            for part in ('1', '2', '3'):
+                for suffix in ('a', 'b'):
+                    os.makedirs(os.path.join(self.node_dir, disk, 'objects',
+                                             part, suffix, 'hash'))
+        os.makedirs(os.path.join(self.node_dir, 'disk0', 'lost+found'))
+        open(os.path.join(self.node_dir, 'disk1', 'objects', '3', 'b', 'hash',
+                          '1234.data'), 'w').close()
+        self.bad = set()
+        self.now = [1000.0]
+
+        real_scandir = FO.scandir
+
+        def fake_scandir(path):
+            return [FakeDirEntry(e, self.bad) for e in real_scandir(path)]
+
+        def fake_lstat(path):
+            return mock.Mock(
+                st_uid=1 if os.path.basename(path) in self.bad else 0)
+
+        def fake_time():
+            # Every call to time() takes one second
+            self.now[0] += 1
+            return self.now[0]
+
+        for name, fake in (
+                ('swiftlm.swift.file_ownership.NODE_DIR', self.node_dir),
+                ('swiftlm.swift.file_ownership.scandir', fake_scandir),
+                ('swiftlm.swift.file_ownership.os.lstat', fake_lstat),
+                ('swiftlm.swift.file_ownership.time.time', fake_time),
+                ('swiftlm.swift.file_ownership.get_uid',
+                 lambda name: {'swift': 0}[name]),
+                ('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                 os.path.join(self.testdir, 'state'))):
+            p = mock.patch(name, fake)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _scan(self):
+        results = []
+        metrics = FO.scan_node_data(results, budget=10)
+        return [r['path'] for r in results], metrics
+
+    def test_walk_sorted_resume(self):
+        top = os.path.join(self.node_dir, 'disk1')
+        full = [parts for _, parts, _ in FO._walk_sorted(top)]
+        self.assertEqual(['objects'], full[0])
+        self.assertEqual(['objects', '1'], full[1])
+        self.assertEqual(['objects', '1', 'a'], full[2])
+        self.assertEqual(['objects', '3', 'b', 'hash', '1234.data'],
+                         full[-1])
+
+        for i in range(len(full)):
+            resumed = [parts for _, parts, _ in
+                       FO._walk_sorted(top, full[i])]
+            self.assertEqual(full[i + 1:], resumed)
+
+        done = [d for _, _, d in FO._walk_sorted(top)]
+        self.assertEqual(sorted(done), done)
+        self.assertEqual(0.0, done[0])
+        self.assertTrue(done[-1] < 1.0)
+
+    def test_bounded_scan_finds_deep_problem(self):
+        bad_path = os.path.join(self.node_dir, 'disk1', 'objects', '3', 'b',
+                                'hash', '1234.data')
+        self.bad.add('1234.data')
+        self.bad.add('lost+found')
+
+        found = []
+        runs = 0
+        while not found:
+            runs += 1
+            self.assertTrue(runs < 20, 'scan did not complete')
+            found, metrics = self._scan()
+        # The budget is too small to walk everything in one run
+        self.assertTrue(runs > 1)
+        self.assertEqual([bad_path], found)
+
+        # Problems stay reported after the scan moves on...
+        found, metrics = self._scan()
+        self.assertTrue(bad_path in found)
+        # ...until they are fixed
+        self.bad.clear()
+        found, metrics = self._scan()
+        self.assertEqual([], found)
+
+    def test_progress(self):
+        progress = []
+        for _ in range(30):
+            _, metrics = self._scan()
+            self.assertEqual(2, len(metrics))
+            m = [m.metric() for m in metrics
+                 if m['mount'].endswith('disk1')][0]
+            self.assertEqual(
+                'swiftlm.swift.file_ownership.data_scan.progress',
+                m['metric'])
+            progress.append(m['value'])
+            if m['value_meta']['msg'].endswith(' 1 full passes completed'):
+                break
+        else:
+            self.fail('scan did not complete: %s' % progress)
+        self.assertEqual(0.0, progress[-1])
+        increasing = progress[:-1]
+        self.assertEqual(sorted(increasing), increasing)
+        self.assertTrue(increasing[-1] > 50.0)
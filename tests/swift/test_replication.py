@@ -15,13 +15,18 @@
 #
 
 
+import json
+import os
+import tempfile
 import unittest
 import pprint
 from mock import patch, Mock, PropertyMock
+from shutil import rmtree
 
 import six
 
 from swiftlm.swift import replication
+from swiftlm.utils import recon
 from swiftlm.utils.metricdata import CheckFailure
 from swiftlm.utils.values import Severity, ServerType
 from swiftlm.utils.utility import SwiftlmCheckFailure
@@ -45,19 +50,32 @@ class TestHealthCheck(unittest.TestCase):
         self.p('swiftlm.utils.metricdata.timestamp', lambda: 123456)
         self.p('swiftlm.swift.replication.timestamp', lambda: 123456)
         self.p('swiftlm.swift.replication.BASE_RESULT.dimensions', {})
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.recon_path = os.path.join(self.testdir, 'recon') + '/'
+        os.mkdir(self.recon_path)
+        self.p('swiftlm.swift.replication.RECON_PATH', self.recon_path)
+        self.p('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        recon.clear_cache()
+        self.addCleanup(recon.clear_cache)
+
+    def server_type(self, name):
+        st = Mock(spec=ServerType)
+        st.name = name
+        st.is_instance = True
+        return st
+
+    def write_recon(self, name, data):
+        with open(os.path.join(self.recon_path, name + '.recon'), 'w') as f:
+            json.dump(data, f)
 
     def test_recon_ok(self):
-        mock_json = Mock()
-        mock_json.return_value = {
-            'replication_last': '1222'
-        }
+        self.write_recon('servertype', {'replication_last': '1222'})
         mock_server_type = Mock(spec=ServerType)
         mock_server_type.name = 'servertype'
         mock_server_type.is_instance = True
 
-        with patch(BUILTIN_OPEN):
-            with patch('json.load', mock_json):
-                actual = replication._recon_check(mock_server_type)
+        actual = replication._recon_check(mock_server_type)
 
         self.assertIsInstance(actual, list)
         self.assertEqual(len(actual), 1)
@@ -73,16 +91,88 @@ class TestHealthCheck(unittest.TestCase):
         self.assertDictEqual(expected.metric(), r.metric())
 
     def test_recon_fail(self):
-        mock_json = Mock()
-        mock_json.side_effect = ValueError('error')
+        with open(os.path.join(self.recon_path, 'servertype.recon'),
+                  'w') as f:
+            f.write('{not json')
+        mock_server_type = Mock(spec=ServerType)
+        mock_server_type.name = 'servertype'
+        mock_server_type.is_instance = True
+
+        self.assertRaises(SwiftlmCheckFailure,
+                          replication._recon_check, mock_server_type)
+
+    def test_recon_missing(self):
         mock_server_type = Mock(spec=ServerType)
         mock_server_type.name = 'servertype'
         mock_server_type.is_instance = True
 
-        with patch(BUILTIN_OPEN):
-            with patch('json.load', mock_json):
-                self.assertRaises(SwiftlmCheckFailure,
-                                  replication._recon_check, mock_server_type)
+        self.assertRaises(SwiftlmCheckFailure,
+                          replication._recon_check, mock_server_type)
+
+    def test_recon_object_details(self):
+        self.write_recon('object', {
+            'replication_last': 120000,
+            'replication_time': 2.5,
+            'object_replication_last': 120000,
+            'object_replication_time': 2.5,
+            'replication_stats': {'attempted': 10, 'failure': 3},
+            'object_replication_per_disk': {
+                'disk0': {'object_replication_last': 121000},
+                'disk1': {'object_replication_last': 100000},
+                'disk2': {}},
+            'object_reconstruction_last': 122000,
+            'object_reconstruction_time': 0.5,
+            'object_reconstruction_per_disk': {}})
+        actual = replication._recon_check(self.server_type('object'))
+        self.assertEqual(
+            [(r.name, r.dimensions, r.value) for r in actual],
+            [('swiftlm.swift.replication.object.last_replication',
+              {'component': 'object-replicator'}, 3456),
+             ('swiftlm.swift.replication.object.device.last_replication',
+              {'component': 'object-replicator', 'device': 'disk0'}, 2456),
+             ('swiftlm.swift.replication.object.device.last_replication',
+              {'component': 'object-replicator', 'device': 'disk1'}, 23456),
+             ('swiftlm.swift.replication.object.replication_time',
+              {'component': 'object-replicator'}, 150.0),
+             ('swiftlm.swift.replication.object.replication_failures',
+              {'component': 'object-replicator'}, 3),
+             ('swiftlm.swift.replication.object.last_reconstruction',
+              {'component': 'object-reconstructor'}, 1456),
+             ('swiftlm.swift.replication.object.reconstruction_time',
+              {'component': 'object-reconstructor'}, 30.0)])
+
+    def test_recon_container_details(self):
+        self.write_recon('container', {
+            'replication_last': 123000,
+            'replication_time': 12.345,
+            'replication_stats': {'attempted': 5, 'failure': 0}})
+        actual = replication._recon_check(self.server_type('container'))
+        self.assertEqual(
+            [(r.name, r.value) for r in actual],
+            [('swiftlm.swift.replication.container.last_replication', 456),
+             ('swiftlm.swift.replication.container.replication_time', 12.35),
+             ('swiftlm.swift.replication.container.replication_failures',
+              0)])
+
+    def test_recon_not_parsed_when_unchanged(self):
+        self.write_recon('container', {'replication_last': 123000})
+        with patch('json.load', Mock(wraps=json.load)) as mock_load:
+            replication._recon_check(self.server_type('container'))
+            replication._recon_check(self.server_type('container'))
+            self.assertEqual(mock_load.call_count, 1)
+
+            # a new process has no in-memory cache but uses the saved
+            # summary
+            recon.clear_cache()
+            actual = replication._recon_check(self.server_type('container'))
+            self.assertEqual(actual[0].value, 456)
+            # one call to load the saved summary
+            self.assertEqual(mock_load.call_count, 2)
+
+            self.write_recon('container', {'replication_last': 123400,
+                                           'replication_time': 1})
+            actual = replication._recon_check(self.server_type('container'))
+            self.assertEqual([r.value for r in actual], [56, 1])
 
     def test_recon_server_type(self):
         mock_server_type = Mock(spec=ServerType)
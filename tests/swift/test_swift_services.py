@@ -16,6 +16,7 @@
 
 
 from shutil import rmtree
+import os
 import socket
 import tempfile
 import mock
@@ -26,6 +27,7 @@ import time
 
 from swiftlm.swift import swift_services
 from swiftlm.swift.swift_services import SERVICES
+from swiftlm.utils.listeners import Listener
 from swiftlm.utils.values import Severity
 from tests import create_fake_process_entries
 from collections import namedtuple
@@ -244,16 +246,307 @@ class TestMain(unittest.TestCase):
         self.assertEqual(expected_metric, metric)
 
 
-class fake_rsync_process():
+class FakeProcess(object):
+    def __init__(self, pid=None):
+        self.pid = pid
+
+
+def make_proc_entry(proc_dir, pid, start=100, utime=0, stime=0, threads=1,
+                    rss_kb=0, fds=0, read_bytes=0, write_bytes=0, io=True):
+    pid_dir = os.path.join(proc_dir, str(pid))
+    if os.path.exists(pid_dir):
+        rmtree(pid_dir)
+    os.makedirs(os.path.join(pid_dir, 'fd'))
+    fields = ['S'] + ['0'] * 49
+    fields[11] = str(utime)
+    fields[12] = str(stime)
+    fields[17] = str(threads)
+    fields[19] = str(start)
+    with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+        f.write('%d (swift-object-server) %s\n' % (pid, ' '.join(fields)))
+    with open(os.path.join(pid_dir, 'status'), 'w') as f:
+        f.write('Name:\tswift-object-se\nVmRSS:\t  %d kB\n' % rss_kb)
+    for fd in range(fds):
+        open(os.path.join(pid_dir, 'fd', str(fd)), 'w').close()
+    if io:
+        with open(os.path.join(pid_dir, 'io'), 'w') as f:
+            f.write('rchar: 1\nread_bytes: %d\nwrite_bytes: %d\n' %
+                    (read_bytes, write_bytes))
+
+
+def service_cmdline(service):
+    return ['/opt/stack/venv/bin/python2',
+            '/opt/stack/service/swift-%s/venv/bin/swift-%s' % (service,
+                                                               service),
+            '/etc/swift/%s.conf' % service]
+
+
+class TestProcessSnapshot(unittest.TestCase):
+
+    def test_snapshot(self):
+        obj1, obj2, proxy, rsync = (FakeProcess(), FakeProcess(),
+                                    FakeProcess(), fake_rsync_process())
+        procs = [(obj1, service_cmdline('object-server')),
+                 (FakeProcess(), ['/sbin/init']),
+                 (obj2, service_cmdline('object-server')),
+                 (proxy, service_cmdline('proxy-server')),
+                 (FakeProcess(), ['/usr/bin/swift-object-server']),
+                 (rsync, ['/usr/bin/rsync', '--daemon'])]
+        mock_procs = mock.Mock(return_value=iter(procs))
+        with mock.patch('swiftlm.swift.swift_services.'
+                        'get_all_proc_and_cmdlines', mock_procs):
+            snapshot = swift_services.ProcessSnapshot()
+        self.assertEqual(mock_procs.call_count, 1)
+        self.assertEqual(snapshot.services,
+                         {'object-server': [obj1, obj2],
+                          'proxy-server': [proxy]})
+        self.assertEqual(snapshot.rsync, [rsync])
+        self.assertTrue(snapshot.is_running('object-server'))
+        self.assertFalse(snapshot.is_running('object-updater'))
+        self.assertEqual(snapshot.processes('object-updater'), [])
+
+    def test_read_proc_stat(self):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        make_proc_entry(testdir, 12, start=500, utime=30, stime=12,
+                        threads=4, rss_kb=2, fds=3, read_bytes=4096,
+                        write_bytes=8192)
+        make_proc_entry(testdir, 13, io=False)
+        self.assertEqual(
+            swift_services.read_proc_stat(12, proc=testdir),
+            swift_services.ProcStat(pid=12, start=500, cpu_ticks=42,
+                                    threads=4, rss=2048, open_fds=3,
+                                    read_bytes=4096, write_bytes=8192))
+        st = swift_services.read_proc_stat(13, proc=testdir)
+        self.assertIsNone(st.read_bytes)
+        self.assertIsNone(st.write_bytes)
+        self.assertIsNone(swift_services.read_proc_stat(14, proc=testdir))
+
+    @mock.patch('swiftlm.swift.swift_services.CLK_TCK', 100)
+    def test_service_usage(self):
+        ProcStat = swift_services.ProcStat
+        boot_time = 1000
+        stats = [ProcStat(1, 500, 300, 2, 1000, 5, 100, 200),
+                 ProcStat(2, 700, 100, 1, 500, 3, 0, 1000)]
+        usage, state = swift_services.service_usage(stats, {}, None,
+                                                    boot_time, 1100.0)
+        self.assertEqual(usage, {'processes': 2, 'rss': 1500, 'threads': 3,
+                                 'open_fds': 8, 'cpu_time': 4.0,
+                                 'uptime': 95, 'restarts': 0})
+        self.assertEqual(state, {'start': 500, 'restarts': 0,
+                                 'pids': {'1': [500, 300, 100, 200],
+                                          '2': [700, 100, 0, 1000]}})
+
+        # 10 seconds later: pid 2 has been replaced by pid 3
+        stats = [ProcStat(1, 500, 800, 2, 1000, 5, 1100, 200),
+                 ProcStat(3, 1500, 100, 1, 500, 3, 0, 3000)]
+        usage, state = swift_services.service_usage(stats, state, 10.0,
+                                                    boot_time, 1110.0)
+        self.assertEqual(usage['cpu_percent'], 60.0)
+        self.assertEqual(usage['read_bytes_per_sec'], 100.0)
+        self.assertEqual(usage['write_bytes_per_sec'], 300.0)
+        self.assertEqual(usage['restarts'], 0)
+
+        # the service is restarted
+        stats = [ProcStat(4, 11000, 10, 1, 1000, 5, 0, 0)]
+        usage, state = swift_services.service_usage(stats, state, 10.0,
+                                                    boot_time, 1120.0)
+        self.assertEqual(usage['restarts'], 1)
+        self.assertEqual(usage['uptime'], 10)
+        self.assertEqual(usage['cpu_percent'], 1.0)
+
+        # no /proc/<pid>/io, so no I/O rates
+        stats = [ProcStat(4, 11000, 10, 1, 1000, 5, None, None)]
+        usage, state = swift_services.service_usage(stats, state, 10.0,
+                                                    boot_time, 1130.0)
+        self.assertNotIn('read_bytes_per_sec', usage)
+        self.assertEqual(usage['cpu_percent'], 0.0)
+
+        self.assertEqual(
+            swift_services.service_usage([], state, 10.0, boot_time, 0),
+            (None, state))
+
+    @mock.patch('swiftlm.swift.swift_services.server_type')
+    @mock.patch('swiftlm.swift.swift_services.get_network_interface_conf',
+                lambda: dict(rsync_bind_ip='10.243.57.2'))
+    @mock.patch('swiftlm.swift.swift_services.get_rsync_target_conf',
+                lambda: dict(rsync_bind_port='873'))
+    def test_main_scans_processes_once(self, mock_type):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        with open(os.path.join(testdir, 'stat'), 'w') as f:
+            f.write('cpu  1 2 3\nbtime 1000\n')
+        make_proc_entry(testdir, 10, start=0, utime=100, rss_kb=1, fds=2)
+        mock_type.return_value = {'proxy': True, 'object': False,
+                                  'container': False, 'account': False}
+        procs = [(FakeProcess(10), service_cmdline('proxy-server')),
+                 (fake_rsync_process(), ['/usr/bin/rsync', '--daemon'])]
+        mock_procs = mock.Mock(return_value=iter(procs))
+        self.addCleanup(mock.patch.stopall)
+        for name, value in (('get_all_proc_and_cmdlines', mock_procs),
+                            ('get_socket_inodes',
+                             lambda pids: {51: 4000, 52: 10}),
+                            ('get_listeners',
+                             lambda: [Listener('10.243.57.2', 873, 51, 0),
+                                      Listener('0.0.0.0', 8080, 52, 3)]),
+                            ('PROC', testdir),
+                            ('CLK_TCK', 100),
+                            ('get_boot_id', lambda: 'boot'),
+                            ('time.time', lambda: 1100.0)):
+            mock.patch('swiftlm.swift.swift_services.' + name, value).start()
+        mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                   testdir).start()
+        results = swift_services.main()
+        self.assertEqual(mock_procs.call_count, 1)
+        self.assertEqual(
+            [(r.name, r.dimensions.get('component'), r.value)
+             for r in results],
+            [('swiftlm.swift.swift_services', 'proxy-server', Severity.ok),
+             ('swiftlm.swift.swift_services.processes', 'proxy-server', 1),
+             ('swiftlm.swift.swift_services.rss', 'proxy-server', 1024),
+             ('swiftlm.swift.swift_services.cpu_time', 'proxy-server', 1.0),
+             ('swiftlm.swift.swift_services.uptime', 'proxy-server', 100),
+             ('swiftlm.swift.swift_services.threads', 'proxy-server', 1),
+             ('swiftlm.swift.swift_services.open_fds', 'proxy-server', 2),
+             ('swiftlm.swift.swift_services.restarts', 'proxy-server', 0),
+             ('swiftlm.swift.swift_services', 'rsync', Severity.ok),
+             ('swiftlm.swift.swift_services.check_ip_port', 'rsync',
+              Severity.ok),
+             ('swiftlm.swift.swift_services.accept_queue', 'proxy-server', 3),
+             ('swiftlm.swift.swift_services.accept_queue', 'rsync', 0)])
+
+    @mock.patch('swiftlm.swift.swift_services.server_type')
+    @mock.patch('swiftlm.swift.swift_services.CLK_TCK', 100)
+    def test_check_service_resources_state(self, mock_type):
+        testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, testdir)
+        self.addCleanup(mock.patch.stopall)
+        with open(os.path.join(testdir, 'stat'), 'w') as f:
+            f.write('btime 1000\n')
+        mock_type.return_value = {'proxy': True, 'object': False,
+                                  'container': False, 'account': False}
+        snapshot = mock.Mock(processes=lambda s: [FakeProcess(10)])
+        now = [1100.0]
+        boot_id = ['boot1']
+        mock.patch('swiftlm.swift.swift_services.PROC', testdir).start()
+        mock.patch('swiftlm.swift.swift_services.time.time',
+                   lambda: now[0]).start()
+        mock.patch('swiftlm.swift.swift_services.get_boot_id',
+                   lambda: boot_id[0]).start()
+        mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR',
+                   testdir).start()
+
+        def values():
+            return dict((r.name.split('.')[-1], r.value) for r in
+                        swift_services.check_service_resources(snapshot))
+
+        make_proc_entry(testdir, 10, start=100, utime=100, write_bytes=0)
+        self.assertNotIn('cpu_percent', values())
+
+        now[0] += 20
+        make_proc_entry(testdir, 10, start=100, utime=2100,
+                        write_bytes=2000)
+        v = values()
+        self.assertEqual(v['cpu_percent'], 100.0)
+        self.assertEqual(v['write_bytes_per_sec'], 100.0)
+        self.assertEqual(v['restarts'], 0)
+
+        now[0] += 20
+        make_proc_entry(testdir, 10, start=500, utime=10)
+        self.assertEqual(values()['restarts'], 1)
+
+        # a reboot counts as a restart, once
+        now[0] += 20
+        boot_id[0] = 'boot2'
+        make_proc_entry(testdir, 10, start=50, utime=10)
+        v = values()
+        self.assertEqual(v['restarts'], 2)
+        self.assertNotIn('cpu_percent', v)
+        now[0] += 20
+        self.assertEqual(values()['restarts'], 2)
+
+
+class TestListeners(unittest.TestCase):
 
-    def connections(self):
-        pconn = namedtuple('pconn', ['laddr', 'family'])
-        return [(pconn(('10.243.57.2', 873), None))]
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        mock.patch('swiftlm.swift.swift_services.server_type',
+                   lambda: {'proxy': True, 'object': True,
+                            'container': False, 'account': False}).start()
+        mock.patch('swiftlm.swift.swift_services.get_socket_inodes',
+                   lambda pids: {11: 100, 12: 101, 13: 200, 14: 300}).start()
+        mock.patch('swiftlm.swift.swift_services.get_listeners',
+                   lambda: [Listener('0.0.0.0', 8080, 11, 0),
+                            Listener('0.0.0.0', 8080, 12, 0),
+                            Listener('192.168.0.1', 6000, 13, 7),
+                            Listener('::1', 22, 99, 0),
+                            Listener('10.0.0.1', 873, 14, 0)]).start()
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        with open(os.path.join(self.testdir, 'object-server.conf'),
+                  'w') as f:
+            f.write('[DEFAULT]\nbind_port = 6000\n')
+        mock.patch('swiftlm.swift.swift_services.LISTENING_SERVICES',
+                   (('proxy-server', 'proxy', self.testdir),
+                    ('object-server', 'object', self.testdir))).start()
+        procs = [(FakeProcess(100), service_cmdline('proxy-server')),
+                 (FakeProcess(101), service_cmdline('proxy-server')),
+                 (FakeProcess(200), service_cmdline('object-server')),
+                 (FakeProcess(300), ['/usr/bin/rsync', '--daemon'])]
+        mock.patch('swiftlm.swift.swift_services.get_all_proc_and_cmdlines',
+                   lambda: iter(procs)).start()
+
+    def check(self, network_conf):
+        mock.patch('swiftlm.swift.swift_services.get_network_interface_conf',
+                   lambda: network_conf).start()
+        return [(r.name.split('.')[-1], r.dimensions['component'], r.value,
+                 r.metric()['value_meta']['msg'])
+                for r in swift_services.check_listeners()]
+
+    def test_listening(self):
+        self.assertEqual(
+            self.check({'proxy_bind_ip': '192.168.0.1',
+                        'proxy_bind_port': '8080',
+                        'object_bind_ip': '192.168.0.1'}),
+            [('check_ip_port', 'proxy-server', Severity.ok, 'OK'),
+             ('check_ip_port', 'object-server', Severity.ok, 'OK'),
+             ('accept_queue', 'object-server', 7,
+              '7 connections waiting to be accepted on 192.168.0.1:6000'),
+             ('accept_queue', 'proxy-server', 0,
+              '0 connections waiting to be accepted on 0.0.0.0:8080'),
+             ('accept_queue', 'rsync', 0,
+              '0 connections waiting to be accepted on 10.0.0.1:873')])
+
+    def test_not_listening(self):
+        results = self.check({'proxy_bind_ip': '192.168.0.1',
+                              'proxy_bind_port': '8081',
+                              'object_bind_ip': '192.168.0.2'})
+        self.assertEqual(
+            results[:2],
+            [('check_ip_port', 'proxy-server', Severity.fail,
+              'proxy-server is not listening on the correct ip or port'),
+             ('check_ip_port', 'object-server', Severity.fail,
+              'object-server is not listening on the correct ip or port')])
+
+    def test_no_conf(self):
+        results = self.check({})
+        self.assertEqual([r[0] for r in results], ['accept_queue'] * 3)
+
+
+class fake_rsync_process():
+    pid = 4000
 
 
 class test_rsync_data(unittest.TestCase):
 
     def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        # rsync listens on a second address as well
+        mock.patch('swiftlm.swift.swift_services.get_socket_inodes',
+                   lambda pids: {51: 4000, 52: 4000}).start()
+        mock.patch('swiftlm.swift.swift_services.get_listeners',
+                   lambda: [Listener('127.0.0.1', 873, 51, 0),
+                            Listener('10.243.57.2', 873, 52, 0)]).start()
         self.testdir = tempfile.mkdtemp()
         self.fake_time = int(time.time())
         self.expected_dimensions_base = dict(service='object-storage')
@@ -21,6 +21,7 @@ import socket
 import tempfile
 import unittest
 import json
+import threading
 import time
 
 import six
@@ -30,8 +31,10 @@ from mock import patch
 
 from swiftlm.systems import check_mounts
 from swiftlm.utils.metricdata import MetricData
+from swiftlm.utils import users, utility
 from swiftlm.utils.values import Severity
-from swiftlm.utils.utility import SwiftlmCheckFailure
+from swiftlm.utils.utility import SwiftlmCheckFailure, MountEntry
+from swiftlm.utils.utility import CommandResult
 
 if six.PY2:
     BUILTIN_OPEN = '__builtin__.open'
@@ -47,10 +50,11 @@ def make_fake_os_stat(fake_returns):
     return fake_os_stat
 
 
-def make_fake_is_mount(mounts):
-    def fake_ismount(mount_path):
-        return mounts.get(mount_path, False)
-    return fake_ismount
+def make_fake_get_mounts(mounts, fstype='xfs'):
+    def fake_get_mounts():
+        return dict((m, MountEntry('1', '/dev/fake', m, fstype, 'rw'))
+                    for m, mounted in mounts.items() if mounted)
+    return fake_get_mounts
 
 
 def make_fake_getpwuid(names):
@@ -65,6 +69,22 @@ def make_fake_getgrgid(names):
     return fake_getgrgid
 
 
+def make_fake_getpwnam(names):
+    uids = dict((name, uid) for uid, name in names.items())
+
+    def fake_getpwnam(name):
+        return Mock(pw_uid=uids[name])
+    return fake_getpwnam
+
+
+def make_fake_getgrnam(names):
+    gids = dict((name, gid) for gid, name in names.items())
+
+    def fake_getgrnam(name):
+        return Mock(gr_gid=gids[name])
+    return fake_getgrnam
+
+
 class TestCheckMounts(unittest.TestCase):
 
     @patch('os.stat')
@@ -75,25 +95,25 @@ class TestCheckMounts(unittest.TestCase):
         mock_gid.return_value = Mock(gr_name='swift')
         mock_uid.return_value = Mock(pw_name='swift')
         response = {}
-        self.assertTrue(check_mounts.is_ug_swift(d, response))
+        self.assertTrue(check_mounts.is_ug_swift(d, response, None))
         self.assertDictEqual(response, {})
 
         mock_gid.return_value = Mock(gr_name='not-swift')
         mock_uid.return_value = Mock(pw_name='swift')
         response = {}
-        self.assertFalse(check_mounts.is_ug_swift(d, response))
+        self.assertFalse(check_mounts.is_ug_swift(d, response, None))
         self.assertDictEqual(response, {'user': 'swift', 'group': 'not-swift'})
 
         mock_gid.return_value = Mock(gr_name='swift')
         mock_uid.return_value = Mock(pw_name='not-swift')
         response = {}
-        self.assertFalse(check_mounts.is_ug_swift(d, response))
+        self.assertFalse(check_mounts.is_ug_swift(d, response, None))
         self.assertDictEqual(response, {'user': 'not-swift', 'group': 'swift'})
 
         mock_gid.return_value = Mock(gr_name='not-swift')
         mock_uid.return_value = Mock(pw_name='not-swift')
         response = {}
-        self.assertFalse(check_mounts.is_ug_swift(d, response))
+        self.assertFalse(check_mounts.is_ug_swift(d, response, None))
         self.assertDictEqual(
             response,
             {'user': 'not-swift', 'group': 'not-swift'}
@@ -103,11 +123,11 @@ class TestCheckMounts(unittest.TestCase):
     def test_is_mounted_775(self, mock_stat):
         d = check_mounts.Device('/dev/sd#', '/srv/node/disk#', 'label#')
         mock_stat.return_value = Mock(st_mode=16877)  # oct(16877) = 040775
-        self.assertTrue(check_mounts.is_mounted_775(d, {}))
+        self.assertTrue(check_mounts.is_mounted_775(d, {}, None))
 
         mock_stat.return_value = Mock(st_mode=16804)  # oct(16804) = 040644
         response = {}
-        self.assertFalse(check_mounts.is_mounted_775(d, response))
+        self.assertFalse(check_mounts.is_mounted_775(d, response, None))
         self.assertDictEqual(response, {'permissions': '644'})
 
     def test_get_devices(self):
@@ -173,6 +193,9 @@ class TestCheckMounts(unittest.TestCase):
         self.p('swiftlm.utils.metricdata.get_base_dimensions', lambda: {})
         self.p('swiftlm.systems.check_mounts.BASE_RESULT.dimensions', {})
         self.p('swiftlm.systems.check_mounts.MOUNT_PATH', '')
+        self.p('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        users.clear_cache()
+        self.addCleanup(users.clear_cache)
 
         self.expected_metric_base = {
             'metric': 'swiftlm.systems.check_mounts',
@@ -235,7 +258,7 @@ class TestCheckMounts(unittest.TestCase):
         dev_info = self._make_devices(('sdd', 'sde'))
         # sdd is not mounted,
         # sde is mounted but has wrong perms
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sde']['mount']: True})
         # oct(16804) = 040644
         fake_os_stat = make_fake_os_stat(
@@ -263,7 +286,7 @@ class TestCheckMounts(unittest.TestCase):
         expected.append(expected_metric)
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         def do_it(*args):
             actual = check_mounts.check_mounts()
@@ -283,7 +306,7 @@ class TestCheckMounts(unittest.TestCase):
         dev_info = self._make_devices(('sdd', 'sde'))
         # sdd is mounted, correct perms but wrong user group
         # sde is mounted but has wrong perms
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sdd']['mount']: True,
              dev_info['sde']['mount']: True})
         fake_os_stat = make_fake_os_stat(
@@ -293,7 +316,9 @@ class TestCheckMounts(unittest.TestCase):
                                             st_gid=1001),
              dev_info['sde']['mount']: dict(st_mode=16804)})
         fake_getpwuid = make_fake_getpwuid({1000: 'not-swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'not-swift'})
         fake_getgrgid = make_fake_getgrgid({1001: 'not-swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'not-swift'})
 
         expected = []
         # sdd
@@ -319,10 +344,12 @@ class TestCheckMounts(unittest.TestCase):
         expected.append(expected_metric)
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
         @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
         def do_it(*args):
             actual = check_mounts.check_mounts()
 
@@ -338,7 +365,7 @@ class TestCheckMounts(unittest.TestCase):
 
     def test_not_valid_label(self):
         dev_info = self._make_devices(('sdd',))
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sdd']['mount']: True})
         fake_os_stat = make_fake_os_stat(
             # oct(16877) = 040775, oct(16804) = 040644
@@ -346,7 +373,9 @@ class TestCheckMounts(unittest.TestCase):
                                             st_uid=1000,
                                             st_gid=1001)})
         fake_getpwuid = make_fake_getpwuid({1000: 'swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'swift'})
         fake_getgrgid = make_fake_getgrgid({1001: 'swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'swift'})
 
         expected_value_meta = dict(
             msg='{device} mounted at {mount} has invalid label {label}'
@@ -358,10 +387,12 @@ class TestCheckMounts(unittest.TestCase):
                                value_meta=expected_value_meta))
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
         @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
         @mock.patch('swiftlm.systems.check_mounts.is_valid_label',
                     return_value=False, __name__='is_valid_label')
         def do_it(*args):
@@ -374,7 +405,7 @@ class TestCheckMounts(unittest.TestCase):
 
     def test_not_xfs(self):
         dev_info = self._make_devices(('sdd',))
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sdd']['mount']: True})
         fake_os_stat = make_fake_os_stat(
             # oct(16877) = 040775, oct(16804) = 040644
@@ -382,7 +413,9 @@ class TestCheckMounts(unittest.TestCase):
                                             st_uid=1000,
                                             st_gid=1001)})
         fake_getpwuid = make_fake_getpwuid({1000: 'swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'swift'})
         fake_getgrgid = make_fake_getgrgid({1001: 'swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'swift'})
 
         expected_value_meta = dict(
             msg='{device} mounted at {mount} is not XFS'
@@ -394,10 +427,12 @@ class TestCheckMounts(unittest.TestCase):
                                     value_meta=expected_value_meta))
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
         @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
         @mock.patch('swiftlm.systems.check_mounts.is_valid_label',
                     return_value=True, __name__='is_valid_label')
         @mock.patch('swiftlm.systems.check_mounts.is_xfs',
@@ -413,7 +448,7 @@ class TestCheckMounts(unittest.TestCase):
 
     def test_not_valid_xfs(self):
         dev_info = self._make_devices(('sdd',))
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sdd']['mount']: True})
         fake_os_stat = make_fake_os_stat(
             # oct(16877) = 040775, oct(16804) = 040644
@@ -421,7 +456,9 @@ class TestCheckMounts(unittest.TestCase):
                                             st_uid=1000,
                                             st_gid=1001)})
         fake_getpwuid = make_fake_getpwuid({1000: 'swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'swift'})
         fake_getgrgid = make_fake_getgrgid({1001: 'swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'swift'})
 
         expected_value_meta = dict(
             msg='{device} mounted at {mount} is corrupt'
@@ -433,10 +470,12 @@ class TestCheckMounts(unittest.TestCase):
                                     value_meta=expected_value_meta))
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
         @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
         @mock.patch('swiftlm.systems.check_mounts.is_valid_label',
                     return_value=True, __name__='is_valid_label')
         @mock.patch('swiftlm.systems.check_mounts.is_xfs',
@@ -456,7 +495,7 @@ class TestCheckMounts(unittest.TestCase):
         dev_info = self._make_devices(('sdd', 'sde'))
         # sdd is mounted, correct perms but wrong user group
         # sde is OK
-        fake_is_mount = make_fake_is_mount(
+        fake_get_mounts = make_fake_get_mounts(
             {dev_info['sdd']['mount']: True,
              dev_info['sde']['mount']: True})
         fake_os_stat = make_fake_os_stat(
@@ -468,7 +507,9 @@ class TestCheckMounts(unittest.TestCase):
                                             st_uid=1002,
                                             st_gid=1002)})
         fake_getpwuid = make_fake_getpwuid({1000: 'not-swift', 1002: 'swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'not-swift', 1002: 'swift'})
         fake_getgrgid = make_fake_getgrgid({1001: 'not-swift', 1002: 'swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'not-swift', 1002: 'swift'})
 
         expected = []
         # sdd
@@ -493,10 +534,12 @@ class TestCheckMounts(unittest.TestCase):
         expected.append(expected_metric)
 
         # avoid ridiculous nesting...
-        @mock.patch('os.path.ismount', fake_is_mount)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
         @mock.patch('os.stat', fake_os_stat)
         @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
         @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
         @mock.patch('swiftlm.systems.check_mounts.is_valid_label',
                     return_value=True)
         @mock.patch('swiftlm.systems.check_mounts.is_xfs', return_value=True)
@@ -515,6 +558,265 @@ class TestCheckMounts(unittest.TestCase):
             self.assertFalse(expected)
         do_it()
 
+    def test_hung_drive(self):
+        dev_info = self._make_devices(('sdd', 'sde'))
+        hung_mount = dev_info['sdd']['mount']
+        release = threading.Event()
+        self.addCleanup(release.set)
+        fake_get_mounts = make_fake_get_mounts(
+            {dev_info['sdd']['mount']: True,
+             dev_info['sde']['mount']: True})
+
+        def fake_os_stat(path):
+            if path == hung_mount:
+                release.wait()
+            return Mock(st_mode=16877, st_uid=1000, st_gid=1001)
+
+        fake_getpwuid = make_fake_getpwuid({1000: 'swift'})
+        fake_getpwnam = make_fake_getpwnam({1000: 'swift'})
+        fake_getgrgid = make_fake_getgrgid({1001: 'swift'})
+        fake_getgrnam = make_fake_getgrnam({1001: 'swift'})
+
+        expected = []
+        dev_info['sdd']['timeout'] = 0.1
+        expected_metric = dict(self.expected_metric_base)
+        expected_metric.update(dict(
+            dimensions={'mount': hung_mount},
+            value=Severity.fail,
+            value_meta=dict(
+                msg='{device} mounted at {mount} did not respond within '
+                    '{timeout} seconds (hung)'.format(**dev_info['sdd']))))
+        expected.append(expected_metric)
+        expected_metric = dict(self.expected_metric_base)
+        expected_metric.update(dict(
+            dimensions={'mount': dev_info['sde']['mount']},
+            value=Severity.ok,
+            value_meta=dict(
+                msg='{device} mounted at {mount} ok'.format(
+                    **dev_info['sde']))))
+        expected.append(expected_metric)
+
+        @mock.patch('swiftlm.systems.check_mounts.DRIVE_TIMEOUT', 0.1)
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
+        @mock.patch('os.stat', fake_os_stat)
+        @mock.patch('pwd.getpwuid', fake_getpwuid)
+        @mock.patch('pwd.getpwnam', fake_getpwnam)
+        @mock.patch('grp.getgrgid', fake_getgrgid)
+        @mock.patch('grp.getgrnam', fake_getgrnam)
+        @mock.patch('swiftlm.systems.check_mounts.is_valid_xfs',
+                    return_value=True)
+        def do_it(*args):
+            hung = []
+            actual = check_mounts.check_mounts(hung)
+
+            self.assertEqual([hung_mount], [d.mount for d in hung])
+            self.assertEqual(2, len(actual))
+            for metric_data in actual:
+                metric = metric_data.metric()
+                self.assertTrue(metric in expected,
+                                'Unexpected metric %s\n not found in\n %s'
+                                % (metric, expected))
+                expected.remove(metric)
+            self.assertFalse(expected)
+        do_it()
+
+    def test_drive_error(self):
+        dev_info = self._make_devices(('sdd', 'sde'))
+        bad_mount = dev_info['sdd']['mount']
+        fake_get_mounts = make_fake_get_mounts(
+            {dev_info['sdd']['mount']: True,
+             dev_info['sde']['mount']: True})
+
+        def fake_os_stat(path):
+            if path == bad_mount:
+                raise OSError(5, 'Input/output error')
+            return Mock(st_mode=16877, st_uid=1000, st_gid=1001)
+
+        @mock.patch('swiftlm.systems.check_mounts.get_mounts', fake_get_mounts)
+        @mock.patch('os.stat', fake_os_stat)
+        @mock.patch('pwd.getpwuid', make_fake_getpwuid({1000: 'swift'}))
+        @mock.patch('pwd.getpwnam', make_fake_getpwnam({1000: 'swift'}))
+        @mock.patch('grp.getgrgid', make_fake_getgrgid({1001: 'swift'}))
+        @mock.patch('grp.getgrnam', make_fake_getgrnam({1001: 'swift'}))
+        @mock.patch('swiftlm.systems.check_mounts.is_valid_xfs',
+                    return_value=True)
+        def do_it(*args):
+            failed = []
+            actual = check_mounts.check_mounts(failed)
+            self.assertEqual([bad_mount], [d.mount for d in failed])
+            by_mount = dict((r['mount'], r) for r in actual)
+            self.assertEqual(2, len(by_mount))
+            self.assertEqual(Severity.fail, by_mount[bad_mount].value)
+            self.assertEqual(
+                '{device} mounted at {mount} could not be checked: '
+                '[Errno 5] Input/output error'.format(**dev_info['sdd']),
+                str(by_mount[bad_mount]))
+            self.assertEqual(Severity.ok,
+                             by_mount[dev_info['sde']['mount']].value)
+        do_it()
+
+
+class TestMountSnapshot(unittest.TestCase):
+
+    def p(self, name, mock):
+        p = patch(name, mock)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.p('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        self.d = check_mounts.Device('/dev/sdb1', '/srv/node/disk0', 'lbl0')
+        self.mounts = {'/srv/node/disk0': MountEntry(
+            '40', '/dev/sdb1', '/srv/node/disk0', 'xfs', 'rw')}
+        self.p('swiftlm.systems.check_mounts.get_mounts',
+               lambda: self.mounts)
+
+    def test_mounted_and_xfs_from_mount_table(self):
+        snapshot = check_mounts.MountSnapshot()
+        self.assertTrue(check_mounts.is_mounted(self.d, {}, snapshot))
+        self.assertTrue(check_mounts.is_xfs(self.d, {}, snapshot))
+
+        self.mounts['/srv/node/disk0'] = MountEntry(
+            '40', '/dev/sdb1', '/srv/node/disk0', 'ext4', 'rw')
+        snapshot = check_mounts.MountSnapshot()
+        self.assertFalse(check_mounts.is_xfs(self.d, {}, snapshot))
+
+        d = check_mounts.Device('/dev/sdc1', '/srv/node/disk1', 'lbl1')
+        self.assertFalse(check_mounts.is_mounted(d, {}, snapshot))
+        self.assertFalse(check_mounts.is_xfs(d, {}, snapshot))
+
+    def test_mount_table_unreadable(self):
+        def fake_get_mounts():
+            raise IOError('No such file or directory')
+
+        with patch('swiftlm.systems.check_mounts.get_mounts',
+                   fake_get_mounts):
+            self.assertRaises(SwiftlmCheckFailure,
+                              check_mounts.MountSnapshot)
+
+    @mock.patch('swiftlm.systems.check_mounts.get_labels')
+    def test_is_valid_label(self, mock_labels):
+        mock_labels.return_value = {'/dev/sdb1': 'lbl0'}
+        snapshot = check_mounts.MountSnapshot()
+        self.assertTrue(check_mounts.is_valid_label(self.d, {}, snapshot))
+
+        d = self.d._replace(label='other')
+        self.assertFalse(check_mounts.is_valid_label(d, {}, snapshot))
+
+        d = self.d._replace(label=check_mounts.LABEL_CHECK_DISABLED)
+        self.assertTrue(check_mounts.is_valid_label(d, {}, snapshot))
+        # Labels are only read once per run
+        self.assertEqual(1, mock_labels.call_count)
+
+    @mock.patch('swiftlm.systems.check_mounts.run_cmd')
+    def test_xfs_info_cached(self, mock_run_cmd):
+        mock_run_cmd.return_value = CommandResult(0, '')
+        snapshot = check_mounts.MountSnapshot()
+        self.assertTrue(check_mounts.is_valid_xfs(self.d, {}, snapshot))
+        snapshot.save()
+        self.assertEqual(1, mock_run_cmd.call_count)
+
+        # A later run reuses the result
+        snapshot = check_mounts.MountSnapshot()
+        self.assertTrue(check_mounts.is_valid_xfs(self.d, {}, snapshot))
+        self.assertEqual(1, mock_run_cmd.call_count)
+
+        # ...until the TTL expires
+        later = time.time() + check_mounts.XFS_INFO_TTL + 1
+        with patch('swiftlm.systems.check_mounts.time.time',
+                   lambda: later):
+            snapshot = check_mounts.MountSnapshot()
+            self.assertTrue(check_mounts.is_valid_xfs(self.d, {}, snapshot))
+        self.assertEqual(2, mock_run_cmd.call_count)
+
+        # ...or the filesystem is remounted
+        mock_run_cmd.return_value = CommandResult(1, 'corrupt')
+        self.mounts['/srv/node/disk0'] = self.mounts[
+            '/srv/node/disk0']._replace(mount_id='41')
+        snapshot = check_mounts.MountSnapshot()
+        self.assertFalse(check_mounts.is_valid_xfs(self.d, {}, snapshot))
+        self.assertEqual(3, mock_run_cmd.call_count)
+
+
+class TestCheckMountsBenchmark(unittest.TestCase):
+    """
+    Scan a synthetic node with 100 drives.
+
+    The scan should not fork any process other than one xfs_info per drive,
+    and on later runs none at all.
+    """
+    drives = 100
+
+    def p(self, name, mock):
+        p = patch(name, mock)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        dev_dir = os.path.join(self.testdir, 'dev')
+        label_dir = os.path.join(self.testdir, 'by-label')
+        mnt_dir = os.path.join(self.testdir, 'mnt')
+        for d in (dev_dir, label_dir, mnt_dir):
+            os.makedirs(d)
+
+        facts = {'devices': []}
+        mountinfo = []
+        for n in range(self.drives):
+            dev = os.path.join(dev_dir, 'sd%d1' % n)
+            mnt = os.path.join(mnt_dir, 'disk%d' % n)
+            open(dev, 'w').close()
+            os.mkdir(mnt)
+            os.chmod(mnt, 0o755)
+            os.symlink(dev, os.path.join(label_dir, 'l%d' % n))
+            facts['devices'].append({'name': dev, 'swift_drive_name': mnt,
+                                     'label': 'l%d' % n})
+            mountinfo.append('%d 25 8:%d / %s rw,noatime shared:%d - xfs %s '
+                             'rw,attr2,inode64,noquota' %
+                             (100 + n, n, mnt, n, dev))
+        devices_file = os.path.join(self.testdir, 'devices')
+        with open(devices_file, 'w') as f:
+            json.dump(facts, f)
+        mountinfo_file = os.path.join(self.testdir, 'mountinfo')
+        with open(mountinfo_file, 'w') as f:
+            f.write('\n'.join(mountinfo) + '\n')
+
+        self.p('swiftlm.systems.check_mounts.DEVICES', devices_file)
+        self.p('swiftlm.systems.check_mounts.MOUNT_PATH', '')
+        self.p('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        self.p('swiftlm.systems.check_mounts.get_mounts',
+               lambda: utility.get_mounts(mountinfo_file))
+        self.p('swiftlm.systems.check_mounts.get_labels',
+               lambda: utility.get_labels(label_dir, ()))
+        self.p('swiftlm.systems.check_mounts.get_uid',
+               lambda name: os.getuid())
+        self.p('swiftlm.systems.check_mounts.get_gid',
+               lambda name: os.getgid())
+        self.run_cmd = Mock(return_value=CommandResult(0, ''))
+        self.p('swiftlm.systems.check_mounts.run_cmd', self.run_cmd)
+
+    def _scan(self):
+        start = time.time()
+        results = check_mounts.check_mounts()
+        elapsed = time.time() - start
+        self.assertEqual(self.drives, len(results))
+        self.assertTrue(all(r.value == Severity.ok for r in results),
+                        [str(r) for r in results if r.value != Severity.ok])
+        return elapsed
+
+    def test_benchmark(self):
+        first = self._scan()
+        self.assertEqual(self.drives, self.run_cmd.call_count)
+        second = self._scan()
+        self.assertEqual(self.drives, self.run_cmd.call_count)
+        # Without forking, a 100 drive scan is a few milliseconds; the bound
+        # is loose so this does not fail on a busy test host.
+        self.assertLess(first, 5.0)
+        self.assertLess(second, 5.0)
+
 
 class FakeStatvfs(object):
             def __init__(self):
@@ -523,6 +825,9 @@ class FakeStatvfs(object):
                 self.f_blocks = 130048
                 self.f_bfree = 47299
                 self.f_bavail = 47299
+                self.f_files = 65536
+                self.f_ffree = 60000
+                self.f_favail = 60000
 
 fake_statvfs_result = FakeStatvfs()
 
@@ -534,7 +839,10 @@ class TestDiskUsage(unittest.TestCase):
         expected = {'size': 532676608,
                     'used': 338939904,
                     'avail': 193736704,
-                    'usage': 64.0}
+                    'usage': 64.0,
+                    'inodes_used': 5536,
+                    'inodes_free': 60000,
+                    'inodes_usage': 9.0}
         result = check_mounts.get_diskusage(check_mounts.Device('na',
                                                                 'na', 'na'))
         self.assertEqual(expected, result)
@@ -564,6 +872,21 @@ class TestDiskUsage(unittest.TestCase):
                                       dimensions={'mount': 'na',
                                                   'service':
                                                   'object-storage'}),
+                    MetricData.single('swiftlm.diskusage.host.val.inodes_used',
+                                      5536,
+                                      dimensions={'mount': 'na',
+                                                  'service':
+                                                  'object-storage'}),
+                    MetricData.single('swiftlm.diskusage.host.val.inodes_free',
+                                      60000,
+                                      dimensions={'mount': 'na',
+                                                  'service':
+                                                  'object-storage'}),
+                    MetricData.single(
+                        'swiftlm.diskusage.host.val.inodes_usage',
+                        9.0,
+                        dimensions={'mount': 'na',
+                                    'service': 'object-storage'}),
                     MetricData.single('swiftlm.diskusage.host.max.usage',
                                       64.0,
                                       dimensions={'service':
@@ -575,7 +898,16 @@ class TestDiskUsage(unittest.TestCase):
                     MetricData.single('swiftlm.diskusage.host.avg.usage',
                                       64.0,
                                       dimensions={'service':
-                                                  'object-storage'})]
+                                                  'object-storage'}),
+                    MetricData.single(
+                        'swiftlm.diskusage.host.max.inodes_usage', 9.0,
+                        dimensions={'service': 'object-storage'}),
+                    MetricData.single(
+                        'swiftlm.diskusage.host.min.inodes_usage', 9.0,
+                        dimensions={'service': 'object-storage'}),
+                    MetricData.single(
+                        'swiftlm.diskusage.host.avg.inodes_usage', 9.0,
+                        dimensions={'service': 'object-storage'})]
         results = check_mounts.diskusage()
         for result in results:
             if result in expected:
@@ -584,3 +916,148 @@ class TestDiskUsage(unittest.TestCase):
                 self.assertEqual(True, False,
                                  msg='Not expecting %s' % result.__repr__())
         self.assertEqual(0, len(expected), msg='Missing: %s' % expected)
+
+    @mock.patch('swiftlm.systems.check_mounts.get_devices',
+                return_value=[check_mounts.Device('na', 'na', 'na'),
+                              check_mounts.Device('hung', 'hung', 'hung'),
+                              check_mounts.Device('skip', 'skip', 'skip')])
+    @mock.patch('swiftlm.systems.check_mounts.DRIVE_TIMEOUT', 0.1)
+    @mock.patch('swiftlm.utils.metricdata.timestamp', lambda: 123456)
+    def test_diskusage_hung(self, *args):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        statvfs_paths = []
+
+        def fake_statvfs(path):
+            statvfs_paths.append(path)
+            if path == 'hung':
+                release.wait()
+            return fake_statvfs_result
+
+        with mock.patch('os.statvfs', fake_statvfs):
+            results = check_mounts.diskusage(
+                skip=[check_mounts.Device('skip', 'skip', 'skip')])
+
+        self.assertEqual(['hung', 'na'], sorted(statvfs_paths))
+        self.assertEqual(
+            set(['na']),
+            set(r['mount'] for r in results if 'mount' in r))
+        usage = dict((r.name, r.value) for r in results
+                     if 'mount' not in r and r.name.endswith('.usage'))
+        self.assertEqual({'swiftlm.diskusage.host.max.usage': 64.0,
+                          'swiftlm.diskusage.host.min.usage': 64.0,
+                          'swiftlm.diskusage.host.avg.usage': 64.0}, usage)
+
+    @mock.patch('swiftlm.systems.check_mounts.get_devices',
+                return_value=[check_mounts.Device('na', 'na', 'na'),
+                              check_mounts.Device('eio', 'eio', 'eio')])
+    @mock.patch('swiftlm.utils.metricdata.timestamp', lambda: 123456)
+    def test_diskusage_error(self, *args):
+        def fake_statvfs(path):
+            if path == 'eio':
+                raise OSError(5, 'Input/output error')
+            return fake_statvfs_result
+
+        with mock.patch('os.statvfs', fake_statvfs):
+            results = check_mounts.diskusage()
+
+        failed = [r for r in results if r.value == Severity.fail]
+        self.assertEqual(1, len(failed))
+        self.assertEqual('swiftlm.systems.check_mounts', failed[0].name)
+        self.assertEqual('eio mounted at eio could not be checked: '
+                         '[Errno 5] Input/output error', str(failed[0]))
+        self.assertEqual(
+            set(['na']),
+            set(r['mount'] for r in results
+                if 'mount' in r and r.name.startswith('swiftlm.diskusage')))
+        usage = dict((r.name, r.value) for r in results
+                     if 'mount' not in r and r.name.endswith('.usage'))
+        self.assertEqual({'swiftlm.diskusage.host.max.usage': 64.0,
+                          'swiftlm.diskusage.host.min.usage': 64.0,
+                          'swiftlm.diskusage.host.avg.usage': 64.0}, usage)
+
+    def test_get_diskusage_no_inodes(self):
+        statvfs_result = FakeStatvfs()
+        statvfs_result.f_files = statvfs_result.f_ffree = 0
+        statvfs_result.f_favail = 0
+        with mock.patch('os.statvfs', return_value=statvfs_result):
+            result = check_mounts.get_diskusage(
+                check_mounts.Device('na', 'na', 'na'))
+        self.assertEqual(set(['size', 'used', 'avail', 'usage']),
+                         set(result.keys()))
+
+
+FREESP_OUTPUT = """blocksize = 4096
+   from      to extents  blocks    pct
+      1       1      31      31   0.00
+      2       3      40     101   0.00
+      4       7      22     113   0.00
+     64     127     100    9000   0.10
+    128     255     500   95000   1.09
+    256     511      10    3000   0.03
+ 524288 1048575       7 6418453  73.79
+total free extents 710
+total free blocks 8698130
+average free extent size 12251.0
+"""
+
+
+class TestFreesp(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        p = patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_parse_freesp(self):
+        self.assertEqual({'freesp_frag': 1.19,
+                          'freesp_avg_extent': 12251 * 4096},
+                         check_mounts.parse_freesp(FREESP_OUTPUT))
+        self.assertEqual({}, check_mounts.parse_freesp(''))
+        self.assertEqual({}, check_mounts.parse_freesp(
+            'xfs_db: cannot open /dev/sdb1'))
+
+    @mock.patch('swiftlm.systems.check_mounts.run_cmd',
+                return_value=CommandResult(0, FREESP_OUTPUT))
+    def test_get_freesp_rate_limited(self, mock_run_cmd):
+        d = check_mounts.Device('/dev/sdb1', '/srv/node/disk0', 'na')
+        state = {}
+        expected = check_mounts.parse_freesp(FREESP_OUTPUT)
+        self.assertEqual(expected, check_mounts.get_freesp(d, state, 600))
+        self.assertEqual(expected, check_mounts.get_freesp(d, state, 600))
+        self.assertEqual(1, mock_run_cmd.call_count)
+        self.assertTrue(mock_run_cmd.call_args[0][0].endswith(' /dev/sdb1'))
+
+        state[d.mount]['time'] -= 601
+        self.assertEqual(expected, check_mounts.get_freesp(d, state, 600))
+        self.assertEqual(2, mock_run_cmd.call_count)
+
+    @mock.patch('os.statvfs', return_value=fake_statvfs_result)
+    @mock.patch('swiftlm.systems.check_mounts.get_devices',
+                return_value=[check_mounts.Device('/dev/sdb1', 'disk0', 'na'),
+                              check_mounts.Device('/dev/sdc1', 'disk1', 'na')])
+    @mock.patch('swiftlm.systems.check_mounts.get_diskusage_conf',
+                return_value={'xfs_freesp_interval': 3600})
+    @mock.patch('swiftlm.systems.check_mounts.run_cmd')
+    def test_diskusage_with_freesp(self, mock_run_cmd, *args):
+        def fake_run_cmd(cmd):
+            if cmd.endswith('/dev/sdb1'):
+                return CommandResult(0, FREESP_OUTPUT)
+            return CommandResult(0, FREESP_OUTPUT.replace(' 1.09', ' 0.00'))
+        mock_run_cmd.side_effect = fake_run_cmd
+
+        for _ in range(2):
+            results = dict(((r.name, r.dimensions.get('mount')), r.value)
+                           for r in check_mounts.diskusage())
+        # xfs_db is only run once per drive per interval
+        self.assertEqual(2, mock_run_cmd.call_count)
+        base = 'swiftlm.diskusage.host.'
+        self.assertEqual(1.19, results[(base + 'val.freesp_frag', 'disk0')])
+        self.assertEqual(0.1, results[(base + 'val.freesp_frag', 'disk1')])
+        self.assertEqual(1.19, results[(base + 'max.freesp_frag', None)])
+        self.assertEqual(0.1, results[(base + 'min.freesp_frag', None)])
+        self.assertAlmostEqual(0.645,
+                               results[(base + 'avg.freesp_frag', None)])
+        self.assertEqual(9.0, results[(base + 'max.inodes_usage', None)])
@@ -0,0 +1,182 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import mock
+
+from swiftlm.systems import diskstats
+from swiftlm.systems.check_mounts import Device
+from swiftlm.utils.values import Severity
+
+
+def diskstats_line(name, reads=0, read_sectors=0, read_ms=0, writes=0,
+                   write_sectors=0, write_ms=0, in_flight=0, io_ms=0,
+                   weighted_ms=0):
+    return '%4d %7d %s %d 0 %d %d %d 0 %d %d %d %d %d 0 0 0 0\n' % (
+        8, 16, name, reads, read_sectors, read_ms, writes, write_sectors,
+        write_ms, in_flight, io_ms, weighted_ms)
+
+
+class TestDiskstats(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.proc_diskstats = os.path.join(self.testdir, 'diskstats')
+        self.sys_class_block = os.path.join(self.testdir, 'block')
+        os.mkdir(self.sys_class_block)
+        self.devices = [Device('/dev/sd%s1' % c, '/srv/node/disk%d' % n,
+                               '---NA---')
+                        for n, c in enumerate('bcde')]
+        self.now = 1000.0
+        self.sleeps = []
+        for name, patched in (
+                ('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir),
+                ('swiftlm.systems.diskstats.PROC_DISKSTATS',
+                 self.proc_diskstats),
+                ('swiftlm.systems.diskstats.SYS_CLASS_BLOCK',
+                 self.sys_class_block),
+                ('swiftlm.systems.diskstats.get_devices',
+                 lambda: self.devices),
+                ('swiftlm.systems.diskstats.time.time', lambda: self.now),
+                ('swiftlm.systems.diskstats.time.sleep', self.sleeps.append),
+                ('swiftlm.utils.metricdata.timestamp', lambda: 123456)):
+            mock.patch(name, patched).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def write_diskstats(self, stats):
+        with open(self.proc_diskstats, 'w') as f:
+            f.write(diskstats_line('sda'))
+            for name, counters in sorted(stats.items()):
+                f.write(diskstats_line(name, **counters))
+
+    def values(self, results):
+        return dict(((r.name, r.dimensions.get('mount')), r.value)
+                    for r in results)
+
+    def test_read_diskstats(self):
+        self.write_diskstats({'sdb1': {'reads': 5, 'io_ms': 7}})
+        os.mkdir(os.path.join(self.sys_class_block, 'sdc1'))
+        with open(os.path.join(self.sys_class_block, 'sdc1', 'stat'),
+                  'w') as f:
+            f.write('    1 0 2 3 4 0 5 6 7 8 9 0 0 0 0\n')
+
+        stats = diskstats.read_diskstats(set(['sdb1', 'sdc1', 'sdz1']))
+        self.assertEqual(['sdb1', 'sdc1'], sorted(stats))
+        self.assertEqual(5, stats['sdb1'].reads)
+        self.assertEqual(7, stats['sdb1'].io_ms)
+        self.assertEqual(diskstats.DiskStats(1, 2, 3, 4, 5, 6, 7, 8, 9),
+                         stats['sdc1'])
+
+    def test_io_rates(self):
+        old = diskstats.DiskStats(100, 1000, 500, 200, 4000, 1500, 0,
+                                  2000, 3000)
+        new = diskstats.DiskStats(300, 3000, 1500, 400, 8000, 4500, 2,
+                                  7000, 13000)
+        self.assertEqual({'read_iops': 20.0, 'write_iops': 20.0,
+                          'read_bytes_per_sec': 102400,
+                          'write_bytes_per_sec': 204800,
+                          'await': 10.0, 'util': 50.0,
+                          'queue_depth': 1.0},
+                         diskstats.io_rates(old, new, 10))
+        self.assertIsNone(diskstats.io_rates(new, old, 10))
+
+    def test_find_outliers(self):
+        rates = {'a': {'await': 5.0, 'util': 10.0},
+                 'b': {'await': 6.0, 'util': 12.0},
+                 'c': {'await': 50.0, 'util': 15.0},
+                 'd': {'await': 7.0, 'util': 90.0}}
+        # Each drive is compared with the median of the others
+        self.assertEqual({'c': ('await', 50.0, 6.0),
+                          'd': ('util', 90.0, 12.0)},
+                         diskstats.find_outliers(rates))
+        # With three drives, one slow drive does not pull the median up
+        del rates['d']
+        self.assertEqual({'c': ('await', 50.0, 5.5)},
+                         diskstats.find_outliers(rates))
+        # Too few peers to compare with
+        del rates['a']
+        self.assertEqual({}, diskstats.find_outliers(rates))
+
+    def test_first_run_takes_two_samples(self):
+        self.write_diskstats({'sdb1': {}, 'sdc1': {}, 'sdd1': {},
+                              'sde1': {}})
+        results = diskstats.main()
+        self.assertEqual([diskstats.SAMPLE_INTERVAL], self.sleeps)
+        values = self.values(results)
+        self.assertEqual(0.0, values[('swiftlm.diskstats.host.val.await',
+                                      '/srv/node/disk0')])
+        self.assertEqual(Severity.ok, values[('swiftlm.systems.diskstats',
+                                              '/srv/node/disk3')])
+
+    def test_rates_since_last_run(self):
+        self.write_diskstats({'sdb1': {}, 'sdc1': {}, 'sdd1': {},
+                              'sde1': {}})
+        diskstats.main()
+        self.sleeps[:] = []
+
+        self.now += 60
+        busy = {'reads': 600, 'read_ms': 3000, 'io_ms': 6000}
+        self.write_diskstats({'sdb1': busy, 'sdc1': busy, 'sdd1': busy,
+                              'sde1': {'reads': 600, 'read_ms': 60000,
+                                       'io_ms': 54000,
+                                       'read_sectors': 1200}})
+        results = diskstats.main()
+        self.assertEqual([], self.sleeps)
+        values = self.values(results)
+        self.assertEqual(10.0, values[('swiftlm.diskstats.host.val.read_iops',
+                                       '/srv/node/disk0')])
+        self.assertEqual(5.0, values[('swiftlm.diskstats.host.val.await',
+                                      '/srv/node/disk0')])
+        self.assertEqual(10.0, values[('swiftlm.diskstats.host.val.util',
+                                       '/srv/node/disk0')])
+        self.assertEqual(100.0, values[('swiftlm.diskstats.host.val.await',
+                                        '/srv/node/disk3')])
+        self.assertEqual(10240, values[
+            ('swiftlm.diskstats.host.val.read_bytes_per_sec',
+             '/srv/node/disk3')])
+        self.assertEqual(100.0, values[('swiftlm.diskstats.host.max.await',
+                                        None)])
+        self.assertEqual(28.75, values[('swiftlm.diskstats.host.avg.await',
+                                        None)])
+
+        for n in range(3):
+            self.assertEqual(Severity.ok, values[(
+                'swiftlm.systems.diskstats', '/srv/node/disk%d' % n)])
+        slow = [r for r in results
+                if r.dimensions.get('mount') == '/srv/node/disk3' and
+                r.name == 'swiftlm.systems.diskstats'][0]
+        self.assertEqual(Severity.warn, slow.value)
+        self.assertEqual('/dev/sde1 mounted at /srv/node/disk3 is slow: '
+                         'await of 100.0 is over 3.0 times the median of 5.0',
+                         slow.metric()['value_meta']['msg'])
+
+    def test_reboot(self):
+        self.write_diskstats({'sdb1': {'reads': 1000}})
+        self.devices = self.devices[:1]
+        diskstats.main()
+        self.sleeps[:] = []
+
+        # The counters go back to zero; the saved sample is not used
+        self.now += 600
+        self.write_diskstats({'sdb1': {'reads': 10}})
+        results = diskstats.main()
+        self.assertEqual([diskstats.SAMPLE_INTERVAL], self.sleeps)
+        self.assertEqual(0.0, self.values(results)[
+            ('swiftlm.diskstats.host.val.read_iops', '/srv/node/disk0')])
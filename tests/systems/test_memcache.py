@@ -0,0 +1,228 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from shutil import rmtree
+
+import mock
+
+from swiftlm.systems import memcache
+from swiftlm.utils.values import Severity
+
+SERVERS = ['192.168.245.5:11211', '192.168.245.6:11211',
+           '192.168.245.7:11211']
+
+STATS = ('STAT pid 1234\r\n'
+         'STAT uptime 1000\r\n'
+         'STAT version 1.4.25\r\n'
+         'STAT rusage_user 0.5\r\n'
+         'STAT curr_connections 10\r\n'
+         'STAT get_hits 900\r\n'
+         'STAT get_misses 100\r\n'
+         'STAT evictions 0\r\n'
+         'STAT curr_items 50\r\n'
+         'STAT bytes 16384\r\n'
+         'STAT limit_maxbytes 65536\r\n'
+         'END\r\n')
+
+SLABS = ('STAT 1:chunk_size 96\r\n'
+         'STAT 1:used_chunks 50\r\n'
+         'STAT active_slabs 1\r\n'
+         'STAT total_malloced 1048576\r\n'
+         'END\r\n')
+
+
+def stats(**counters):
+    result = memcache.parse_stats(STATS)
+    result.update(counters)
+    return result
+
+
+class FakeMemcached(threading.Thread):
+    """Answer the commands on one connection from replies"""
+
+    def __init__(self, replies):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.replies = replies
+        self.commands = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.server = '127.0.0.1:%d' % self.sock.getsockname()[1]
+
+    def run(self):
+        conn, _ = self.sock.accept()
+        data = ''
+        while len(self.commands) < len(self.replies):
+            data += conn.recv(1024)
+            while '\r\n' in data:
+                command, data = data.split('\r\n', 1)
+                reply = self.replies[len(self.commands)]
+                self.commands.append(command)
+                # Send the reply in two pieces
+                conn.sendall(reply[:10])
+                conn.sendall(reply[10:])
+        conn.close()
+        self.sock.close()
+
+
+class TestMemcache(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.now = 1000.0
+        self.replies = {}
+        for name, patched in (
+                ('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir),
+                ('swiftlm.systems.memcache.MEMCACHE_CONF_PATH', self.testdir),
+                ('swiftlm.systems.memcache.server_type', lambda *a: True),
+                ('swiftlm.systems.memcache.read_stats',
+                 self.fake_read_stats),
+                ('swiftlm.systems.memcache.time.time', lambda: self.now),
+                ('swiftlm.utils.metricdata.timestamp', lambda: 123456)):
+            mock.patch(name, patched).start()
+        self.addCleanup(mock.patch.stopall)
+        self.write_conf(','.join(SERVERS))
+
+    def write_conf(self, servers):
+        with open(os.path.join(self.testdir, 'memcache.conf'), 'w') as f:
+            f.write('[memcache]\nmemcache_servers = %s\n' % servers)
+
+    def fake_read_stats(self, server):
+        reply = self.replies.get(server)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply or [stats(), memcache.parse_stats(SLABS)]
+
+    def values(self, results):
+        return dict(((r.name, r.dimensions.get('url')), r.value)
+                    for r in results)
+
+    def test_get_memcache_servers(self):
+        self.write_conf('192.168.245.5:11211, 192.168.245.6,,')
+        self.assertEqual(['192.168.245.5:11211', '192.168.245.6:11211'],
+                         memcache.get_memcache_servers())
+        os.unlink(os.path.join(self.testdir, 'memcache.conf'))
+        self.assertEqual([], memcache.get_memcache_servers())
+
+    def test_parse_stats(self):
+        result = memcache.parse_stats(STATS)
+        self.assertEqual(1234, result['pid'])
+        self.assertEqual(0.5, result['rusage_user'])
+        self.assertEqual('1.4.25', result['version'])
+        self.assertEqual({'1:chunk_size': 96, '1:used_chunks': 50,
+                          'active_slabs': 1, 'total_malloced': 1048576},
+                         memcache.parse_stats(SLABS))
+        self.assertRaises(ValueError, memcache.parse_stats, 'ERROR\r\n')
+
+    def test_read_stats(self):
+        mock.patch.stopall()
+        daemon = FakeMemcached([STATS, SLABS])
+        daemon.start()
+        result = memcache.read_stats(daemon.server)
+        daemon.join()
+        self.assertEqual(['stats', 'stats slabs'], daemon.commands)
+        self.assertEqual(memcache.parse_stats(STATS), result[0])
+        self.assertEqual(1, result[1]['active_slabs'])
+
+    def test_read_stats_error(self):
+        mock.patch.stopall()
+        daemon = FakeMemcached(['ERROR\r\n'])
+        daemon.start()
+        self.assertRaises(ValueError, memcache.read_stats, daemon.server,
+                          ('stats nonsense',))
+        daemon.join()
+
+    def test_server_values(self):
+        slabs = memcache.parse_stats(SLABS)
+        old = {'pid': 1234, 'uptime': 940, 'get_hits': 600,
+               'get_misses': 0, 'evictions': 0}
+        new = stats(evictions=120)
+        self.assertEqual({'hit_ratio': 0.75, 'evictions_per_sec': 2.0,
+                          'curr_connections': 10, 'curr_items': 50,
+                          'bytes': 16384, 'limit_maxbytes': 65536,
+                          'bytes_used_pct': 25.0, 'active_slabs': 1,
+                          'total_malloced': 1048576},
+                         memcache.server_values(new, slabs, old, 60))
+
+        # memcached restarted; the hit ratio is over its lifetime
+        restarted = dict(old, pid=999)
+        values = memcache.server_values(new, slabs, restarted, 60)
+        self.assertEqual(0.9, values['hit_ratio'])
+        self.assertNotIn('evictions_per_sec', values)
+
+        # No gets at all
+        values = memcache.server_values(stats(get_hits=0, get_misses=0),
+                                        slabs, {}, 0)
+        self.assertNotIn('hit_ratio', values)
+
+    def test_key_distribution(self):
+        shares = memcache.key_distribution(SERVERS, 3000)
+        self.assertEqual(set(SERVERS), set(shares))
+        self.assertAlmostEqual(1.0, sum(shares.values()))
+        self.assertTrue(all(0.2 < share < 0.5 for share in shares.values()))
+
+    def test_main(self):
+        results = memcache.main()
+        values = self.values(results)
+        for server in SERVERS:
+            self.assertEqual(Severity.ok,
+                             values[('swiftlm.systems.memcache', server)])
+            self.assertEqual(0.9, values[
+                ('swiftlm.memcache.server.val.hit_ratio', server)])
+            self.assertEqual(25.0, values[
+                ('swiftlm.memcache.server.val.bytes_used_pct', server)])
+            self.assertNotIn(
+                ('swiftlm.memcache.server.val.evictions_per_sec', server),
+                values)
+            self.assertIn(('swiftlm.memcache.ring.val.key_share', server),
+                          values)
+        imbalance = values[('swiftlm.memcache.ring.max.imbalance', None)]
+        self.assertTrue(1.0 <= imbalance < 1.5, imbalance)
+
+        # A minute later, one server has evicted items and one is down
+        self.now += 60
+        slabs = memcache.parse_stats(SLABS)
+        self.replies[SERVERS[0]] = [
+            stats(uptime=1060, get_hits=1200, evictions=30), slabs]
+        self.replies[SERVERS[1]] = socket.error(111, 'ECONNREFUSED')
+        results = memcache.main()
+        values = self.values(results)
+        self.assertEqual(1.0, values[
+            ('swiftlm.memcache.server.val.hit_ratio', SERVERS[0])])
+        self.assertEqual(0.5, values[
+            ('swiftlm.memcache.server.val.evictions_per_sec', SERVERS[0])])
+        self.assertEqual(0.0, values[
+            ('swiftlm.memcache.server.val.evictions_per_sec', SERVERS[2])])
+        statuses = dict((r.dimensions['url'], r) for r in results
+                        if r.name == 'swiftlm.systems.memcache')
+        self.assertEqual(Severity.warn, statuses[SERVERS[0]].value)
+        self.assertEqual('%s is evicting 0.5 items per second with 25.0%% of'
+                         ' memory used' % SERVERS[0],
+                         str(statuses[SERVERS[0]]))
+        self.assertEqual(Severity.fail, statuses[SERVERS[1]].value)
+        self.assertIn('ECONNREFUSED', str(statuses[SERVERS[1]]))
+        self.assertEqual(Severity.ok, statuses[SERVERS[2]].value)
+
+    def test_not_proxy(self):
+        with mock.patch('swiftlm.systems.memcache.server_type',
+                        return_value=False):
+            self.assertEqual([], memcache.main())
@@ -15,13 +15,50 @@
 #
 
 
+import socket
+import struct
+import tempfile
+import threading
 import unittest
+from shutil import rmtree
 from mock import Mock, patch
 
 from swiftlm.systems import ntp
 from swiftlm.utils.values import Severity
-from swiftlm.utils.utility import CommandResult
-from swiftlm.utils.metricdata import MetricData, CheckFailure
+from swiftlm.utils.metricdata import MetricData
+
+SYNCED_CLOCK = {'synchronised': True, 'offset': 0.25, 'frequency': -12.5,
+                'estimated_error': 1.5, 'max_error': 20.0}
+
+NTPD_VARIABLES = (
+    'version="ntpd 4.2.8p10@1.3728-o", processor="x86_64",\r\n'
+    'system="Linux/4.4.0", leap=00, stratum=3, precision=-23,\r\n'
+    'rootdelay=1.612, rootdisp=21.542, refid=10.1.1.1, offset=-0.431,\r\n'
+    'frequency=-12.345, sys_jitter=0.081, clk_jitter=0.054')
+
+
+def chrony_encode(coef, exp):
+    """The inverse of ntp.chrony_float, value = coef * 2 ** (exp - 25)"""
+    return ((exp & 0x7f) << 25) | (coef & 0x1ffffff)
+
+
+class FakeDaemon(threading.Thread):
+    """Answer one UDP request on localhost with reply(request)"""
+
+    def __init__(self, reply):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.reply = reply
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self.request = None
+
+    def run(self):
+        self.request, client = self.sock.recvfrom(4096)
+        for packet in self.reply(self.request):
+            self.sock.sendto(packet, client)
+        self.sock.close()
 
 
 class TestNtp(unittest.TestCase):
@@ -31,93 +68,147 @@ class TestNtp(unittest.TestCase):
         self.addCleanup(p.stop)
 
     def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.p('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir)
         self.p('swiftlm.systems.ntp.BASE_RESULT.dimensions', {})
         self.p('swiftlm.utils.metricdata.get_base_dimensions', lambda *a: {})
         self.p('swiftlm.utils.metricdata.timestamp', lambda *a: 123456)
+        self.now = 1000.0
+        self.p('swiftlm.systems.ntp.time.time', lambda: self.now)
 
-    def test_status_ok(self):
-        mock_command = Mock()
-        mock_command.return_value = CommandResult(0, '')
+    def values(self, results):
+        return dict((r.name, r.value) for r in results)
 
-        with patch('swiftlm.systems.ntp.run_cmd', mock_command):
-            with patch('swiftlm.systems.ntp.check_details', lambda: []):
+    def test_status_ok(self):
+        with patch('swiftlm.systems.ntp.read_adjtimex',
+                   return_value=SYNCED_CLOCK):
+            with patch('swiftlm.systems.ntp.query_daemon',
+                       return_value=('ntpd', {'stratum': 3,
+                                              'offset': -0.431,
+                                              'frequency': -12.345})):
                 actual = ntp.main()
 
         self.assertIsInstance(actual, list)
-        self.assertEqual(len(actual), 1)
         r = actual[0]
         self.assertIsInstance(r, MetricData)
-
         expected = MetricData.single(ntp.__name__, Severity.ok,
                                      ntp.BASE_RESULT.messages['ok'])
         self.assertEqual(r, expected)
+        self.assertEqual({ntp.__name__: Severity.ok,
+                          ntp.__name__ + '.stratum': 3,
+                          ntp.__name__ + '.offset': -0.431,
+                          ntp.__name__ + '.frequency': -12.345,
+                          ntp.__name__ + '.estimated_error': 1.5,
+                          ntp.__name__ + '.max_error': 20.0},
+                         self.values(actual))
 
     def test_status_fail(self):
-        mock_command = Mock()
-        mock_command.return_value = CommandResult(1, 'error')
-
-        with patch('swiftlm.systems.ntp.run_cmd', mock_command):
-            with patch('swiftlm.systems.ntp.check_details', lambda: []):
+        clock = dict(SYNCED_CLOCK, synchronised=False)
+        with patch('swiftlm.systems.ntp.read_adjtimex', return_value=clock):
+            with patch('swiftlm.systems.ntp.query_daemon',
+                       return_value=(None, {})):
                 actual = ntp.main()
 
-        self.assertIsInstance(actual, list)
-        self.assertEqual(len(actual), 1)
         r = actual[0]
-        self.assertIsInstance(r, MetricData)
-
         expected = MetricData.single(ntp.__name__, Severity.fail,
                                      ntp.BASE_RESULT.messages['fail'],
-                                     {'error': 'error'})
+                                     msgkeys={'error': 'no ntpd or chronyd'
+                                              ' is answering'})
         self.assertEqual(r, expected)
-
-    def test_details_ok(self):
-        mock_command = Mock()
-        mock_command.return_value = CommandResult(0, 'stratum=1,offset=2,')
-
-        with patch('swiftlm.systems.ntp.run_cmd', mock_command):
-            with patch('swiftlm.systems.ntp.check_status', lambda: []):
-                actual = ntp.main()
-
-        self.assertIsInstance(actual, list)
-        self.assertEqual(len(actual), 2)
-        actual = [a.metric() for a in actual]
-
-        expected = [
-            MetricData.single(ntp.__name__+'.stratum', '1', ''),
-            MetricData.single(ntp.__name__+'.offset', '2', '')
-        ]
-
-        for e in expected:
-            self.assertIn(e.metric(), actual)
-
-    def test_details_fail(self):
-        mock_command = Mock()
-        mock_command.return_value = CommandResult(0, 'stratum=1,')
-
-        with patch('swiftlm.systems.ntp.run_cmd', mock_command):
-            with patch('swiftlm.systems.ntp.check_status', lambda: []):
-                actual = ntp.main()
-
-        self.assertIsInstance(actual, list)
-        self.assertEqual(len(actual), 2)
-        actual = [a.metric() for a in actual]
-
-        failed = CheckFailure.child()
-        failed.value = Severity.fail
-        failed['check'] = ntp.__name__ + '.offset'
-        failed['error'] = 'Output does not contain "offset"'
-
-        expected = [
-            failed,
-            MetricData.single(ntp.__name__+'.stratum', '1', ''),
-        ]
-
-        for e in expected:
-            self.assertIn(e.metric(), actual)
+        # Without a daemon the kernel's offset is reported
+        values = self.values(actual)
+        self.assertEqual(0.25, values[ntp.__name__ + '.offset'])
+        self.assertNotIn(ntp.__name__ + '.stratum', values)
+
+    def test_adjtimex_fail(self):
+        with patch('swiftlm.systems.ntp.read_adjtimex',
+                   side_effect=OSError(1, 'EPERM')):
+            actual = ntp.main()
+        self.assertEqual(1, len(actual))
+        self.assertEqual(Severity.fail, actual[0].value)
+
+    def test_read_adjtimex(self):
+        clock = ntp.read_adjtimex()
+        self.assertEqual(set(SYNCED_CLOCK), set(clock))
+
+    def test_drift_rate(self):
+        query = Mock(return_value=(None, {}))
+        clock = dict(SYNCED_CLOCK)
+        with patch('swiftlm.systems.ntp.read_adjtimex', return_value=clock):
+            with patch('swiftlm.systems.ntp.query_daemon', query):
+                values = self.values(ntp.main())
+                self.assertNotIn(ntp.__name__ + '.drift_rate', values)
+                # 0.5ms more every 15 minutes
+                for n in range(1, 20):
+                    self.now += 900
+                    clock['offset'] += 0.5
+                    values = self.values(ntp.main())
+        self.assertEqual(2.0, values[ntp.__name__ + '.drift_rate'])
+        history = ntp.load_state(ntp.NTP_STATE)['history']
+        self.assertEqual(ntp.HISTORY_SIZE, len(history))
+
+        # Old offsets are dropped
+        self.now += ntp.HISTORY_AGE
+        self.assertEqual([[self.now, 1.0]], ntp.update_history(1.0, self.now))
+
+    def test_parse_ntpd_variables(self):
+        variables = ntp.parse_ntpd_variables(NTPD_VARIABLES)
+        self.assertEqual('3', variables['stratum'])
+        self.assertEqual('-0.431', variables['offset'])
+        self.assertEqual('ntpd 4.2.8p10@1.3728-o', variables['version'])
+
+    def test_query_ntpd(self):
+        def reply(request):
+            _, op, seq, _, _, _, _ = ntp.NTP_CONTROL_HEADER.unpack_from(
+                request)
+            self.assertEqual(ntp.NTP_CONTROL_READVAR, op)
+            # Two fragments, the second sent first
+            first, second = NTPD_VARIABLES[:100], NTPD_VARIABLES[100:]
+            return [
+                ntp.NTP_CONTROL_HEADER.pack(
+                    0x16, 0x80 | op, seq, 0, 0, 100, len(second)) + second,
+                ntp.NTP_CONTROL_HEADER.pack(
+                    0x16, 0xa0 | op, seq, 0, 0, 0, len(first)) + first,
+            ]
+        daemon = FakeDaemon(reply)
+        daemon.start()
+        self.assertEqual({'stratum': 3, 'offset': -0.431,
+                          'frequency': -12.345},
+                         ntp.query_ntpd(daemon.address))
+        daemon.join()
+
+    def test_query_chronyd(self):
+        def reply(request):
+            self.assertEqual(ntp.CHRONY_TRACKING_REPLY_SIZE, len(request))
+            fields = ntp.CHRONY_REQUEST_HEADER.unpack_from(request)
+            self.assertEqual(ntp.CHRONY_REQ_TRACKING, fields[4])
+            header = ntp.CHRONY_REPLY_HEADER.pack(
+                6, 2, 0, 0, ntp.CHRONY_REQ_TRACKING, ntp.CHRONY_RPY_TRACKING,
+                0, 0, 0, 0, fields[6], 0, 0)
+            floats = [0] * 9
+            # 2 ** -10 seconds slow, -12.5 ppm
+            floats[0] = chrony_encode(1 << 20, -5)
+            floats[3] = chrony_encode(-25, 24)
+            tracking = ntp.CHRONY_TRACKING.pack(
+                0x0a010101, b'\0' * 16, 1, 0, 2, 0, 0, 0, 0, *floats)
+            return [header + tracking]
+        daemon = FakeDaemon(reply)
+        daemon.start()
+        self.assertEqual({'stratum': 2, 'offset': 0.9765625,
+                          'frequency': -12.5},
+                         ntp.query_chronyd(daemon.address))
+        daemon.join()
+
+    def test_query_daemon_none(self):
+        with patch('swiftlm.systems.ntp.query_ntpd',
+                   side_effect=socket.timeout()):
+            with patch('swiftlm.systems.ntp.query_chronyd',
+                       side_effect=socket.error(111, 'ECONNREFUSED')):
+                self.assertEqual((None, {}), ntp.query_daemon())
 
     def test_main(self):
-        with patch('swiftlm.systems.ntp.check_status', lambda: ['a']):
-            with patch('swiftlm.systems.ntp.check_details', lambda: ['b']):
-                actual = ntp.main()
+        with patch('swiftlm.systems.ntp.check_sync', lambda: ['a']):
+            actual = ntp.main()
 
-        self.assertListEqual(['a', 'b'], actual)
+        self.assertListEqual(['a'], actual)
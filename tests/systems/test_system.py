@@ -15,7 +15,10 @@
 #
 
 
+import os
+import tempfile
 import unittest
+from shutil import rmtree
 from mock import Mock, patch
 
 from swiftlm.systems import system
@@ -54,5 +57,152 @@ class TestSystem(unittest.TestCase):
     def test_main(self):
         # As functions are added, extend this to check that main calls them
         with patch('swiftlm.systems.system.get_load_average', lambda: ['a']):
-            actual = system.main()
-        self.assertListEqual(['a'], actual)
+            with patch('swiftlm.systems.system.get_host_stats',
+                       lambda: ['b']):
+                actual = system.main()
+        self.assertListEqual(['a', 'b'], actual)
+
+
+PROC_STAT = """cpu  %d 0 %d %d %d 0 0 %d 0 0
+cpu0 1 2 3 4 5 6 7 8 0 0
+intr 1 2 3
+"""
+
+MEMINFO = """MemTotal:        8000000 kB
+MemFree:         1000000 kB
+MemAvailable:    2000000 kB
+Buffers:           10000 kB
+Cached:          1500000 kB
+Dirty:               100 kB
+Writeback:             0 kB
+HugePages_Total:       0
+"""
+
+PRESSURE = """some avg10=0.00 avg60=0.00 avg300=0.00 total=%d
+full avg10=0.00 avg60=0.00 avg300=0.00 total=%d
+"""
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: 9999 99 0 0 0 0 0 0 9999 99 0 0 0 0 0 0
+  eth0: %d %d 0 %d 0 0 0 0 %d %d 0 0 0 0 0 0
+"""  # noqa
+
+SNMP = """Ip: Forwarding DefaultTTL
+Ip: 1 64
+Tcp: RtoAlgorithm RtoMin ActiveOpens InSegs OutSegs RetransSegs InErrs
+Tcp: 1 200 22 5000 %d %d 0
+Udp: InDatagrams NoPorts
+Udp: 10 0
+"""
+
+
+class TestHostStats(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        self.proc = os.path.join(self.testdir, 'proc')
+        for d in ('net', 'pressure'):
+            os.makedirs(os.path.join(self.proc, d))
+        self.now = 1000.0
+        for name, patched in (
+                ('swiftlm.utils.utility.SWIFTLM_STATE_DIR', self.testdir),
+                ('swiftlm.systems.system.PROC', self.proc),
+                ('swiftlm.systems.system.time.time', lambda: self.now),
+                ('swiftlm.utils.metricdata.get_base_dimensions',
+                 lambda *a: {}),
+                ('swiftlm.utils.metricdata.timestamp', lambda *a: 123456)):
+            patch(name, patched).start()
+        self.addCleanup(patch.stopall)
+
+    def write(self, path, text):
+        with open(os.path.join(self.proc, path), 'w') as f:
+            f.write(text)
+
+    def write_proc(self, user, system_, idle, iowait, steal, io_stall,
+                   rx_bytes, rx_drops, out_segs, retrans):
+        self.write('stat', PROC_STAT % (user, system_, idle, iowait, steal))
+        self.write('meminfo', MEMINFO)
+        self.write('pressure/io', PRESSURE % (io_stall, io_stall // 2))
+        self.write('net/dev', NET_DEV % (rx_bytes, 100, rx_drops, 500, 10))
+        self.write('net/snmp', SNMP % (out_segs, retrans))
+
+    def values(self, results):
+        return dict(((r.name, r.dimensions.get('interface')), r.value)
+                    for r in results)
+
+    def test_parse_meminfo(self):
+        meminfo = system.parse_meminfo(MEMINFO)
+        self.assertEqual(8000000 * 1024, meminfo['MemTotal'])
+        self.assertEqual(0, meminfo['HugePages_Total'])
+
+    def test_parse_net_dev(self):
+        self.assertEqual(
+            {'eth0': {'rx_bytes': 1, 'rx_packets': 2, 'rx_errors': 0,
+                      'rx_drops': 3, 'rx_fifo': 0, 'rx_frame': 0,
+                      'rx_compressed': 0, 'rx_multicast': 0,
+                      'tx_bytes': 4, 'tx_packets': 5, 'tx_errors': 0,
+                      'tx_drops': 0}},
+            system.parse_net_dev(NET_DEV % (1, 2, 3, 4, 5)))
+
+    def test_parse_snmp_tcp(self):
+        self.assertEqual({'OutSegs': 7, 'RetransSegs': 8, 'InErrs': 0},
+                         system.parse_snmp_tcp(SNMP % (7, 8)))
+
+    def test_first_run(self):
+        self.write_proc(100, 100, 100, 100, 100, 0, 0, 0, 0, 0)
+        values = self.values(system.get_host_stats())
+        # Only the memory figures do not need a previous sample
+        self.assertEqual({('swiftlm.memory.host.val.available_percent',
+                           None): 25.0,
+                          ('swiftlm.memory.host.val.cached_bytes',
+                           None): 1500000 * 1024,
+                          ('swiftlm.memory.host.val.dirty_bytes',
+                           None): 100 * 1024,
+                          ('swiftlm.memory.host.val.writeback_bytes',
+                           None): 0},
+                         values)
+
+    def test_deltas(self):
+        self.write_proc(100, 100, 100, 100, 100, 1000, 1000, 5, 1000, 10)
+        system.get_host_stats()
+        self.now += 10
+        self.write_proc(150, 110, 200, 120, 120, 501000, 11000, 25, 3000,
+                        15)
+        values = self.values(system.get_host_stats())
+
+        self.assertEqual(25.0, values[('swiftlm.cpu.host.val.user', None)])
+        self.assertEqual(5.0, values[('swiftlm.cpu.host.val.system', None)])
+        self.assertEqual(10.0, values[('swiftlm.cpu.host.val.iowait',
+                                       None)])
+        self.assertEqual(10.0, values[('swiftlm.cpu.host.val.steal', None)])
+        self.assertEqual(5.0, values[('swiftlm.pressure.host.val.io_some',
+                                      None)])
+        self.assertEqual(2.5, values[('swiftlm.pressure.host.val.io_full',
+                                      None)])
+        self.assertNotIn(('swiftlm.pressure.host.val.cpu_some', None),
+                         values)
+        self.assertEqual(1000.0, values[
+            ('swiftlm.net.host.val.rx_bytes_per_sec', 'eth0')])
+        self.assertEqual(2.0, values[
+            ('swiftlm.net.host.val.rx_drops_per_sec', 'eth0')])
+        self.assertEqual(0.0, values[
+            ('swiftlm.net.host.val.tx_bytes_per_sec', 'eth0')])
+        self.assertNotIn(('swiftlm.net.host.val.rx_bytes_per_sec', 'lo'),
+                         values)
+        self.assertEqual(0.5, values[
+            ('swiftlm.tcp.host.val.retrans_segs_per_sec', None)])
+        self.assertEqual(0.25, values[('swiftlm.tcp.host.val.retrans_percent',
+                                       None)])
+
+    def test_counters_reset(self):
+        self.write_proc(100, 100, 100, 100, 100, 1000, 1000, 5, 1000, 10)
+        system.get_host_stats()
+        self.now += 10
+        self.write_proc(10, 10, 10, 10, 10, 10, 10, 0, 10, 0)
+        values = self.values(system.get_host_stats())
+        self.assertNotIn(('swiftlm.cpu.host.val.user', None), values)
+        self.assertNotIn(('swiftlm.net.host.val.rx_bytes_per_sec', 'eth0'),
+                         values)
+        self.assertIn(('swiftlm.memory.host.val.cached_bytes', None), values)
@@ -0,0 +1,99 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+import unittest
+
+from swiftlm.utils.histogram import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_bucket(self):
+        histogram = LatencyHistogram()
+        for value in (0.0011, 0.01, 0.01025, 0.0123, 0.5, 1.0, 7.3, 99.0):
+            index = histogram.bucket(value)
+            self.assertLess(value, histogram.upper_bound(index))
+            self.assertGreaterEqual(value, histogram.upper_bound(index - 1))
+        self.assertEqual(0, histogram.bucket(0))
+        self.assertEqual(0, histogram.bucket(0.001))
+
+    def test_percentile(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertIsNone(histogram.mean())
+        for n in range(1, 1001):
+            histogram.record(n / 1000.0)
+        self.assertEqual(1000, histogram.count)
+        self.assertAlmostEqual(0.5005, histogram.mean())
+        # Within a bucket (1 / 32) of the true value
+        for percent in (50, 90, 99, 99.9):
+            value = histogram.percentile(percent)
+            self.assertLessEqual(percent / 100.0, value)
+            self.assertLess(value, percent / 100.0 * (1 + 1 / 32.0))
+        # Never outside the range recorded
+        self.assertEqual(1.0, histogram.percentile(100))
+        self.assertEqual(0.001, histogram.percentile(0))
+
+    def test_out_of_range(self):
+        histogram = LatencyHistogram(min_value=1, max_value=100)
+        histogram.record(0)
+        histogram.record(1000)
+        self.assertEqual(1, histogram.counts[0])
+        self.assertEqual(1, histogram.counts[-1])
+        # Reported as the bounds of the end buckets until clamped
+        self.assertEqual(1, histogram.percentile(50))
+        self.assertEqual(102.0, histogram.percentile(100))
+
+    def test_summary(self):
+        histogram = LatencyHistogram(min_value=0.01, max_value=10000)
+        for value in (0.1, 0.3, 0.3, 0.5, 100.0):
+            histogram.record(value)
+        summary = histogram.summary()
+        self.assertEqual(5, summary['count'])
+        self.assertEqual(0.1, summary['min'])
+        self.assertEqual(100.0, summary['max'])
+        self.assertAlmostEqual(20.24, summary['mean'])
+        self.assertTrue(0.3 <= summary['p50'] < 0.31)
+        self.assertEqual(100.0, summary['p99'])
+        self.assertEqual(100.0, summary['p99.9'])
+
+    def test_merge_and_serialise(self):
+        first = LatencyHistogram()
+        second = LatencyHistogram()
+        for n in range(10):
+            first.record(0.01)
+            second.record(1.0)
+        copy = LatencyHistogram.from_dict(
+            json.loads(json.dumps(second.to_dict())))
+        self.assertEqual(second.counts, copy.counts)
+        self.assertEqual(10, copy.count)
+        self.assertEqual(1.0, copy.min)
+        first.merge(copy)
+        self.assertEqual(20, first.count)
+        self.assertEqual(0.01, first.min)
+        self.assertEqual(1.0, first.max)
+        self.assertAlmostEqual(0.01, first.percentile(50), places=3)
+        self.assertAlmostEqual(1.0, first.percentile(95))
+
+    def test_merge_different_buckets(self):
+        self.assertRaises(ValueError, LatencyHistogram().merge,
+                          LatencyHistogram(max_value=10))
+
+    def test_from_dict_invalid(self):
+        state = LatencyHistogram().to_dict()
+        state['counts'] = {'100000': 1}
+        self.assertRaises(ValueError, LatencyHistogram.from_dict, state)
+        self.assertRaises(KeyError, LatencyHistogram.from_dict, {})
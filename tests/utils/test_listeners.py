@@ -0,0 +1,86 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from swiftlm.utils import listeners
+from swiftlm.utils.listeners import Listener
+
+HEADER = '  sl  local_address rem_address   st tx_queue rx_queue ...\n'
+
+
+def tcp_line(local, remote, state, rx_queue, inode):
+    return ('   0: %s %s %s 00000000:%08X 00:00000000 00000000   112        0'
+            ' %d 1 0000000000000000 100 0 0 10 0\n' %
+            (local, remote, state, rx_queue, inode))
+
+
+TCP = (HEADER +
+       tcp_line('0100007F:0369', '00000000:0000', '0A', 0, 1001) +
+       tcp_line('0100A8C0:1770', '00000000:0000', '0A', 5, 1002) +
+       tcp_line('0100A8C0:1770', '0200A8C0:C350', '01', 0, 1003) +
+       '   3: garbage\n')
+
+ANY6 = '0' * 32
+TCP6 = (HEADER +
+        tcp_line(ANY6 + ':1F90', ANY6 + ':0000', '0A', 2, 2001) +
+        tcp_line('0' * 24 + '01000000:0016', ANY6 + ':0000', '0A', 0, 2002) +
+        tcp_line('0000000000000000FFFF00000100A8C0:1F91', ANY6 + ':0000',
+                 '0A', 0, 2003))
+
+
+class TestListeners(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.testdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_get_listeners(self):
+        tcp = self.write('tcp', TCP)
+        tcp6 = self.write('tcp6', TCP6)
+        missing = os.path.join(self.testdir, 'missing')
+        self.assertEqual(
+            listeners.get_listeners((tcp, tcp6, missing)),
+            [Listener('127.0.0.1', 873, 1001, 0),
+             Listener('192.168.0.1', 6000, 1002, 5),
+             Listener('::', 8080, 2001, 2),
+             Listener('::1', 22, 2002, 0),
+             Listener('192.168.0.1', 8081, 2003, 0)])
+
+    def test_get_socket_inodes(self):
+        fd_dir = os.path.join(self.testdir, '10', 'fd')
+        os.makedirs(fd_dir)
+        os.symlink('socket:[1001]', os.path.join(fd_dir, '3'))
+        os.symlink('/dev/null', os.path.join(fd_dir, '4'))
+        os.symlink('socket:[1002]', os.path.join(fd_dir, '5'))
+        self.assertEqual(
+            listeners.get_socket_inodes([10, 11], proc=self.testdir),
+            {1001: 10, 1002: 10})
+
+    def test_ip_matches(self):
+        self.assertTrue(listeners.ip_matches('10.0.0.1', '10.0.0.1'))
+        self.assertTrue(listeners.ip_matches('0.0.0.0', '10.0.0.1'))
+        self.assertTrue(listeners.ip_matches('::', '10.0.0.1'))
+        self.assertFalse(listeners.ip_matches('10.0.0.2', '10.0.0.1'))
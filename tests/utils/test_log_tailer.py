@@ -274,6 +274,18 @@ class TestOpsStats(unittest.TestCase):
                 self.assertEqual(num_cs, 2)
         self.assertEqual(num_ps, 2)
 
+    def test_latency(self):
+        stats = AccessStatsRecorder()
+        stats.record_op('GET', 200, 10, project='p1')
+        self.assertEqual(0, stats.latency.count)
+        for n in range(1, 101):
+            stats.record_op('GET', 200, 10, project='p1',
+                            request_time=n / 100.0)
+        self.assertEqual(100, stats.latency.count)
+        self.assertEqual(0.01, stats.latency.min)
+        self.assertEqual(1.0, stats.latency.percentile(100))
+        self.assertTrue(0.5 <= stats.latency.percentile(50) < 0.52)
+
 
 class TestParsing(unittest.TestCase):
 
@@ -302,7 +314,8 @@ class TestParsing(unittest.TestCase):
                                   'project':
                                       '7eacc76d75ef4457a20dc9de49edf8d4',
                                   'container': None,
-                                  'obj': None})
+                                  'obj': None,
+                                  'request_time': 0.0837})
 
         msg = ('May 27 00:18:00 standard-ccp-c1-m2-mgmt proxy-server:'
                ' 192.168.245.5 192.168.245.5 27/May/2016/00/18/00 PUT'
@@ -319,7 +332,8 @@ class TestParsing(unittest.TestCase):
                                   'project':
                                       '7eacc76d75ef4457a20dc9de49edf8d4',
                                   'container': 'swift_monitor_latency_test',
-                                  'obj': 'tinyobj-136-standard-ccp-c1-m1-mgmt'})
+                                  'obj': 'tinyobj-136-standard-ccp-c1-m1-mgmt',
+                                  'request_time': 0.0281})
 
         msg = ('May 27 00:18:00 standard-ccp-c1-m2-mgmt proxy-server:'
                ' 192.168.245.5 192.168.245.5 27/May/2016/00/18/00 GET'
@@ -336,7 +350,8 @@ class TestParsing(unittest.TestCase):
                                   'project':
                                       '7eacc76d75ef4457a20dc9de49edf8d4',
                                   'container': 'swift_monitor_latency_test',
-                                  'obj': 'tinyobj-136-standard-ccp-c1-m1-mgmt'})
+                                  'obj': 'tinyobj-136-standard-ccp-c1-m1-mgmt',
+                                  'request_time': 0.0115})
 
         msg = ('May 27 00:18:00 standard-ccp-c1-m2-mgmt proxy-server:'
                ' 192.168.245.5 192.168.245.5 27/May/2016/00/18/00 GET'
@@ -351,7 +366,8 @@ class TestParsing(unittest.TestCase):
                                   'bytes_transferred': 36,
                                   'project': None,
                                   'container': None,
-                                  'obj':  None})
+                                  'obj':  None,
+                                  'request_time': 0.0115})
 
     def test_log_parser_excluded_messages(self):
         msg = ('May 27 00:18:00 standard-ccp-c1-m2-mgmt proxy-server: - -'
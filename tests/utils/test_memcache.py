@@ -0,0 +1,47 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import unittest
+
+import mock
+from swift.common.memcached import MemcacheRing, md5hash
+
+from swiftlm.utils.memcache import ring_server
+
+SERVERS = ['192.168.245.5:11211', '192.168.245.6:11211',
+           '192.168.245.7:11211']
+
+
+class TestRingServer(unittest.TestCase):
+
+    def test_ring_server(self):
+        ring = MemcacheRing(SERVERS)
+        counts = dict((server, 0) for server in SERVERS)
+        for n in range(300):
+            counts[ring_server(ring, 'key-%d' % n)] += 1
+        self.assertEqual(300, sum(counts.values()))
+        self.assertTrue(all(count > 50 for count in counts.values()))
+
+    def test_matches_memcache_ring(self):
+        # The server chosen is the first that MemcacheRing would try
+        ring = MemcacheRing(SERVERS)
+        for server in SERVERS:
+            mock.patch.object(ring._client_cache[server], 'get',
+                              return_value=(None, None)).start()
+        self.addCleanup(mock.patch.stopall)
+        for n in range(20):
+            key = 'key-%d' % n
+            first = next(ring._get_conns(md5hash(key)))[0]
+            self.assertEqual(first, ring_server(ring, key))
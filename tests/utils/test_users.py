@@ -0,0 +1,65 @@
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+
+import unittest
+
+import mock
+from mock import Mock
+
+from swiftlm.utils import users
+
+
+class TestUsers(unittest.TestCase):
+
+    def setUp(self):
+        users.clear_cache()
+        self.addCleanup(users.clear_cache)
+
+    def test_get_uid_cached(self):
+        getpwnam = Mock(return_value=Mock(pw_uid=1001))
+        with mock.patch('pwd.getpwnam', getpwnam):
+            self.assertEqual(users.get_uid('swift'), 1001)
+            self.assertEqual(users.get_uid('swift'), 1001)
+        getpwnam.assert_called_once_with('swift')
+
+    def test_get_gid_cached(self):
+        getgrnam = Mock(return_value=Mock(gr_gid=1002))
+        with mock.patch('grp.getgrnam', getgrnam):
+            self.assertEqual(users.get_gid('swift'), 1002)
+            self.assertEqual(users.get_gid('swift'), 1002)
+        getgrnam.assert_called_once_with('swift')
+
+    def test_missing_user_and_group(self):
+        getpwnam = Mock(side_effect=KeyError)
+        getgrnam = Mock(side_effect=KeyError)
+        with mock.patch('pwd.getpwnam', getpwnam):
+            self.assertIsNone(users.get_uid('swift'))
+            self.assertIsNone(users.get_uid('swift'))
+        with mock.patch('grp.getgrnam', getgrnam):
+            self.assertIsNone(users.get_gid('swift'))
+        self.assertEqual(getpwnam.call_count, 1)
+
+    @mock.patch('pwd.getpwuid', lambda uid: Mock(pw_name='swift'))
+    @mock.patch('grp.getgrgid', lambda gid: Mock(gr_name='adm'))
+    def test_names(self):
+        self.assertEqual(users.get_user_name(1001), 'swift')
+        self.assertEqual(users.get_group_name(4), 'adm')
+
+    @mock.patch('pwd.getpwuid', Mock(side_effect=KeyError))
+    @mock.patch('grp.getgrgid', Mock(side_effect=KeyError))
+    def test_names_fallback(self):
+        self.assertEqual(users.get_user_name(1234), '1234')
+        self.assertEqual(users.get_group_name(4321), '4321')
@@ -18,6 +18,7 @@
 import json
 import os
 import tempfile
+import threading
 import unittest
 
 import mock
@@ -232,6 +233,13 @@ class TestAggregate(unittest.TestCase):
         self.assertEqual(24.0, agg.total)
         self.assertEqual(2.0, agg.avg)
 
+    def testMinZero(self):
+        agg = Aggregate()
+        for d in (0.0, 5.0, 2.0):
+            agg.add(d)
+        self.assertEqual(0.0, agg.min)
+        self.assertEqual(5.0, agg.max)
+
 
 class SleepInterval(unittest.TestCase):
 
@@ -247,3 +255,121 @@ class SleepInterval(unittest.TestCase):
         now = 1461665162  # Tue Apr 26 11:06:02 2016
         sleep_for = sleep_interval(60, now, 60)
         self.assertEqual(sleep_for, 58)
+
+
+class TestGetMounts(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+
+    def test_get_mounts(self):
+        path = os.path.join(self.testdir, 'mountinfo')
+        with open(path, 'w') as f:
+            f.write(
+                '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+                '40 22 8:17 / /srv/node/disk0 rw,noatime shared:20 - xfs '
+                '/dev/sdb1 rw,attr2,inode64,noquota\n'
+                '41 22 8:33 / /srv/node/disk\\0401 rw,noatime - xfs '
+                '/dev/sdc1 rw\n'
+                '42 22 8:33 / /srv/node/disk0 rw master:3 shared:4 - ext4 '
+                '/dev/sdd1 rw\n'
+                'garbage\n')
+        mounts = utility.get_mounts(path)
+        self.assertEqual(set(['/', '/srv/node/disk0', '/srv/node/disk 1']),
+                         set(mounts.keys()))
+        # The mount on top of a stacked mount point is the visible one
+        self.assertEqual(
+            utility.MountEntry('42', '/dev/sdd1', '/srv/node/disk0', 'ext4',
+                               'rw'),
+            mounts['/srv/node/disk0'])
+        self.assertEqual('xfs', mounts['/srv/node/disk 1'].fstype)
+
+    def test_get_labels(self):
+        label_dir = os.path.join(self.testdir, 'by-label')
+        os.mkdir(label_dir)
+        for dev, label in (('sdb1', 'disk0'), ('sdc1', 'my\\x20disk')):
+            dev_path = os.path.join(self.testdir, dev)
+            open(dev_path, 'w').close()
+            os.symlink(dev_path, os.path.join(label_dir, label))
+        blkid_file = os.path.join(self.testdir, 'blkid.tab')
+        with open(blkid_file, 'w') as f:
+            f.write('<device DEVNO="0x0811" TIME="1" LABEL="stale" '
+                    'TYPE="xfs">%s</device>\n'
+                    '<device DEVNO="0x0831" TIME="1" LABEL="disk2" '
+                    'TYPE="xfs">/dev/sdd1</device>\n'
+                    '<device DEVNO="0x0841" TYPE="swap">/dev/sde1</device>\n'
+                    % os.path.join(self.testdir, 'sdb1'))
+        labels = utility.get_labels(label_dir, (blkid_file,
+                                                '/does/not/exist'))
+        self.assertEqual({os.path.join(self.testdir, 'sdb1'): 'disk0',
+                          os.path.join(self.testdir, 'sdc1'): 'my disk',
+                          '/dev/sdd1': 'disk2'}, labels)
+
+    def test_get_labels_missing(self):
+        self.assertEqual({}, utility.get_labels('/does/not/exist', ()))
+
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.testdir)
+        state_dir = os.path.join(self.testdir, 'state')
+        p = mock.patch('swiftlm.utils.utility.SWIFTLM_STATE_DIR', state_dir)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_round_trip(self):
+        self.assertEqual({}, utility.load_state('test.json'))
+        utility.save_state('test.json', {'a': [1, 2]})
+        self.assertEqual({'a': [1, 2]}, utility.load_state('test.json'))
+        self.assertEqual(['test.json'],
+                         os.listdir(os.path.join(self.testdir, 'state')))
+
+    def test_unserialisable_state_not_saved(self):
+        utility.save_state('test.json', {'a': object()})
+        self.assertEqual({}, utility.load_state('test.json'))
+        self.assertEqual([], os.listdir(os.path.join(self.testdir, 'state')))
+
+    def test_state_dir(self):
+        other = os.path.join(self.testdir, 'other')
+        utility.save_state('test.json', {'a': 1}, other)
+        self.assertEqual({}, utility.load_state('test.json'))
+        self.assertEqual({'a': 1}, utility.load_state('test.json', other))
+
+
+class TestRunInThreads(unittest.TestCase):
+
+    def test_results_in_order(self):
+        results = utility.run_in_threads(lambda x: x * 2, [3, 1, 2], 5)
+        self.assertEqual([utility.ThreadResult(3, True, 6, None),
+                          utility.ThreadResult(1, True, 2, None),
+                          utility.ThreadResult(2, True, 4, None)], results)
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def func(item):
+            if item == 'hung':
+                release.wait()
+            return item
+
+        results = utility.run_in_threads(func, ['a', 'hung', 'b'], 0.1)
+        self.assertEqual([utility.ThreadResult('a', True, 'a', None),
+                          utility.ThreadResult('hung', False, None, None),
+                          utility.ThreadResult('b', True, 'b', None)], results)
+
+    def test_exception(self):
+        def func(item):
+            if item == 2:
+                raise OSError('bad item')
+            return item
+
+        results = utility.run_in_threads(func, [1, 2, 3], 5)
+        self.assertEqual([(1, True, 1, None), (3, True, 3, None)],
+                         [results[0], results[2]])
+        self.assertEqual((2, True, None), results[1][:3])
+        self.assertIsInstance(results[1].error, OSError)
+        self.assertEqual('bad item', str(results[1].error))